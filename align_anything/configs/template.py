@@ -13,6 +13,8 @@
 # limitations under the License.
 # ==============================================================================
 
+import functools
+import string
 from abc import ABC, abstractmethod
 from typing import Any
 
@@ -22,11 +24,87 @@ from PIL import Image
 from align_anything.utils.template_registry import register_template
 
 
+def split_placeholder(template: str, field: str) -> tuple[str, str | None]:
+    """Split a format string around its `field` placeholder, like `template.format(field=...)`.
+
+    The tail is None for a format string without the placeholder, which drops the value as
+    `str.format` does.
+    """
+    pieces = list(string.Formatter().parse(template))
+    fields = [(name, spec, conversion) for _, name, spec, conversion in pieces if name is not None]
+    if not fields:
+        return ''.join(literal for literal, *_ in pieces), None
+    if fields != [(field, '', None)]:
+        raise ValueError(f'Cannot compile {template!r}, it must hold a single plain {{{field}}}.')
+    index = next(i for i, (_, name, _, _) in enumerate(pieces) if name is not None)
+    return (
+        ''.join(literal for literal, *_ in pieces[: index + 1]),
+        ''.join(literal for literal, *_ in pieces[index + 1 :]),
+    )
+
+
+class FormatPlan:
+    """The `system + user + assistant` layout of a template, compiled into constant pieces.
+
+    A sample is formatted as `prefix + input + infix + output + suffix`, so the text and the
+    prompt are built in one pass and the prompt/response boundary is a character offset.
+    """
+
+    def __init__(self, system_prompt: str, user_prompt: str, assistant_prompt: str) -> None:
+        user_head, user_tail = split_placeholder(user_prompt, 'input')
+        assistant_head, assistant_tail = split_placeholder(assistant_prompt, 'output')
+        self.uses_input = user_tail is not None
+        self.uses_output = assistant_tail is not None
+        self.prefix = system_prompt + user_head
+        self.infix = (user_tail or '') + assistant_head
+        self.suffix = assistant_tail or ''
+
+    def head(self, input_text: str) -> str:
+        """The text up to the response, its length is the prompt/response boundary."""
+        if not self.uses_input:
+            return self.prefix + self.infix
+        return f'{self.prefix}{input_text}{self.infix}'
+
+    def complete(self, head: str, output_text: str) -> str:
+        """The full text of a response after `head`."""
+        if not self.uses_output:
+            return head + self.suffix
+        return f'{head}{output_text}{self.suffix}'
+
+    def prompt(self, head: str) -> str:
+        """The prompt of the generation, the full text with an empty response."""
+        return head + self.suffix
+
+    def format(self, input_text: str, output_text: str) -> tuple[str, str, int]:
+        """Format the text, the prompt and the character offset where the response starts."""
+        head = self.head(input_text)
+        return self.complete(head, output_text), self.prompt(head), len(head)
+
+    def format_batch(self, inputs: list[str], outputs: list[str]) -> dict[str, list[Any]]:
+        """Format the columns of a batch, for `datasets.Dataset.map(..., batched=True)`."""
+        heads = [self.head(input_text) for input_text in inputs]
+        return {
+            'text': [self.complete(head, output) for head, output in zip(heads, outputs)],
+            'prompt': [self.prompt(head) for head in heads],
+            'prompt_end': [len(head) for head in heads],
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def compile_format_plan(system_prompt: str, user_prompt: str, assistant_prompt: str) -> FormatPlan:
+    return FormatPlan(system_prompt, user_prompt, assistant_prompt)
+
+
 class Template(ABC):
     @abstractmethod
     def format_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
         pass
 
+    @property
+    def format_plan(self) -> FormatPlan:
+        """The compiled layout of the template, shared by its instances."""
+        return compile_format_plan(self.system_prompt, self.user_prompt, self.assistant_prompt)
+
 
 @register_template('Dialogue')
 class Dialogue(Template):
@@ -36,24 +114,25 @@ class Dialogue(Template):
     separator: str = ''
 
     def format_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
-        text = (
-            f'{self.system_prompt}'
-            f"{self.user_prompt.format(input=' '.join((raw_sample['instruction'], raw_sample['input'])))}"
-            f"{self.assistant_prompt.format(output=raw_sample['output'])}"
-        )
-
-        prompt = (
-            f'{self.system_prompt}'
-            f"{self.user_prompt.format(input=' '.join((raw_sample['instruction'], raw_sample['input'])))}"
-            f"{self.assistant_prompt.format(output='')}"
+        text, prompt, prompt_end = self.format_plan.format(
+            ' '.join((raw_sample['instruction'], raw_sample['input'])),
+            raw_sample['output'],
         )
 
         return_dict = {
             'text': text,
             'prompt': prompt,
+            'prompt_end': prompt_end,
         }
         return return_dict
 
+    def format_batch(self, batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        """Format the `text`, `prompt` and `prompt_end` columns of a batch of samples."""
+        return self.format_plan.format_batch(
+            [' '.join(pair) for pair in zip(batch['instruction'], batch['input'])],
+            batch['output'],
+        )
+
 
 @register_template('Vicuna')
 class Vicuna(Template):
@@ -63,28 +142,15 @@ class Vicuna(Template):
     split_token: str = 'ASSISTANT:'
 
     def format_text(self, raw_sample: dict[str, Any]) -> str:
-        formatted_output = (
-            f'{self.system_prompt}'
-            f"{self.user_prompt.format(input=raw_sample['user'])}"
-            f"{self.assistant_prompt.format(output=raw_sample['assistant'])}"
-        )
-        return formatted_output
+        plan = self.format_plan
+        return plan.complete(plan.head(raw_sample['user']), raw_sample['assistant'])
 
     def format_prompt(self, raw_sample: dict[str, Any]) -> str:
-        formatted_output = (
-            f'{self.system_prompt}'
-            f"{self.user_prompt.format(input=raw_sample['user'])}"
-            f"{self.assistant_prompt.format(output='')}"
-        )
-        return formatted_output
+        plan = self.format_plan
+        return plan.prompt(plan.head(raw_sample['user']))
 
     def format_sample(self, raw_sample: dict[str, Any]) -> str:
-        formatted_output = (
-            f'{self.system_prompt}'
-            f"{self.user_prompt.format(input=raw_sample['user'])}"
-            f"{self.assistant_prompt.format(output=raw_sample['assistant'])}"
-        )
-        return formatted_output
+        return self.format_text(raw_sample)
 
 
 @register_template('PKUSafeRLHF')
@@ -99,38 +165,22 @@ class PKUSafeRLHF(Template):
         metrics = raw_sample['better_response_id']
         better_response = raw_sample[f'response_{int(metrics)}']
         worse_response = raw_sample[f'response_{1-int(metrics)}']
-        prompt = raw_sample['prompt']
-
-        formatted_better_output = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output=better_response)}'
-        )
-        formatted_worse_output = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output=worse_response)}'
-        )
+        plan = self.format_plan
+        head = plan.head(raw_sample['prompt'])
 
         return {
-            'better_text': formatted_better_output,
-            'worse_text': formatted_worse_output,
+            'better_text': plan.complete(head, better_response),
+            'worse_text': plan.complete(head, worse_response),
+            'prompt_end': len(head),
         }
 
     def format_prompt_only_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
-        prompt = raw_sample['prompt']
-
-        formatted_prompt = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output="")}'
-        )
-
-        return {'text': formatted_prompt}
+        plan = self.format_plan
+        return {'text': plan.prompt(plan.head(raw_sample['prompt']))}
 
 
 @register_template('LLAVA')
-class LLAVA:
+class LLAVA(Template):
     system_prompt: str = ''
     user_prompt: str = 'USER: \n<image>{input}'
     assistant_prompt: str = '\nASSISTANT:{output}'
@@ -139,17 +189,9 @@ class LLAVA:
     def format_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
         raw_conversations = raw_sample['conversations']
         raw_prompt = raw_conversations[0]['value'].replace('<image>\n', '').replace('\n<image>', '')
-
-        text = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=raw_prompt)}'
-            f"{self.assistant_prompt.format(output=raw_conversations[1]['value'])}"
-        )
-
-        prompt = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=raw_prompt)}'
-            f"{self.assistant_prompt.format(output='')}"
+        text, prompt, prompt_end = self.format_plan.format(
+            raw_prompt,
+            raw_conversations[1]['value'],
         )
 
         base_coco_url = 'http://images.cocodataset.org/train2017/'
@@ -157,101 +199,60 @@ class LLAVA:
         return {
             'text': text,
             'prompt': prompt,
+            'prompt_end': prompt_end,
             'image': Image.open(requests.get(image_file, stream=True).raw),
         }
 
 
 @register_template('RLAIFV')
-class RLAIFV:
+class RLAIFV(Template):
     system_prompt: str = ''
     user_prompt: str = 'USER: \n<image>{input}'
     assistant_prompt: str = '\nASSISTANT:{output}'
     split_token: str = 'ASSISTANT:'
 
     def format_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
-        better_response = raw_sample['chosen']
-        worse_response = raw_sample['rejected']
-        prompt = raw_sample['question']
-        image = raw_sample['image']
-
-        formatted_better_output = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output=better_response)}'
-        )
-        formatted_worse_output = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output=worse_response)}'
-        )
+        plan = self.format_plan
+        head = plan.head(raw_sample['question'])
 
         return {
-            'better_text': formatted_better_output,
-            'worse_text': formatted_worse_output,
-            'image': image,
+            'better_text': plan.complete(head, raw_sample['chosen']),
+            'worse_text': plan.complete(head, raw_sample['rejected']),
+            'prompt_end': len(head),
+            'image': raw_sample['image'],
         }
     
     def format_prompt_only_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
-        prompt = raw_sample['question']
-        image = raw_sample['image']
-
-        formatted_prompt = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output="")}'
-        )
-
+        plan = self.format_plan
         return {
-            'text': formatted_prompt,
-            'image': image,
+            'text': plan.prompt(plan.head(raw_sample['question'])),
+            'image': raw_sample['image'],
         }
 
 
 @register_template('SPA_VL')
-class SPA_VL:
+class SPA_VL(Template):
     system_prompt: str = ''
     user_prompt: str = 'USER: \n<image>{input}'
     assistant_prompt: str = '\nASSISTANT:{output}'
     split_token: str = 'ASSISTANT:'
 
     def format_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
-        better_response = raw_sample['chosen']
-        worse_response = raw_sample['rejected']
-        prompt = raw_sample['question']
-        image = raw_sample['image']
-
-        formatted_better_output = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output=better_response)}'
-        )
-        formatted_worse_output = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output=worse_response)}'
-        )
-        image = image.convert('RGBA')
+        plan = self.format_plan
+        head = plan.head(raw_sample['question'])
 
         return {
-            'better_text': formatted_better_output,
-            'worse_text': formatted_worse_output,
-            'image': image,
+            'better_text': plan.complete(head, raw_sample['chosen']),
+            'worse_text': plan.complete(head, raw_sample['rejected']),
+            'prompt_end': len(head),
+            'image': raw_sample['image'].convert('RGBA'),
         }
 
     def format_prompt_only_sample(self, raw_sample: dict[str, Any]) -> dict[str, Any]:
-        prompt = raw_sample['question']
-        image = raw_sample['image']
-
-        formatted_prompt = (
-            f'{self.system_prompt}'
-            f'{self.user_prompt.format(input=prompt)}'
-            f'{self.assistant_prompt.format(output="")}'
-        )
-        image = image.convert('RGBA')
-
+        plan = self.format_plan
         return {
-            'text': formatted_prompt,
-            'image': image,
+            'text': plan.prompt(plan.head(raw_sample['question'])),
+            'image': raw_sample['image'].convert('RGBA'),
         }
 
 
@@ -21,6 +21,7 @@ from torch.utils.data import Dataset
 
 from align_anything.datasets.preference import *
 from align_anything.datasets.prompt_only import *
+from align_anything.datasets.streaming import *
 from align_anything.datasets.supervised import *
 
 
@@ -15,9 +15,11 @@
 
 from __future__ import annotations
 
+import hashlib
 from typing import Any, Callable
 from typing_extensions import TypedDict  # Python 3.10+
 
+import numpy as np
 import torch
 import transformers
 from torch.utils.data import Dataset
@@ -26,6 +28,7 @@ from transformers.tokenization_utils import PaddingStrategy, TruncationStrategy
 from align_anything.utils.multi_process import get_current_device
 from align_anything.utils.template_registry import get_template_class
 from align_anything.utils.tools import left_padding
+import datasets
 from datasets import load_dataset
 
 
@@ -39,16 +42,38 @@ __all__ = [
 ]
 
 
-def remove_duplicate_prompts(dict_list: list[dict[str, Any]], template):
-    seen_prompts = set()
-    unique_dict_list = []
-    for idx in range(len(dict_list)):
-        item = dict_list[idx]
-        prompt = template.format_prompt_only_sample(item)['text']
-        if prompt not in seen_prompts:
-            unique_dict_list.append(item)
-            seen_prompts.add(prompt)
-    return unique_dict_list
+def prompt_hash(raw_sample: dict[str, Any], template: Any) -> dict[str, int]:
+    """Hash the formatted prompt of a sample to a signed 64-bit integer."""
+    prompt = template.format_prompt_only_sample(raw_sample)['text']
+    if isinstance(prompt, list):
+        prompt = '\x00'.join(prompt)
+    digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=8).digest()
+    return {'prompt_hash': int.from_bytes(digest, 'little', signed=True)}
+
+
+def remove_duplicate_prompts(
+    dataset: datasets.Dataset,
+    template: Any,
+    num_proc: int | None = None,
+) -> datasets.Dataset:
+    """Keep the first sample of every formatted prompt.
+
+    The prompt hashes are computed with `map` over `num_proc` processes and cached by `datasets`
+    with the dataset, so only 8 bytes per sample are held in memory and the result stays backed
+    by Arrow.
+    """
+    hashes = dataset.map(
+        prompt_hash,
+        fn_kwargs={'template': template},
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        desc='Hashing prompts',
+    )
+    hashes = np.asarray(hashes.with_format('numpy')['prompt_hash'], dtype=np.int64)
+    _, first_indices = np.unique(hashes, return_index=True)
+    if len(first_indices) == len(dataset):
+        return dataset
+    return dataset.select(np.sort(first_indices))
 
 
 class PromptOnlySample(TypedDict, total=True):
@@ -76,6 +101,7 @@ class PromptOnlyDataset(Dataset):
         split: str | None = None,
         subset: str | None = None,
         data_files: str | None = None,
+        num_proc: int | None = None,
     ):
         super().__init__()
         assert path, f'You must set the valid datasets path! Here is {path}'
@@ -84,10 +110,15 @@ class PromptOnlyDataset(Dataset):
         self.processor = processor
         raw_data_duplicated = load_dataset(path, split=split, subset=subset, data_files=data_files)
         self.template = get_template_class(template)
-        self.raw_data = remove_duplicate_prompts(raw_data_duplicated, self.template)
+        self.raw_data = remove_duplicate_prompts(
+            raw_data_duplicated,
+            self.template,
+            num_proc=num_proc,
+        )
 
         if size:
-            self.raw_data = self.raw_data[:size]
+            size = min(size, len(self.raw_data))
+            self.raw_data = self.raw_data.select(range(int(size)))
 
     def preprocess(self, raw_sample: dict[str, Any]) -> PromptOnlySample:
         formatted_sample = self.template.format_prompt_only_sample(raw_sample)
@@ -0,0 +1,174 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Streaming variants of the datasets for corpora that do not fit in memory."""
+
+from __future__ import annotations
+
+import math
+from typing import Any, Iterator
+
+import torch.distributed as dist
+import transformers
+from torch.utils.data import IterableDataset, get_worker_info
+
+from align_anything.datasets.preference import PreferenceDataset
+from align_anything.datasets.prompt_only import PromptOnlyDataset
+from align_anything.datasets.supervised import SupervisedDataset
+from align_anything.utils.template_registry import get_template_class
+from datasets import load_dataset
+from datasets.distributed import split_dataset_by_node
+
+
+__all__ = [
+    'StreamingDataset',
+    'StreamingSupervisedDataset',
+    'StreamingPreferenceDataset',
+    'StreamingPromptOnlyDataset',
+]
+
+
+class StreamingDataset(IterableDataset):
+    """Stream, shard, shuffle and preprocess raw samples without loading the dataset.
+
+    The samples are shuffled with a buffer of `shuffle_buffer_size` samples, reshuffled every epoch,
+    and split over the ranks. Every rank yields exactly `len(self)` samples per epoch, wrapping
+    around its shard when it is short, so all ranks run the same number of steps. The length comes
+    from `size` or from the split information of the dataset.
+
+    Inside a rank the samples are dealt to the `DataLoader` workers in chunks of `batch_size`, the
+    order in which the `DataLoader` collects the batches, so the batches of a rank always follow
+    the same sample stream. The workers iterate copies of the dataset, so the trainer reports the
+    consumed samples with `consume` and moves to the next epoch with `set_epoch`. `state_dict`
+    records the position in the stream and `load_state_dict` resumes from it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        template: str,
+        tokenizer: transformers.PreTrainedTokenizer,
+        processor: transformers.ProcessorMixin | None = None,
+        size: int | None = None,
+        split: str | None = None,
+        subset: str | None = None,
+        data_files: str | None = None,
+        shuffle_buffer_size: int = 10000,
+        seed: int = 0,
+        batch_size: int = 1,
+    ) -> None:
+        assert path, f'You must set the valid datasets path! Here is {path}'
+        assert template, f'You must set the valid template path! Here is {template}'
+        self.tokenizer = tokenizer
+        self.processor = processor
+        self.template = get_template_class(template)
+        self.raw_data = load_dataset(
+            path,
+            split=split,
+            subset=subset,
+            data_files=data_files,
+            streaming=True,
+        )
+        if size:
+            self.raw_data = self.raw_data.take(int(size))
+        self.num_total_samples = self.estimate_size(size, split)
+
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.batch_size = batch_size
+        self.rank = dist.get_rank() if dist.is_initialized() else 0
+        self.world_size = dist.get_world_size() if dist.is_initialized() else 1
+        self.epoch = 0
+        self.num_consumed = 0
+
+    def estimate_size(self, size: int | None, split: str | None) -> int:
+        """Take the length from `size`, otherwise from the split information of the dataset."""
+        if size:
+            return int(size)
+        splits = getattr(self.raw_data.info, 'splits', None) or {}
+        split_info = splits.get(split or 'train')
+        if split_info is None or not split_info.num_examples:
+            raise ValueError(
+                'The size of the streaming dataset is unknown, please set the dataset size.',
+            )
+        return split_info.num_examples
+
+    def __len__(self) -> int:
+        """Get the number of samples per rank and epoch."""
+        return math.ceil(self.num_total_samples / self.world_size)
+
+    def set_epoch(self, epoch: int) -> None:
+        """Reshuffle the stream for `epoch` and start it from the beginning."""
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.num_consumed = 0
+
+    def consume(self, num_samples: int) -> None:
+        """Record that the trainer consumed `num_samples` more samples of the epoch."""
+        self.num_consumed = min(self.num_consumed + num_samples, len(self))
+
+    def state_dict(self) -> dict[str, int]:
+        return {'epoch': self.epoch, 'num_consumed': self.num_consumed}
+
+    def load_state_dict(self, state_dict: dict[str, int]) -> None:
+        self.epoch = state_dict['epoch']
+        self.num_consumed = state_dict['num_consumed']
+
+    def rank_stream(self) -> Iterator[Any]:
+        """Yield the `len(self)` raw samples of this rank for the current epoch."""
+        raw_data = self.raw_data.shuffle(seed=self.seed, buffer_size=self.shuffle_buffer_size)
+        raw_data.set_epoch(self.epoch)
+        raw_data = split_dataset_by_node(raw_data, rank=self.rank, world_size=self.world_size)
+        num_samples = 0
+        while num_samples < len(self):
+            num_samples_before = num_samples
+            for raw_sample in raw_data:
+                yield raw_sample
+                num_samples += 1
+                if num_samples >= len(self):
+                    return
+            if num_samples == num_samples_before:
+                return
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        start = self.num_consumed
+
+        for index, raw_sample in enumerate(self.rank_stream()):
+            if index < start:
+                continue
+            if (index - start) // self.batch_size % num_workers != worker_id:
+                continue
+            yield self.preprocess(raw_sample)
+
+    def __getitem__(self, index: int) -> Any:
+        raise TypeError(f'{type(self).__name__} only supports iteration.')
+
+
+class StreamingSupervisedDataset(StreamingDataset, SupervisedDataset):
+    """Streaming variant of `SupervisedDataset`."""
+
+
+class StreamingPreferenceDataset(StreamingDataset, PreferenceDataset):
+    """Streaming variant of `PreferenceDataset`."""
+
+
+class StreamingPromptOnlyDataset(StreamingDataset, PromptOnlyDataset):
+    """Streaming variant of `PromptOnlyDataset`, duplicated prompts are not removed."""
+
+    def __init__(self, *args: Any, num_proc: int | None = None, **kwargs: Any) -> None:
+        # `num_proc` of the deduplication is accepted for the same signature as `PromptOnlyDataset`
+        super().__init__(*args, **kwargs)
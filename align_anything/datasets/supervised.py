@@ -86,12 +86,33 @@ class SupervisedDataset(Dataset):
             raw_text = formatted_sample['text'] + self.tokenizer.eos_token
         else:
             raise NotImplementedError
-        return_dict['input_ids'] = self.tokenize(raw_text)
+        prompt_end = formatted_sample.get('prompt_end')
+        if (
+            prompt_end is not None
+            and isinstance(formatted_sample['text'], str)
+            and self.tokenizer.is_fast
+        ):
+            # locate the response by character offsets instead of tokenizing the prompt again
+            encoded = self.tokenizer(
+                raw_text,
+                max_length=self.tokenizer.model_max_length,
+                truncation=True,
+                return_offsets_mapping=True,
+                return_tensors='pt',
+            )
+            return_dict['input_ids'] = encoded['input_ids'][0]
+            starts, ends = encoded['offset_mapping'][0].unbind(dim=-1)
+            is_response = (ends > starts) & (starts >= prompt_end)
+            num_prompt_tokens = (
+                int(is_response.int().argmax()) if is_response.any() else len(starts)
+            )
+        else:
+            return_dict['input_ids'] = self.tokenize(raw_text)
+            num_prompt_tokens = len(self.tokenize(formatted_sample['prompt']))
 
-        formatted_prompt = formatted_sample['prompt']
         labels = return_dict['input_ids'].clone()
         # mask non-assistant input
-        labels[: len(self.tokenize(formatted_prompt))] = IGNORE_INDEX
+        labels[:num_prompt_tokens] = IGNORE_INDEX
         return_dict['labels'] = labels
 
         if 'image' in formatted_sample.keys():
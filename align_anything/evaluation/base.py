@@ -14,8 +14,11 @@
 # ==============================================================================
 
 import os
+import math
 import json
+import heapq
 import torch
+import warnings
 import random
 import numpy as np
 from tqdm import tqdm
@@ -23,14 +26,17 @@ from pprint import pprint
 from abc import abstractmethod
 from typing import Union, List, Dict, Any, Tuple
 from datasets import load_dataset, DatasetDict
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader
 from collections import OrderedDict
 
 import deepspeed
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
 from align_anything.models.pretrained_model import load_pretrained_models
+from align_anything.utils.tools import gather_log_probabilities, left_padding, right_padding
 from align_anything.evaluation.dis_utils import *
+from align_anything.evaluation.result_cache import ResultCache, model_fingerprint
+from align_anything.utils.speculative_decoding import SpeculativeDecoder, split_speculative_config
 
 
 ACTION_GENERATION = 'generation'
@@ -56,10 +62,11 @@ class BaseEvaluator:
         self.output_dir = self.eval_cfgs.output_dir
         self.cache_dir = os.path.join(self.output_dir, '.cache')
         self.temperature = self.eval_cfgs.temperature if self.eval_cfgs.temperature else 0.7
-        self.generate_config = self.eval_cfgs.generate_config if self.eval_cfgs.generate_config else {}
+        self.generate_config, self.speculative_config = split_speculative_config(self.eval_cfgs.generate_config)
 
         self.batch_size = self.eval_cfgs.batch_size if self.eval_cfgs.batch_size else 1
-        assert self.batch_size == 1, "Current version only supports batch_size=1"
+        assert self.batch_size == 1 or self.action == ACTION_PPL, "Current version only supports batch_size=1 except for action `ppl`"
+        self.ppl_length_normalize = self.eval_cfgs.ppl_length_normalize if self.eval_cfgs.ppl_length_normalize else False
 
         self.split = self.data_cfgs.split
         self.task_dir = self.data_cfgs.task_dir
@@ -69,6 +76,10 @@ class BaseEvaluator:
         self.max_length = self.model_cfgs.max_length
         self.max_new_tokens = self.model_cfgs.max_new_tokens
 
+        self.use_prefix_cache = self.eval_cfgs.prefix_cache if self.eval_cfgs.prefix_cache is not None else True
+        self.prefix_cache = None
+        self.use_result_cache = self.eval_cfgs.result_cache if self.eval_cfgs.result_cache is not None else True
+
         self.task2details = {}
         self.task2correction = {}
         self.details_filename = f'{self.model_id}_details.jsonl'
@@ -82,6 +93,9 @@ class BaseEvaluator:
         self.task_names = self.get_task_names()
 
         self.init_model()
+        self.init_speculator()
+        self.init_candidate_label_ids()
+        self.init_result_cache()
 
     def init_model(self) -> None:
         if self.ds_cfgs is not None and self.ds_cfgs['zero_optimization']['stage'] == 3:
@@ -105,63 +119,118 @@ class BaseEvaluator:
             )
         self.model.eval()
 
+    def init_speculator(self) -> None:
+        self.speculator = SpeculativeDecoder(
+            self.model,
+            **self.speculative_config,
+            trust_remote_code=self.model_cfgs.trust_remote_code,
+        )
+
+
+    def init_candidate_label_ids(self) -> None:
+        """Resolve and validate the token id scored for each candidate label once."""
+        self.candidate_label_ids = None
+        if not self.candidate_labels:
+            return
+
+        label_ids = []
+        for label in self.candidate_labels:
+            token_ids = self.tokenizer(label, add_special_tokens=False).input_ids
+            if len(token_ids) == 0:
+                raise ValueError(f"Candidate label '{label}' is tokenized to no tokens.")
+            # Sentencepiece and byte-level BPE tokenizers mark the word boundary with a '▁' or
+            # 'Ġ' prefix, either on the label token ('▁A') or as a token of its own ('▁', 'A').
+            # That is how the label follows the prompt, so only the label itself is counted.
+            tokens = self.tokenizer.convert_ids_to_tokens(token_ids)
+            label_tokens = tokens[1:] if len(tokens) > 1 and tokens[0] in ('▁', 'Ġ') else tokens
+            if len(label_tokens) > 1:
+                warnings.warn(
+                    f"Candidate label '{label}' is tokenized to {len(label_tokens)} tokens "
+                    f'{label_tokens}, only the last one is scored.',
+                    category=RuntimeWarning,
+                    stacklevel=2,
+                )
+            label_ids.append(token_ids[-1])
+
+        if len(set(label_ids)) != len(label_ids):
+            raise ValueError(
+                f'Candidate labels {self.candidate_labels} are not mapped to distinct tokens: {label_ids}'
+            )
+        self.candidate_label_ids = torch.tensor(label_ids, dtype=torch.long, device=self.device)
+
+    def init_result_cache(self) -> None:
+        self.result_cache = None
+        if not self.use_result_cache:
+            return
+        self.model_fingerprint = model_fingerprint(
+            self.model_cfgs.model_name_or_path,
+            getattr(getattr(self.model, 'module', self.model), 'config', None),
+        )
+        self.result_cache = ResultCache(os.path.join(self.cache_dir, f'{self.model_id}_results'), get_rank())
+
+    def get_result_config(self) -> Dict[str, Any]:
+        """Everything besides the model and the prompt that changes the result of an instance."""
+        return {
+            'action': self.action,
+            'candidate_labels': self.candidate_labels,
+            'ppl_length_normalize': self.ppl_length_normalize,
+            'max_new_tokens': self.max_new_tokens,
+            'generate_config': self.generate_config,
+        }
 
     def load_dataset(self, task_name: str) -> DatasetDict:
         return load_dataset(self.task_dir, task_name)
 
     def eval(self) -> None:
-        local_task2details = {}
-        local_task2correction = {}
-        for name in self.task_names:
-            task2details, correction = self.eval_task(name, self.split)
-
-            self.update_results(task2details)
-
-            local_task2details.update(task2details)
-            local_task2correction.update(correction)
-
-        self.save_to_cache(local_task2details, f'{self.model_id}_details.jsonl')
-        self.save_to_cache(local_task2correction, f'{self.model_id}_correction.jsonl')
-        dist.barrier()
+        with open(self.get_shard_path(get_rank()), 'w', encoding='utf-8') as f:
+            for name in self.task_names:
+                task2details, _ = self.eval_task(name, self.split)
+                for task, details in task2details.items():
+                    for detail in details:
+                        f.write(json.dumps({'task': task, **detail}, ensure_ascii=False) + '\n')
+                f.flush()
+
+        if is_dist_avail_and_initialized():
+            dist.barrier()
+        self.speculative_stats = self.speculator.stats.all_reduce() if self.speculator.enabled else None
 
         if is_main_process():
-            self.load_cache()
+            self.merge_shards()
             self.calculate_results()
 
-    def load_cache(self) -> None:
-        for line in open(os.path.join(self.cache_dir, f'{self.model_id}_details.jsonl'), 'r', encoding='utf-8'):
-            task2details = json.loads(line)
-            if len(self.task2details) == 0:
-                self.task2details = task2details
-            else:
-                for k, v in task2details.items():
-                    self.task2details[k].extend(v)
-
-        for line in open(os.path.join(self.cache_dir, f'{self.model_id}_correction.jsonl'), 'r', encoding='utf-8'):
-            task2correction = json.loads(line)
-            if len(self.task2correction) == 0:
-                self.task2correction = task2correction
-            else:
-                for k, v in task2correction.items():
-                    self.task2correction[k].extend(v)
-
-    def save_to_cache(self, data: Dict[str, Any], filename: str) -> None:
-        with open(os.path.join(self.cache_dir, filename), 'a', encoding='utf-8') as f:
-            f.write(json.dumps(data, ensure_ascii=False) + '\n')
-
-    def update_results(self,
-                       task2details:Dict[str, Dict[str, Any]]
-                    )->None:
-        file_path = os.path.join(self.output_dir, self.details_filename)
-
-        with open(file_path, 'a', encoding='utf-8') as file:
-            for k, v in task2details.items():
-                json_record = json.dumps({k: v}, ensure_ascii=False)
-                file.write(json_record + '\n')
+    def get_shard_path(self, rank: int) -> str:
+        return os.path.join(self.cache_dir, f'{self.model_id}_details.rank{rank}.jsonl')
+
+    def merge_shards(self) -> None:
+        """Stream the per-rank shards into the details file in dataset order."""
+        task_order = {name: i for i, name in enumerate(self.task_names)}
+
+        def read_shard(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    yield (task_order[record['task']], record['index']), record
+
+        # Every shard is sorted by (task, index), so a k-way merge keeps the memory bounded.
+        shards = [read_shard(self.get_shard_path(rank)) for rank in range(get_world_size())]
+        self.task2details, self.task2correction = {}, {}
+        last_key = None
+        with open(os.path.join(self.output_dir, self.details_filename), 'w', encoding='utf-8') as f:
+            for key, record in heapq.merge(*shards, key=lambda item: item[0]):
+                if key == last_key:
+                    continue
+                last_key = key
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.accumulate_record(record)
+
+    def accumulate_record(self, record: Dict[str, Any]) -> None:
+        """Keep what `calculate_results` needs from a merged record."""
+        self.task2correction.setdefault(record['task'], []).append(record['is_correct'])
 
     def eval_task(self, task_name: str, split='val') -> Dict[str, Dict[str, Any]]:
         dataset = self.load_dataset(task_name)
         self.set_fewshot_dataset(dataset)
+        self.set_prefix_cache()
 
         task_details, task_correction = [], []
 
@@ -170,13 +239,62 @@ class BaseEvaluator:
             keys = preprocessed[0].keys()
             return {key: [data[key] for data in preprocessed] for key in keys}
 
-        sampler = DistributedSampler(dataset[split]) if torch.distributed.is_initialized() else None
-        dataloader = DataLoader(dataset[split], sampler=sampler, batch_size=self.batch_size, collate_fn=collate_fn)
-
+        num_samples = len(dataset[split])
+        rank, world_size = get_rank(), get_world_size()
+        cached, cached_indices, keys = {}, set(), {}
+        if self.result_cache is not None:
+            config = self.get_result_config()
+
+            def make_key(index):
+                if index not in keys:
+                    prompt = self.build_prompt(dataset[split][index])
+                    keys[index] = self.result_cache.make_key(
+                        self.model_fingerprint, task_name, split, index, prompt, config
+                    )
+                return keys[index]
+
+            # Every rank only builds the prompts of its round-robin share of the instances.
+            own_indices = range(rank, num_samples, world_size)
+            own_keys = [make_key(index) for index in own_indices]
+            # The other ranks must have committed their results of the previous task.
+            if is_dist_avail_and_initialized():
+                dist.barrier()
+            found = self.result_cache.get_many(own_keys)
+            cached = {index: found[keys[index]] for index in own_indices if keys[index] in found}
+            cached_indices = set(cached)
+            # All ranks must agree on the pending instances, and finish reading before writing.
+            if is_dist_avail_and_initialized():
+                gathered = [None] * world_size
+                dist.all_gather_object(gathered, sorted(cached))
+                cached_indices = {index for indices in gathered for index in indices}
+        pending = [index for index in range(num_samples) if index not in cached_indices]
+
+        # Shard the pending instances like DistributedSampler, padding the last round so that all
+        # ranks run the same number of forwards.
+        indices = pending
+        if world_size > 1 and len(pending) > 0:
+            total_size = math.ceil(len(pending) / world_size) * world_size
+            padded = (pending * math.ceil(total_size / len(pending)))[:total_size]
+            indices = padded[rank:total_size:world_size]
+        dataloader = DataLoader(dataset[split], sampler=indices, batch_size=self.batch_size, collate_fn=collate_fn)
+
+        position = 0
+        records = list(cached.items())
         for batch in tqdm(dataloader, desc=f"Evaluating task {task_name}"):
             details, correction = self.eval_instance(batch)
-            task_details.extend(details)
-            task_correction.extend(correction)
+            new_records = []
+            for detail, is_correct in zip(details, correction):
+                # The padded positions keep all ranks in lockstep but must not be scored twice.
+                if position * world_size + rank < len(pending):
+                    new_records.append((indices[position], {**detail, 'is_correct': is_correct}))
+                position += 1
+            if self.result_cache is not None:
+                self.result_cache.put_many(task_name, [(make_key(index), record) for index, record in new_records])
+            records.extend(new_records)
+
+        for index, record in sorted(records, key=lambda item: item[0]):
+            task_details.append({'index': index, **record})
+            task_correction.append(record['is_correct'])
 
         return {task_name: task_details}, {task_name: task_correction}
 
@@ -209,22 +327,93 @@ class BaseEvaluator:
         action_func = getattr(self, action_func_name)
         return action_func(inputs)
 
-    def choice_logits(self, inputs: List[str])-> Tuple[List[str], List[Dict[str, Any]]]:
-        # TODO: add support for multiple prompts
-        logits = self.model(**inputs['inputs'][0]).logits[:, -1].flatten()
-
-        candidate_logits = torch.tensor([logits[self.tokenizer(label).input_ids[-1]] for label in self.candidate_labels]).to(torch.float32)
-        probs = torch.nn.functional.softmax(candidate_logits, dim=-1).cpu().numpy()
-
-        pred_index = probs.argmax()
-        pred = self.candidate_labels[pred_index]
-
-        info = {
-            'probs': [f'{prob: .4f}' for prob in probs],
-            'logits': [f'{logit: .4f}' for logit in candidate_logits.cpu().numpy()]
+    @torch.no_grad()
+    def set_prefix_cache(self) -> None:
+        """Encode the few-shot prefix shared by every instance of the current task once."""
+        self.prefix_cache = None
+        if not self.use_prefix_cache or self.action != ACTION_LOGITS:
+            return
+        prefix = self.build_fewshot_prefix()
+        if not prefix:
+            return
+
+        # The last prefix token is left to the suffix, so that a token merged across the
+        # prefix/question boundary does not make every instance miss the cache.
+        prefix_ids = self.processor(prefix, return_tensors='pt').to(self.device)['input_ids'][:, :-1]
+        if prefix_ids.size(-1) == 0:
+            return
+        past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+        past_key_values, cache_class = self.to_legacy_cache(past_key_values)
+
+        self.prefix_cache = {
+            'input_ids': prefix_ids,
+            'past_key_values': past_key_values,
+            'cache_class': cache_class,
         }
 
-        return [pred], [info]
+    @staticmethod
+    def to_legacy_cache(past_key_values: Any) -> Tuple[Tuple[Tuple[torch.Tensor, ...], ...], Any]:
+        """Convert the model cache to the tuple format, returning the original cache class."""
+        if hasattr(past_key_values, 'to_legacy_cache'):
+            return past_key_values.to_legacy_cache(), type(past_key_values)
+        return past_key_values, None
+
+    @staticmethod
+    def from_legacy_cache(past_key_values: Tuple[Tuple[torch.Tensor, ...], ...], cache_class: Any) -> Any:
+        if cache_class is not None:
+            return cache_class.from_legacy_cache(past_key_values)
+        return past_key_values
+
+    def get_prefix_past_key_values(self, batch_size: int) -> Any:
+        # Broadcast the cached prefix over the batch; the model concatenates new keys and values
+        # into fresh tensors, so the shared cache is never modified in place.
+        past_key_values = tuple(
+            tuple(state.expand(batch_size, *state.shape[1:]) for state in layer)
+            for layer in self.prefix_cache['past_key_values']
+        )
+        return self.from_legacy_cache(past_key_values, self.prefix_cache['cache_class'])
+
+    def last_token_logits(self, inputs: Dict[str, Any]) -> torch.Tensor:
+        input_ids = inputs['input_ids']
+        if self.prefix_cache is not None and set(inputs.keys()) <= {'input_ids', 'attention_mask'}:
+            prefix_ids = self.prefix_cache['input_ids']
+            prefix_length = prefix_ids.size(-1)
+            batch_size = input_ids.size(0)
+            if input_ids.size(-1) > prefix_length and torch.equal(
+                input_ids[:, :prefix_length], prefix_ids.expand(batch_size, -1)
+            ):
+                attention_mask = inputs.get('attention_mask')
+                if attention_mask is None:
+                    attention_mask = torch.ones_like(input_ids)
+                return self.model(
+                    input_ids=input_ids[:, prefix_length:],
+                    attention_mask=attention_mask,
+                    past_key_values=self.get_prefix_past_key_values(batch_size),
+                    use_cache=True,
+                ).logits[:, -1]
+        return self.model(**inputs).logits[:, -1]
+
+    def choice_logits(self, inputs: List[str])-> Tuple[List[str], List[Dict[str, Any]]]:
+        # TODO: add support for multiple prompts
+        if self.candidate_label_ids is None:
+            raise ValueError('Action `logits` requires `candidate_labels` to be set in yaml')
+        logits = self.last_token_logits(inputs['inputs'][0])  # size = (B, V)
+
+        label_ids = self.candidate_label_ids.to(logits.device)
+        candidate_logits = logits.index_select(-1, label_ids).to(torch.float32)  # size = (B, C)
+        probs = torch.nn.functional.softmax(candidate_logits, dim=-1)
+        pred_indices = probs.argmax(dim=-1).tolist()
+
+        probs, candidate_logits = probs.cpu().numpy(), candidate_logits.cpu().numpy()
+        preds, infos = [], []
+        for pred_index, prob, candidate_logit in zip(pred_indices, probs, candidate_logits):
+            preds.append(self.candidate_labels[pred_index])
+            infos.append({
+                'probs': [f'{p: .4f}' for p in prob],
+                'logits': [f'{logit: .4f}' for logit in candidate_logit]
+            })
+
+        return preds, infos
 
     def generation(self, inputs: Dict[str, Any]):
         return self._generation(inputs)
@@ -232,23 +421,109 @@ class BaseEvaluator:
 
     def _generation(self, inputs: Dict[str, Any])-> Tuple[str, Dict[str, Any]]:
         inputs = inputs['inputs'][0]
-        outputs = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, **self.generate_config)
+        outputs = self.speculator.generate(self.model, **inputs, max_new_tokens=self.max_new_tokens, **self.generate_config)
         outputs = outputs[:, inputs['input_ids'].shape[1]:]
         response = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
         return [self.parser_response(response)], [{'response': response}]
 
-    def choice_ppl(self, inputs: Dict[str, Any])-> Tuple[str, Dict[str, Any]]:
-        # TODO: add support for multiple prompts
-        inputs = inputs['inputs'][0]
-        def score(ctx):
-            input_ids = ctx['input_ids']
-            target_ids = input_ids.clone()
-            loss = self.model(input_ids, labels=target_ids).loss.to(torch.float32)
-            return loss.detach().cpu().numpy()
-        candidate_scores = [score(ctx) for ctx in inputs]
-        pred = 'ABCDEFG'[np.argmin(candidate_scores)]
-        info = {'candidate_scores': [f'{x: .4f}' for x in candidate_scores]}
-        return [pred], [info]
+    def tokenize_candidates(self, candidates: List[Tuple[str, str]]) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Tokenize (context, continuation) pairs into context ids and continuation ids."""
+        tokenized = []
+        for context, continuation in candidates:
+            # Move trailing spaces of the context to the continuation, so that the boundary is
+            # tokenized as in the whole sequence.
+            num_spaces = len(context) - len(context.rstrip())
+            if num_spaces > 0:
+                context, continuation = context[:-num_spaces], context[-num_spaces:] + continuation
+            whole_ids = self.tokenizer(context + continuation).input_ids
+            num_context_ids = len(self.tokenizer(context).input_ids)
+            assert 0 < num_context_ids < len(whole_ids), f'invalid candidate: {(context, continuation)}'
+            tokenized.append((
+                torch.tensor(whole_ids[:num_context_ids], dtype=torch.long),
+                torch.tensor(whole_ids[num_context_ids:], dtype=torch.long),
+            ))
+        return tokenized
+
+    @torch.no_grad()
+    def score_continuations(
+        self,
+        contexts: List[torch.Tensor],
+        continuations: List[torch.Tensor],
+        context_indices: List[int],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Log-likelihood of each continuation given `contexts[context_indices[i]]`.
+
+        The distinct contexts are encoded once, left padded, and their key-value cache is shared
+        by all continuations in a single right padded forward.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        context_ids = left_padding(contexts, padding_value=pad_token_id).to(self.device)
+        context_mask = left_padding(
+            [torch.ones_like(ids, dtype=torch.bool) for ids in contexts], padding_value=False
+        ).to(self.device)
+        context_outputs = self.model(
+            input_ids=context_ids,
+            attention_mask=context_mask,
+            position_ids=(context_mask.long().cumsum(dim=-1) - 1).clamp(min=0),
+            use_cache=True,
+        )
+        past_key_values, cache_class = self.to_legacy_cache(context_outputs.past_key_values)
+
+        index = torch.tensor(context_indices, dtype=torch.long, device=self.device)
+        past_key_values = tuple(
+            tuple(state.index_select(0, index.to(state.device)) for state in layer)
+            for layer in past_key_values
+        )
+
+        continuation_ids = right_padding(continuations, padding_value=pad_token_id).to(self.device)
+        continuation_mask = right_padding(
+            [torch.ones_like(ids, dtype=torch.bool) for ids in continuations], padding_value=False
+        ).to(self.device)
+        context_lengths = context_mask.sum(dim=-1).index_select(0, index)
+        position_ids = context_lengths.unsqueeze(-1) + torch.arange(
+            continuation_ids.size(-1), device=self.device
+        )
+        logits = self.model(
+            input_ids=continuation_ids,
+            attention_mask=torch.cat([context_mask.index_select(0, index), continuation_mask], dim=-1),
+            position_ids=position_ids,
+            past_key_values=self.from_legacy_cache(past_key_values, cache_class),
+            use_cache=True,
+        ).logits
+
+        # The first continuation token is predicted by the last context position.
+        last_context_logits = context_outputs.logits[:, -1:].index_select(0, index.to(logits.device))
+        logits = torch.cat([last_context_logits, logits[:, :-1]], dim=1)
+        continuation_mask = continuation_mask.to(logits.device)
+        log_probs = gather_log_probabilities(logits.float(), continuation_ids.to(logits.device))
+        log_likelihoods = (log_probs * continuation_mask).sum(dim=-1)
+        return log_likelihoods, continuation_mask.sum(dim=-1)
+
+    def choice_ppl(self, inputs: Dict[str, Any])-> Tuple[List[str], List[Dict[str, Any]]]:
+        contexts, continuations, context_indices, num_candidates = [], [], [], []
+        context2index = {}
+        for candidates in inputs['inputs']:
+            num_candidates.append(len(candidates))
+            for context_ids, continuation_ids in candidates:
+                key = tuple(context_ids.tolist())
+                if key not in context2index:
+                    context2index[key] = len(contexts)
+                    contexts.append(context_ids)
+                context_indices.append(context2index[key])
+                continuations.append(continuation_ids)
+
+        log_likelihoods, lengths = self.score_continuations(contexts, continuations, context_indices)
+        if self.ppl_length_normalize:
+            log_likelihoods = log_likelihoods / lengths
+        candidate_scores = log_likelihoods.cpu().numpy()
+
+        preds, infos, start = [], [], 0
+        for num in num_candidates:
+            scores = candidate_scores[start:start + num]
+            start += num
+            preds.append('ABCDEFG'[np.argmax(scores)])
+            infos.append({'candidate_scores': [f'{x: .4f}' for x in scores]})
+        return preds, infos
 
     def parser_response(self, response: List[str]) -> str:
         response = response[0].strip()
@@ -271,6 +546,8 @@ class BaseEvaluator:
             total_correct += sum(correction)
             total_length += len(correction)
         result['average'] = total_correct / total_length
+        if self.speculative_stats is not None:
+            result['speculative_decoding'] = self.speculative_stats.summary()
 
         with open(os.path.join(self.output_dir, self.results_filename), 'w', encoding='utf-8') as f:
             json.dump(result, f, ensure_ascii=False, indent=4)
@@ -294,6 +571,10 @@ class BaseEvaluator:
     def build_example_prompt(self, data, with_answer: bool=True):
         raise NotImplementedError
 
+    def build_fewshot_prefix(self) -> str:
+        """The part of `build_prompt` shared by every instance of a task, empty if there is none."""
+        return ''
+
     @abstractmethod
     def build_prompt(self, data: Dict[str, Any])-> str:
         raise NotImplementedError
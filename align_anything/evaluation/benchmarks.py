@@ -57,20 +57,21 @@ class MMLU(BaseEvaluator):
         answer = f'Answer: {self.get_answer(data)}' if with_answer else 'Answer: '
         return f"{data['question']}\n{choices}\n{answer}"
 
-    def build_prompt(self, data):
+    def build_fewshot_prefix(self):
         prompt = f"The following are multiple choice questions (with answers).\n\n"
         few_shot_examples = self.few_shot_data[:self.num_shot] if self.num_shot else []
         if len(few_shot_examples) == 0:
-            return prompt + self.build_example_prompt(data, False)
-        else:
-            examples = [
-                self.build_example_prompt(
-                    {key: value[i] for key, value in few_shot_examples.items()}, True
-                )
-                for i in range(len(few_shot_examples['question']))
-            ]
-            examples.append(self.build_example_prompt(data, False))
-            return prompt + '\n\n'.join(examples)
+            return prompt
+        examples = [
+            self.build_example_prompt(
+                {key: value[i] for key, value in few_shot_examples.items()}, True
+            )
+            for i in range(len(few_shot_examples['question']))
+        ]
+        return prompt + '\n\n'.join(examples) + '\n\n'
+
+    def build_prompt(self, data):
+        return self.build_fewshot_prefix() + self.build_example_prompt(data, False)
 
 
 @register_evaluator('gaokao')
@@ -99,19 +100,20 @@ class GaokaoSingleChoice(BaseEvaluator):
         answer = f"答案：{data['answer']}" if with_answer else '答案：'
         return f'{question}\n{choices}\n{answer}'
 
-    def build_prompt(self, data):
+    def build_fewshot_prefix(self):
         few_shot_examples = self.few_shot_data[:self.num_shot] if self.num_shot else []
         if len(few_shot_examples) == 0:
-            return self.build_example_prompt(data, False)
-        else:
-            examples = [
-                self.build_example_prompt(
-                    {key: value[i] for key, value in few_shot_examples.items()}, True
-                )
-                for i in range(len(few_shot_examples['question']))
-            ]
-            examples.append(self.build_example_prompt(data, False))
-            return '\n'.join(examples)
+            return ''
+        examples = [
+            self.build_example_prompt(
+                {key: value[i] for key, value in few_shot_examples.items()}, True
+            )
+            for i in range(len(few_shot_examples['question']))
+        ]
+        return '\n'.join(examples) + '\n'
+
+    def build_prompt(self, data):
+        return self.build_fewshot_prefix() + self.build_example_prompt(data, False)
 
 
 @register_evaluator('gsm8k')
@@ -165,22 +167,24 @@ class Hellaswag(BaseEvaluator):
     def set_fewshot_dataset(self, dataset):
         self.few_shot_data = None
 
-    def build_prompt(self, data):
+    def build_candidates(self, data):
         assert self.num_shot == 0, 'Hellaswag does not support few-shot learning.'
         question = data['ctx']
         choices = data['endings']
-        prompt = [question + ' ' + choice for choice in choices]
-        return prompt
+        return [(question, ' ' + choice) for choice in choices]
+
+    def build_prompt(self, data):
+        return [context + continuation for context, continuation in self.build_candidates(data)]
 
     def preproccess(self, data):
-        prompts = self.build_prompt(data)
-        inputs = [self.processor(prompt, return_tensors='pt').to(self.device) for prompt in prompts]
+        candidates = self.build_candidates(data)
+        inputs = self.tokenize_candidates(candidates)
         answers = self.get_answer(data)
 
         return {
             "inputs": inputs,
             "answers": answers,
-            "prompts": prompts,
+            "prompts": [context + continuation for context, continuation in candidates],
         }
 
 @register_evaluator('winogrande')
@@ -211,22 +215,27 @@ class Winogrande(BaseEvaluator):
     def set_fewshot_dataset(self, dataset):
         self.few_shot_data = None
 
-    def build_prompt(self, data):
+    def build_candidates(self, data):
         assert self.num_shot == 0, 'Winogrande does not support few-shot learning.'
         question = data['sentence']
         choices = [data[key] for key in ('option1', 'option2')]
-        prompt = [question.replace('_', can) for can in choices]
-        return prompt
+        # Partial scoring: each option fills the blank in the context and the rest of the
+        # sentence is the shared continuation.
+        blank = question.index('_')
+        return [(question[:blank] + can, question[blank + 1:]) for can in choices]
+
+    def build_prompt(self, data):
+        return [context + continuation for context, continuation in self.build_candidates(data)]
 
     def preproccess(self, data):
-        prompts = self.build_prompt(data)
-        inputs = [self.processor(prompt, return_tensors='pt').to(self.device) for prompt in prompts]
+        candidates = self.build_candidates(data)
+        inputs = self.tokenize_candidates(candidates)
         answers = self.get_answer(data)
 
         return {
             "inputs": inputs,
             "answers": answers,
-            "prompts": prompts,
+            "prompts": [context + continuation for context, continuation in candidates],
         }
 
 @register_evaluator("mme")
@@ -290,6 +299,12 @@ class MME(BaseEvaluator):
             'id': data['id'],
         }
 
+    def accumulate_record(self, record: Dict[str, Any]) -> None:
+        super().accumulate_record(record)
+        self.task2details.setdefault(record['task'], []).append(
+            {'id': record['id'], 'is_correct': record['is_correct']}
+        )
+
     def eval_instance(self, instance: Dict[str, Any]) -> Dict[str, Any]:
         details, correction = [], []
         preds, infos = self.predict(instance)
@@ -22,6 +22,7 @@ def main() -> None:
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the input order with --shuffle.')
     parser.add_argument('--base-url', type=str, default=None)
     parser.add_argument('--openai-api-key', type=str, nargs='+')
     parser.add_argument('--openai-api-key-file', type=Path, default=None)
@@ -35,16 +36,30 @@ def main() -> None:
     )
     parser.add_argument('--input-file', type=Path, required=True)
     parser.add_argument('--cache-dir', type=Path, default=Path('./cache'))
+    parser.add_argument('--cache-ttl', type=float, default=None, help='Expire cached responses after this many seconds.')
+    parser.add_argument('--cache-max-entries', type=int, default=None, help='Keep at most this many cached responses.')
     parser.add_argument('--num-cpus', type=int, default=max(os.cpu_count() - 4, 4))
     parser.add_argument('--num-workers', type=int, default=max(2 * (os.cpu_count() - 4) // 3, 4))
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['pool', 'ray'],
+        default='pool',
+        help='Send requests from a thread pool sharing HTTP connections, or from Ray tasks.',
+    )
     parser.add_argument('--type', type=str, default="image-recognition")
     parser.add_argument('--platform',  type=str, default="openai")
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue the jsonl outputs of an interrupted run of the pool backend.',
+    )
 
     args = parser.parse_args()
     print(f"Type: {args.type}")
     
-    if args.num_workers >= args.num_cpus:
+    if args.backend == 'ray' and args.num_workers >= args.num_cpus:
         raise ValueError('num_workers should be less than num_cpus')
 
     if args.debug:
@@ -58,12 +73,18 @@ def main() -> None:
             f.write('*\n')
 
     input_file = args.input_file.expanduser().absolute()
-    inputs = prepare_inputs(input_file, shuffle=args.shuffle, platform=args.platform, type=args.type)
-
     openai_api_keys = get_openai_api_keys(args.openai_api_key, args.openai_api_key_file)
 
     print(len(openai_api_keys), args.num_cpus)
     print(openai_api_keys)
+    if args.backend == 'pool':
+        stream_results(args, input_file, cache_dir, openai_api_keys)
+        return
+
+    inputs = prepare_inputs(
+        input_file, shuffle=args.shuffle, platform=args.platform, type=args.type, seed=args.seed,
+    )
+
     ray.init()
     results = batch_request_openai(
         type=args.type,
@@ -73,6 +94,8 @@ def main() -> None:
         base_url=args.base_url,
         num_workers=args.num_workers,
         cache_dir=cache_dir,
+        cache_ttl=args.cache_ttl,
+        cache_max_entries=args.cache_max_entries,
     )
     processed_results = []
     raw_results = []
@@ -90,5 +113,42 @@ def main() -> None:
     output_file = input_file.with_suffix('.'+args.type+'_re_debug.json')
     output_file.write_text(json.dumps(raw_results, indent=2, ensure_ascii=False))
 
+def stream_results(args: argparse.Namespace, input_file: Path, cache_dir: Path, openai_api_keys: list[str]) -> None:
+    """Write every result to jsonl in input order as soon as it and all earlier ones are done."""
+    output_file = input_file.with_suffix('.'+args.type+'_re_output.jsonl')
+    debug_file = input_file.with_suffix('.'+args.type+'_re_debug.jsonl')
+
+    skip = 0
+    if args.resume:
+        # The two files are written one after the other, so an interruption can
+        # leave one a line ahead; cut both back to the results they share.
+        skip = min(count_lines(output_file), count_lines(debug_file))
+        truncate_lines(output_file, skip)
+        truncate_lines(debug_file, skip)
+        print(f'Resuming after {skip} completed results')
+    if args.shuffle:
+        # The order is seeded, so a resumed run skips the same inputs it wrote.
+        inputs = iter_shuffled_inputs(input_file, type=args.type, seed=args.seed, skip=skip)
+    else:
+        inputs = iter_inputs(input_file, type=args.type, skip=skip)
+
+    mode = 'at' if args.resume else 'wt'
+    with output_file.open(mode=mode, encoding='utf-8') as fout, debug_file.open(mode=mode, encoding='utf-8') as fdebug:
+        for _, result in stream_request_openai_pooled(
+            type=args.type,
+            inputs=inputs,
+            openai_api_keys=openai_api_keys,
+            openai_models=args.openai_chat_completion_models,
+            base_url=args.base_url,
+            num_workers=args.num_workers,
+            cache_dir=cache_dir,
+            cache_ttl=args.cache_ttl,
+            cache_max_entries=args.cache_max_entries,
+        ):
+            fdebug.write(json.dumps(result, ensure_ascii=False) + '\n')
+            fout.write(json.dumps(post_process(result, args.type), ensure_ascii=False) + '\n')
+            fdebug.flush()
+            fout.flush()
+
 if __name__ == '__main__':
     main()
@@ -21,10 +21,12 @@ import logging
 import os
 import random
 import re
+import threading
 import time
-from collections import deque
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any, Callable, Union
+from typing import Any, Callable, Iterable, Iterator, Union
 
 import openai
 import ray
@@ -37,6 +39,8 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from web_utils import *
 
+from align_anything.evaluation.judge_cache import JudgeCache
+
 from config.system_prompt import SAFETY_SCORE_SYSTEM_PROMPT,SAFETY_SCORE_USER_PROMPT
 from config.system_prompt import UTILITY_SCORE_SYSTEM_PROMPT,UTILITY_SCORE_USER_PROMPT
 from config.system_prompt import HELPFUL_SCORE_SYSTEM_PROMPT,HELPFUL_SCORE_USER_PROMPT
@@ -149,42 +153,12 @@ def post_process(response, type: str):
 
 
 
-@ray.remote(num_cpus=1)
-def request_openai(
-    id: int,
-    type: str,
-    input: dict[str, str],
-    openai_api_keys: list[(str, str)],
-    openai_model: str,
-    base_url: str | None = None,
-    cache_dir: Path | str | None = None,
-) -> list[dict[str, object]]:
-    openai_api_keys = itertools.cycle(openai_api_keys)
-    openai_api_keys = next(openai_api_keys)
-    
-    openai_api_key = openai_api_keys[0]
-    if cache_dir is not None:
-        cache_dir = Path(cache_dir).expanduser().absolute()
-        cache_dir.mkdir(parents=True, exist_ok=True)
-
+def build_messages(type: str, input: dict[str, Any]) -> list[dict[str, Any]]:
     system_prompt = input['system_prompt']
     user_prompt = input['user_prompt']
-    sha256 = hashlib.sha256((system_prompt + user_prompt).encode('utf-8')).hexdigest()
-
-    if cache_dir is not None:
-        output_file = cache_dir / f'{sha256}.json'
-        if output_file.exists():
-            with output_file.open(mode='rt', encoding='utf-8') as f:
-                try:
-                    return id, json.load(f)
-                except json.JSONDecodeError:
-                    output_file = None
-    else:
-        output_file = None
-
     if (type == "image-recognition"):
         image_url = input['transformed_input']['image_url']
-        messages = [
+        return [
         {'role': 'system', 'content': system_prompt},
         {'role': 'user', 
          'content': [
@@ -201,33 +175,87 @@ def request_openai(
          ]
         },
       ]
-        
-    else:
-        
-        messages = [
+
+    return [
         {'role': 'system', 'content': system_prompt},
         {'role': 'user', 'content': user_prompt},
     ]
-    
+
+
+def open_judge_cache(
+    cache_dir: Path | str | None,
+    cache_ttl: float | None = None,
+    cache_max_entries: int | None = None,
+) -> JudgeCache | None:
+    if cache_dir is None:
+        return None
+    cache_dir = Path(cache_dir).expanduser().absolute()
+    return JudgeCache(str(cache_dir / 'judge_cache.sqlite'), ttl=cache_ttl, max_entries=cache_max_entries)
+
+
+def request_openai_cached(
+    id: int,
+    type: str,
+    input: dict[str, str],
+    openai_api_key: str,
+    openai_model: str,
+    base_url: str | None = None,
+    cache: JudgeCache | None = None,
+    client: openai.OpenAI | None = None,
+    on_error: Callable[[Exception], None] | None = None,
+) -> tuple[int, dict[str, object]]:
+    messages = build_messages(type, input)
+    key = JudgeCache.make_key(
+        openai_model, messages, temperature=DEFAULT_TEMPERATURE, max_tokens=DEFAULT_MAX_TOKENS,
+    )
+
     result = input.copy()
-    
-    result.update(
-        request_openai_noexcept(
+    response = cache.get(key) if cache is not None else None
+    result['cache_hit'] = response is not None
+    if response is None:
+        response = request_openai_noexcept(
             messages=messages,
             openai_api_keys=openai_api_key,
             openai_model=openai_model,
             base_url=base_url,
-        ),
-    )
-    
-    result['sha256'] = sha256
+            client=client,
+            on_error=on_error,
+        )
+        response.pop('messages')
+        if cache is not None and not response['output'].startswith('ERROR:'):
+            cache.put(key, openai_model, response)
 
-    if output_file is not None:
-        with output_file.open(mode='wt', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+    result.update(response)
+    result['messages'] = messages
+    result['sha256'] = key
     return id, result
 
 
+@ray.remote(num_cpus=1)
+def request_openai(
+    id: int,
+    type: str,
+    input: dict[str, str],
+    openai_api_keys: list[(str, str)],
+    openai_model: str,
+    base_url: str | None = None,
+    cache_dir: Path | str | None = None,
+    cache_ttl: float | None = None,
+) -> list[dict[str, object]]:
+    openai_api_keys = itertools.cycle(openai_api_keys)
+    openai_api_keys = next(openai_api_keys)
+    
+    openai_api_key = openai_api_keys[0]
+    cache = open_judge_cache(cache_dir, cache_ttl)
+    try:
+        return request_openai_cached(
+            id, type, input, openai_api_key, openai_model, base_url=base_url, cache=cache,
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+
+
 def batch_request_openai(
     type: str,
     inputs: list[dict[str, Any]],
@@ -236,6 +264,8 @@ def batch_request_openai(
     base_url: str | None = None,
     num_workers: int = 8,
     cache_dir: Path | str | None = None,
+    cache_ttl: float | None = None,
+    cache_max_entries: int | None = None,
 ) -> list[dict[str, object]]:
     openai_api_keys = sorted(set(openai_api_keys))
     openai_models = sorted(set(openai_models))
@@ -263,6 +293,7 @@ def batch_request_openai(
                         openai_model=random.choice(openai_models),  
                         base_url=base_url,
                         cache_dir=cache_dir,
+                        cache_ttl=cache_ttl,
                     ),
                 )
                 
@@ -272,9 +303,166 @@ def batch_request_openai(
                 results[idx] = result
             pbar.update(len(ready))
 
+    num_hits = sum(result['cache_hit'] for result in results)
+    print(f'Judge cache: {num_hits} hits out of {len(results)} requests')
+    cache = open_judge_cache(cache_dir, cache_ttl, cache_max_entries)
+    if cache is not None:
+        cache.evict()
+        cache.close()
     return results
 
 
+class RequestStats:
+    """Thread-safe throughput, latency and error statistics of a batch of requests."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.latencies = []
+        self.num_cache_hits = 0
+        self.errors = Counter()
+
+    def add_request(self, latency: float, cache_hit: bool, output: str) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_cache_hits += int(cache_hit)
+            if output.startswith('ERROR:'):
+                self.errors[output] += 1
+
+    def add_error(self, error: Exception) -> None:
+        with self.lock:
+            self.errors[type(error).__name__] += 1
+
+    def summary(self) -> dict[str, Any]:
+        elapsed = time.perf_counter() - self.start_time
+        latencies = sorted(self.latencies)
+
+        def percentile(q: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        return {
+            'num_requests': len(latencies),
+            'num_cache_hits': self.num_cache_hits,
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'latency_p50': percentile(0.50),
+            'latency_p90': percentile(0.90),
+            'latency_p99': percentile(0.99),
+            'errors': dict(self.errors),
+        }
+
+
+def stream_request_openai_pooled(
+    type: str,
+    inputs: Iterable[dict[str, Any]],
+    openai_api_keys: list[str],
+    openai_models: list[str],
+    base_url: str | None = None,
+    num_workers: int = 8,
+    cache_dir: Path | str | None = None,
+    cache_ttl: float | None = None,
+    cache_max_entries: int | None = None,
+    max_pending: int | None = None,
+) -> Iterator[tuple[int, dict[str, object]]]:
+    """Request the inputs in a thread pool sharing one keep-alive client per key.
+
+    Inputs are consumed lazily and results are yielded in input order through a reorder buffer.
+    At most `max_pending` inputs are in flight or buffered, so memory does not grow with the input.
+    """
+    openai_api_keys = sorted(set(openai_api_keys))
+    openai_models = sorted(set(openai_models))
+    if max_pending is None:
+        max_pending = 4 * num_workers
+    max_pending = max(1, max_pending)
+    clients = [
+        openai.OpenAI(api_key=key[0] if isinstance(key, tuple) else key, base_url=base_url)
+        for key in openai_api_keys
+    ]
+    cache = open_judge_cache(cache_dir, cache_ttl, cache_max_entries)
+    stats = RequestStats()
+
+    def request(idx: int, input: dict[str, Any]) -> tuple[int, dict[str, object]]:
+        start = time.perf_counter()
+        # Rotate over the keys in input order, as the Ray backend does.
+        key = openai_api_keys[idx % len(openai_api_keys)]
+        _, result = request_openai_cached(
+            idx,
+            type,
+            input,
+            key[0] if isinstance(key, tuple) else key,
+            random.choice(openai_models),
+            base_url=base_url,
+            cache=cache,
+            client=clients[idx % len(clients)],
+            on_error=stats.add_error,
+        )
+        stats.add_request(time.perf_counter() - start, result['cache_hit'], result['output'])
+        return idx, result
+
+    inputs = enumerate(inputs)
+    pending, reorder_buffer = set(), {}
+    next_idx, exhausted = 0, False
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor, tqdm.tqdm() as pbar:
+            while not exhausted or pending or reorder_buffer:
+                while not exhausted and len(pending) + len(reorder_buffer) < max_pending:
+                    try:
+                        idx, input = next(inputs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(request, idx, input))
+
+                if pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        idx, result = future.result()
+                        reorder_buffer[idx] = result
+                        pbar.update(1)
+
+                while next_idx in reorder_buffer:
+                    yield next_idx, reorder_buffer.pop(next_idx)
+                    next_idx += 1
+    finally:
+        for client in clients:
+            client.close()
+        if cache is not None:
+            cache.evict()
+            cache.close()
+        print(f'Request stats: {json.dumps(stats.summary(), indent=2)}')
+
+
+def batch_request_openai_pooled(
+    type: str,
+    inputs: list[dict[str, Any]],
+    openai_api_keys: list[str],
+    openai_models: list[str],
+    base_url: str | None = None,
+    num_workers: int = 8,
+    cache_dir: Path | str | None = None,
+    cache_ttl: float | None = None,
+    cache_max_entries: int | None = None,
+) -> list[dict[str, object]]:
+    """Same as `batch_request_openai`, in a thread pool sharing one keep-alive client per key."""
+    return [
+        result
+        for _, result in stream_request_openai_pooled(
+            type,
+            inputs,
+            openai_api_keys,
+            openai_models,
+            base_url=base_url,
+            num_workers=num_workers,
+            cache_dir=cache_dir,
+            cache_ttl=cache_ttl,
+            cache_max_entries=cache_max_entries,
+            max_pending=len(inputs),
+        )
+    ]
+
+
 def get_openai_api_keys(
     openai_api_keys: list[str],
     openai_api_key_file: Path | str | None,
@@ -414,32 +602,86 @@ def transform_data(data, type):
     new_data['order'] = order
     return new_data, order
 
-def prepare_inputs(input_file: Path | str, shuffle: bool = False, type: str = "image-recognition", platform : str = "openai") -> list[Any]:
-    input_file = Path(input_file).expanduser().absolute()
-
+def make_input(raw_input: dict[str, Any], input_file: Path, type: str) -> dict[str, Any]:
+    data, order = transform_data(raw_input, type)
+    system_prompt, user_prompt = get_annotator_response_b_prompt(data, type)
+    return {
+        'system_prompt': system_prompt,
+        'user_prompt': user_prompt,
+        'transformed_input': data,
+        'input_file': str(input_file),
+        'order': order
+    }
+
+def iter_raw_inputs(input_file: Path) -> Iterator[dict[str, Any]]:
     if input_file.suffix.lower() == '.json':
         with input_file.open(mode='rt', encoding='utf-8') as f:
-            raw_inputs = json.load(f)
+            yield from json.load(f)
     elif input_file.suffix.lower() == '.jsonl':
         with input_file.open(mode='rt', encoding='utf-8') as f:
-            raw_inputs = [json.loads(line) for line in f]
-
-    inputs = []
-    i=0
-    for raw_input in raw_inputs:
-        data, order = transform_data(raw_input, type)
-        system_prompt, user_prompt = get_annotator_response_b_prompt(data, type)
-        inputs.append(
-                {
-                    'system_prompt': system_prompt,
-                    'user_prompt': user_prompt,
-                    'transformed_input': data,
-                    'input_file': str(input_file),
-                    'order': order
-                },
-            )
-        i+=1
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
 
+def iter_inputs(input_file: Path | str, type: str = "image-recognition", skip: int = 0) -> Iterator[dict[str, Any]]:
+    """Lazily read the input file and build each prompt only when it is requested."""
+    input_file = Path(input_file).expanduser().absolute()
+    for i, raw_input in enumerate(iter_raw_inputs(input_file)):
+        if i >= skip:
+            yield make_input(raw_input, input_file, type)
+
+def iter_shuffled_inputs(input_file: Path | str, type: str = "image-recognition", seed: int = 0, skip: int = 0) -> Iterator[dict[str, Any]]:
+    """Like `iter_inputs`, but in the seeded order of `prepare_inputs(shuffle=True)`.
+
+    Only the byte offsets of the jsonl lines are shuffled and kept in memory, each line is read
+    and its prompt built when it is requested. A json file has to be loaded whole, but its
+    prompts are still built lazily.
+    """
+    input_file = Path(input_file).expanduser().absolute()
+    rng = random.Random(seed)
+    if input_file.suffix.lower() == '.jsonl':
+        offsets = []
+        with input_file.open(mode='rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+        rng.shuffle(offsets)
+        with input_file.open(mode='rb') as f:
+            for offset in offsets[skip:]:
+                f.seek(offset)
+                yield make_input(json.loads(f.readline()), input_file, type)
+    else:
+        raw_inputs = list(iter_raw_inputs(input_file))
+        indices = list(range(len(raw_inputs)))
+        rng.shuffle(indices)
+        for index in indices[skip:]:
+            yield make_input(raw_inputs[index], input_file, type)
+
+def prepare_inputs(input_file: Path | str, shuffle: bool = False, type: str = "image-recognition", platform : str = "openai", seed: int = 0) -> list[Any]:
+    inputs = list(iter_inputs(input_file, type))
     if shuffle:
-        random.shuffle(inputs)
-    return inputs
\ No newline at end of file
+        # Use a private generator: building the prompts reseeds the global one.
+        random.Random(seed).shuffle(inputs)
+    return inputs
+
+def count_lines(file: Path) -> int:
+    """Count the complete lines; a line cut off by an interrupted write is not a result."""
+    if not file.exists():
+        return 0
+    with file.open(mode='rb') as f:
+        return sum(1 for line in f if line.endswith(b'\n'))
+
+def truncate_lines(file: Path, num_lines: int) -> None:
+    """Keep only the first `num_lines` lines of the file, dropping any partial last line."""
+    if not file.exists():
+        return
+    with file.open(mode='r+b') as f:
+        offset = 0
+        for _ in range(num_lines):
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+        f.truncate(offset)
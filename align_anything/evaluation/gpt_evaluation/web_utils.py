@@ -37,26 +37,34 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+DEFAULT_MAX_TOKENS = 8192
+DEFAULT_TEMPERATURE = 0.05
+
 def request_openai_noexcept(
     messages: list[dict[str, str]],
     openai_api_keys: str,
     openai_model: str,
     base_url: str | None = None,
+    client: openai.OpenAI | None = None,
+    on_error: Callable[[Exception], None] | None = None,
 ) -> list[dict[str, object]]:
     output = None
     hit_rate_limit = 0
     while True:
-        client = openai.OpenAI(api_key=openai_api_keys, base_url=base_url)
+        if client is None:
+            client = openai.OpenAI(api_key=openai_api_keys, base_url=base_url)
         try:
             output = client.chat.completions.create(
                 messages=messages,
                 model=openai_model,
-                max_tokens=8192,
-                temperature=0.05,
+                max_tokens=DEFAULT_MAX_TOKENS,
+                temperature=DEFAULT_TEMPERATURE,
             )
             break
         except openai.OpenAIError as e:
             logging.error(e)
+            if on_error is not None:
+                on_error(e)
             if 'maximum context length' in str(e).lower():
                 return {
                     'messages': messages,
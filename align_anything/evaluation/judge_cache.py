@@ -0,0 +1,122 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+
+def _hash_image_urls(content: Any) -> Any:
+    # Image payloads are inlined as base64 data urls, only their digest goes into the key.
+    if isinstance(content, list):
+        return [_hash_image_urls(item) for item in content]
+    if isinstance(content, dict):
+        if content.get('type') == 'image_url':
+            url = content['image_url']['url'] if isinstance(content['image_url'], dict) else content['image_url']
+            return {'type': 'image_url', 'sha256': hashlib.sha256(url.encode('utf-8')).hexdigest()}
+        return {key: _hash_image_urls(value) for key, value in content.items()}
+    return content
+
+
+class JudgeCache:
+    """Content-addressed cache of judge responses backed by a single SQLite file.
+
+    The key covers the judge model, the full messages (images by digest) and the sampling
+    parameters. Entries older than `ttl` seconds expire, and the least recently used entries
+    are evicted beyond `max_entries`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        timeout: float = 600.0,
+    ) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, accessed REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, Any]], **sampling_params: Any) -> str:
+        payload = {
+            'model': model,
+            'messages': _hash_image_urls(messages),
+            'sampling_params': sampling_params,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT response, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, response: Any) -> None:
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, model, json.dumps(response, ensure_ascii=False), now, now),
+            )
+            self.connection.commit()
+
+    def evict(self) -> None:
+        with self.lock:
+            if self.ttl is not None:
+                self.connection.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+            if self.max_entries is not None:
+                self.connection.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (int(self.max_entries),),
+                )
+            self.connection.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
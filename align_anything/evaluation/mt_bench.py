@@ -18,6 +18,7 @@
 # ==============================================================================
 
 import argparse
+import asyncio
 import os
 import json
 import glob
@@ -26,17 +27,49 @@ import random
 import shortuuid
 import numpy as np
 from tqdm import tqdm
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 
 import torch
 
 import deepspeed
+from transformers import LogitsProcessor, LogitsProcessorList, TopKLogitsWarper, TopPLogitsWarper
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
 from align_anything.models.pretrained_model import load_pretrained_models
-from align_anything.evaluation.utils import load_jsonl, make_judge, make_match, play_a_match
+from align_anything.evaluation.judge_cache import JudgeCache
+from align_anything.evaluation.utils import AsyncJudgeClient, load_jsonl, make_judge, make_match, play_matches_async
 from align_anything.evaluation.evaluator_registry import register_evaluator
 from align_anything.evaluation.dis_utils import *
+from align_anything.utils.speculative_decoding import SpeculativeDecoder, split_speculative_config
+
+class SeededSamplingLogitsProcessor(LogitsProcessor):
+    """Sample each row with its own generator and force greedy decoding to pick that token.
+
+    This makes the sampled answer of a row independent of the other rows in the batch. The
+    `warpers` filter the scaled scores before sampling, like the top-k / top-p warpers of
+    `do_sample=True` generation.
+    """
+
+    def __init__(
+        self,
+        temperature: float,
+        generators: List[torch.Generator],
+        warpers: Optional[LogitsProcessorList] = None,
+    ) -> None:
+        self.temperature = temperature
+        self.generators = generators
+        self.warpers = warpers if warpers is not None else LogitsProcessorList()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        scores = self.warpers(input_ids, scores.float() / self.temperature)
+        probs = torch.softmax(scores, dim=-1)
+        tokens = torch.cat([
+            torch.multinomial(probs[i], num_samples=1, generator=generator)
+            for i, generator in enumerate(self.generators)
+        ])
+        forced = torch.full_like(scores, float('-inf'))
+        return forced.scatter_(-1, tokens.unsqueeze(-1), 0.0)
+
 
 @register_evaluator("mt_bench")
 class MTBench:
@@ -59,6 +92,8 @@ class MTBench:
         self.model_id = self.model_cfgs.model_id
         self.temperature = self.eval_cfgs.temperature if self.eval_cfgs.temperature else 0.7
         self.seed = self.eval_cfgs.seed if self.eval_cfgs.seed else 3407
+        self.batch_size = self.eval_cfgs.batch_size if self.eval_cfgs.batch_size else 16
+        _, self.speculative_config = split_speculative_config(self.eval_cfgs.generate_config)
         self.judge_model = self.eval_cfgs.judge_model
 
         self.questions_file = f"{self.data_cfgs.task_dir}/{self.data_cfgs.task}/question.jsonl"
@@ -81,7 +116,17 @@ class MTBench:
             auto_device_mapping=True,
             trust_remote_code=self.model_cfgs.trust_remote_code,
         )
+        # Batched generation pads on the left, so the prompts of a batch all end at the last
+        # position and the new tokens follow them directly.
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model.eval()
+        self.speculator = SpeculativeDecoder(
+            self.model,
+            **self.speculative_config,
+            trust_remote_code=self.model_cfgs.trust_remote_code,
+        )
 
     def load_dataset(self):
         self.questions = load_jsonl(self.questions_file)
@@ -131,60 +176,127 @@ class MTBench:
             prompt +=  f"USER: {last_message.get('content', '')} ASSISTANT:"
         return prompt
 
-    def generate_answers(self):
+    def sampling_warpers(self) -> LogitsProcessorList:
+        """Build the top-k / top-p warpers that `do_sample=True` takes from the generation config."""
+        generation_config = self.model.generation_config
+        top_k = generation_config.top_k if generation_config.top_k is not None else 50
+        top_p = generation_config.top_p if generation_config.top_p is not None else 1.0
+        warpers = LogitsProcessorList()
+        if top_k > 0:
+            warpers.append(TopKLogitsWarper(top_k=top_k))
+        if top_p < 1.0:
+            warpers.append(TopPLogitsWarper(top_p=top_p))
+        return warpers
+
+    def write_answer(self, question_obj: Dict[str, Any], choices: List[Dict[str, Any]]) -> None:
+        with open(os.path.expanduser(self.answers_file), "a") as fout:
+            answer_json = {
+                "question_id": question_obj["question_id"],
+                "answer_id": shortuuid.uuid(),
+                "model_id": self.model_id,
+                "choices": sorted(choices, key=lambda choice: choice["index"]),
+                "tstamp": time.time(),
+            }
+            fout.write(json.dumps(answer_json) + "\n")
 
-        for question_obj in tqdm(self.questions):
-            if question_obj["category"] in self.temperature_config:
-                self.temperature = self.temperature_config[question_obj["category"]]
-            choices = []
-            conversations = []
+    def generate_answers(self):
+        # The logits are produced by the output embeddings, which may sit on another device than
+        # the input embeddings when the model is split over several devices.
+        logits_device = self.model.get_output_embeddings().weight.device
+        # One state per (question, choice), each with its own generator seeded as `seed + choice`.
+        states = []
+        pending_choices = {}
+        finished_choices = {}
+        for question_obj in self.questions:
+            pending_choices[question_obj["question_id"]] = self.eval_cfgs.num_choices
+            finished_choices[question_obj["question_id"]] = []
             for i in range(self.eval_cfgs.num_choices):
-                torch.manual_seed(i+self.seed)
-                turns = []
-                for j in range(len(question_obj["turns"])):
-                    question = question_obj["turns"][j]
-                    messages = self.format_messages(
-                        question,
-                        conversations,
+                generator = torch.Generator(device=logits_device)
+                generator.manual_seed(i + self.seed)
+                states.append({
+                    'question': question_obj,
+                    'index': i,
+                    'temperature': self.temperature_config.get(question_obj["category"], self.temperature),
+                    'generator': generator,
+                    'conversations': [],
+                    'turns': [],
+                })
+
+        # Turn `j` of every question only depends on its earlier turns, so each turn is a
+        # batched pass over all questions, bucketed by sampling temperature.
+        num_turns = max(len(question_obj["turns"]) for question_obj in self.questions)
+        for j in range(num_turns):
+            buckets = {}
+            for state in states:
+                if j < len(state['question']["turns"]):
+                    buckets.setdefault(state['temperature'], []).append(state)
+
+            for temperature, bucket in sorted(buckets.items()):
+                prompts = {}
+                for state in bucket:
+                    messages = self.format_messages(state['question']["turns"][j], state['conversations'])
+                    prompts[id(state)] = self.message_to_prompt(messages)
+                bucket.sort(key=lambda state: len(prompts[id(state)]))
+
+                for start in tqdm(range(0, len(bucket), self.batch_size), desc=f"Turn {j + 1}, temperature {temperature}"):
+                    batch = bucket[start:start + self.batch_size]
+                    outputs = self.generation(
+                        [prompts[id(state)] for state in batch],
+                        temperature,
+                        [state['generator'] for state in batch],
                     )
-
-                    prompt = self.message_to_prompt(messages)
-
-                    output = self.generation(prompt)
-                    turns.append(output)
-                    conversations.append({
-                        "input": question,
-                        "output": output,
-                    })
-
-                choices.append({"index": i, "turns": turns})
-
-            with open(os.path.expanduser(self.answers_file), "a") as fout:
-                answer_json = {
-                    "question_id": question_obj["question_id"],
-                    "answer_id": shortuuid.uuid(),
-                    "model_id": self.model_id,
-                    "choices": choices,
-                    "tstamp": time.time(),
-                }
-                fout.write(json.dumps(answer_json) + "\n")
+                    for state, output in zip(batch, outputs):
+                        state['turns'].append(output)
+                        state['conversations'].append({
+                            "input": state['question']["turns"][j],
+                            "output": output,
+                        })
+                        if len(state['turns']) < len(state['question']["turns"]):
+                            continue
+                        # Write a question out as soon as all of its choices are answered
+                        question_id = state['question']["question_id"]
+                        finished_choices[question_id].append(
+                            {"index": state['index'], "turns": state['turns']}
+                        )
+                        pending_choices[question_id] -= 1
+                        if pending_choices[question_id] == 0:
+                            self.write_answer(state['question'], finished_choices.pop(question_id))
+
+        if self.speculator.enabled:
+            stats = self.speculator.stats.summary()
+            print(f"Speculative decoding: {stats}")
+            with open(f"{self.answers_dir}/{self.model_id}_speculative_decoding.json", "w") as fout:
+                json.dump(stats, fout, indent=4)
 
     @torch.no_grad()
-    def generation(self, prompt: str)->str:
-        return self._generate(prompt)
-
-    def _generate(self, prompt: str)->str:
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-        output_ids = self.model.generate(
+    def generation(self, prompts: List[str], temperature: float, generators: List[torch.Generator]) -> List[str]:
+        return self._generate(prompts, temperature, generators)
+
+    def _generate(self, prompts: List[str], temperature: float, generators: List[torch.Generator]) -> List[str]:
+        # Assisted generation verifies one sequence at a time.
+        if self.speculator.enabled and len(prompts) > 1:
+            return [
+                output
+                for prompt, generator in zip(prompts, generators)
+                for output in self._generate([prompt], temperature, [generator])
+            ]
+
+        inputs = self.tokenizer(prompts, padding=True, return_tensors="pt").to(self.model.device)
+        logits_processor = LogitsProcessorList()
+        if temperature > 0:
+            logits_processor.append(
+                SeededSamplingLogitsProcessor(temperature, generators, self.sampling_warpers())
+            )
+        output_ids = self.speculator.generate(
+            self.model,
             **inputs,
-            do_sample=self.temperature > 0,
-            temperature=self.temperature,
+            do_sample=False,
+            logits_processor=logits_processor,
             max_new_tokens=self.model_cfgs.max_new_token,
             pad_token_id=self.tokenizer.eos_token_id,
         )[:, inputs['input_ids'].shape[1]:]
 
-        output = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0]
-        return output
+        return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
 
     def generate_judgements(self):
         # Load answers
@@ -227,11 +339,21 @@ class MTBench:
             multi_turn=True,
         )
 
-        results = []
         output_file_path = os.path.join(self.output_dir, f"{self.judge_model}.jsonl")
-        for match in tqdm(matches):
-            result = play_a_match(match, output_file=output_file_path)
-            results.append(result)
+        judge_cache = None
+        if self.eval_cfgs.judge_cache is None or self.eval_cfgs.judge_cache:
+            judge_cache = JudgeCache(
+                os.path.join(self.eval_cfgs.output_dir, ".cache", "judge_cache.sqlite"),
+                ttl=self.eval_cfgs.judge_cache_ttl,
+                max_entries=self.eval_cfgs.judge_cache_max_entries,
+            )
+        judge_client = AsyncJudgeClient(
+            base_url=self.eval_cfgs.judge_base_url,
+            max_concurrency=int(self.eval_cfgs.judge_concurrency or 32),
+            requests_per_minute=self.eval_cfgs.judge_requests_per_minute,
+            cache=judge_cache,
+        )
+        results = asyncio.run(play_matches_async(matches, judge_client, output_file=output_file_path))
 
         score = {}
         score['avg'] = []
@@ -0,0 +1,112 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import os
+import glob
+import json
+import hashlib
+import sqlite3
+from typing import Any, Dict, List, Sequence
+
+
+WEIGHT_FILE_SUFFIXES = ('.safetensors', '.bin', '.pt', '.pth', '.json', '.model')
+
+
+def hash_object(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def model_fingerprint(model_name_or_path: str, config: Any = None) -> str:
+    """Identify a checkpoint by its local files, or by the hub revision for remote models."""
+    path = os.path.expanduser(model_name_or_path)
+    if os.path.isdir(path):
+        files = []
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(WEIGHT_FILE_SUFFIXES):
+                continue
+            stat = os.stat(os.path.join(path, name))
+            files.append((name, stat.st_size, int(stat.st_mtime)))
+        return hash_object([os.path.abspath(path), files])
+    return hash_object([model_name_or_path, getattr(config, '_commit_hash', None)])
+
+
+class ResultCache:
+    """Instance-level evaluation results keyed by everything that determines the result.
+
+    Every rank appends to its own SQLite file `<prefix>.rank<rank>.sqlite`, so a file never has
+    two writers and the store does not rely on file locking, which network filesystems do not
+    implement reliably. Lookups read the files of all ranks, including those left by runs with
+    another world size, and a crashed run keeps every committed instance.
+    """
+
+    def __init__(self, prefix: str, rank: int = 0, timeout: float = 600.0) -> None:
+        self.prefix = prefix
+        self.path = f'{prefix}.rank{rank}.sqlite'
+        self.timeout = timeout
+        self.connection = sqlite3.connect(self.path, timeout=timeout)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, task TEXT, record TEXT)'
+        )
+        self.connection.commit()
+
+    def shard_paths(self) -> List[str]:
+        return sorted(glob.glob(f'{glob.escape(self.prefix)}.rank*.sqlite'))
+
+    @staticmethod
+    def make_key(
+        fingerprint: str,
+        task: str,
+        split: str,
+        index: int,
+        prompt: Any,
+        config: Dict[str, Any],
+    ) -> str:
+        return hash_object([fingerprint, task, split, index, hash_object(prompt), config])
+
+    def get_many(self, keys: Sequence[str], chunk_size: int = 500) -> Dict[str, Dict[str, Any]]:
+        """Look the keys up in the files of all ranks, which must not be written meanwhile."""
+        found = {}
+        for path in self.shard_paths():
+            if os.path.abspath(path) == os.path.abspath(self.path):
+                connection = self.connection
+            else:
+                connection = sqlite3.connect(path, timeout=self.timeout)
+            try:
+                for start in range(0, len(keys), chunk_size):
+                    chunk = list(keys[start:start + chunk_size])
+                    rows = connection.execute(
+                        f'SELECT key, record FROM results WHERE key IN ({",".join("?" * len(chunk))})',
+                        chunk,
+                    )
+                    for key, record in rows:
+                        found[key] = json.loads(record)
+            finally:
+                if connection is not self.connection:
+                    connection.close()
+        return found
+
+    def put_many(self, task: str, items: List[Any]) -> None:
+        """Insert `(key, record)` pairs, replacing stale entries with the same key."""
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO results (key, task, record) VALUES (?, ?, ?)',
+            [(key, task, json.dumps(record, ensure_ascii=False)) for key, record in items],
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
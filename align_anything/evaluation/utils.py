@@ -22,15 +22,21 @@ import re
 import ast
 import json
 import time
+import random
+import asyncio
 import openai
 import dataclasses
 
 from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple, Union, Any
 
+from align_anything.evaluation.judge_cache import JudgeCache
+
 # API setting constants
 API_MAX_RETRY = 16
 API_RETRY_SLEEP = 10
 API_ERROR_OUTPUT = "$ERROR$"
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 60.0
 
 TIE_DELTA = 0.1
 
@@ -96,15 +102,14 @@ def make_match(
         )
     return matches
 
-def run_judge(
+def build_judge_messages(
     question: Dict[str, Any],
     answer: Dict[str, Any],
     judge: Judge,
     ref_answer: Optional[Dict[str, Any]] = None,
     multi_turn: bool = False
-) -> Tuple[int, str, str]:
+) -> Tuple[str, List[Dict[str, str]]]:
     kwargs = {}
-    model = judge.model_name
 
     if ref_answer:
         kwargs["ref_answer_1"] = ref_answer["choices"][0]["turns"][0]
@@ -131,9 +136,9 @@ def run_judge(
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
+    return user_prompt, messages
 
-    judgment = chat_completion_openai(model, messages, temperature=0, max_tokens=2048)
-
+def parse_rating(judge: Judge, judgment: str) -> float:
     rating = -1
     if judge.prompt_template["output_format"] == "[[rating]]":
         match = re.search(one_score_pattern, judgment) or re.search(one_score_pattern_backup, judgment)
@@ -141,14 +146,20 @@ def run_judge(
             rating = ast.literal_eval(match.groups()[0])
     else:
         raise ValueError(f"invalid output format: {judge.prompt_template['output_format']}")
+    return rating
 
-    return rating, user_prompt, judgment
-
-def play_a_match(match: MatchSingle, output_file: Optional[str] = None) -> Dict[str, Any]:
-    score, user_prompt, judgment = run_judge(
-        match.question, match.answer, match.judge, match.ref_answer, multi_turn=match.multi_turn
-    )
+def run_judge(
+    question: Dict[str, Any],
+    answer: Dict[str, Any],
+    judge: Judge,
+    ref_answer: Optional[Dict[str, Any]] = None,
+    multi_turn: bool = False
+) -> Tuple[int, str, str]:
+    user_prompt, messages = build_judge_messages(question, answer, judge, ref_answer, multi_turn)
+    judgment = chat_completion_openai(judge.model_name, messages, temperature=0, max_tokens=2048)
+    return parse_rating(judge, judgment), user_prompt, judgment
 
+def make_match_result(match: MatchSingle, score: float, user_prompt: str, judgment: str) -> Dict[str, Any]:
     result = {
         "question_id": match.question["question_id"],
         "model": match.model,
@@ -164,6 +175,13 @@ def play_a_match(match: MatchSingle, output_file: Optional[str] = None) -> Dict[
         f"question: {result['question_id']}, turn: {result['turn']}, model: {result['model']}, "
         f"score: {result['score']}, judge: {result['judge']}"
     )
+    return result
+
+def play_a_match(match: MatchSingle, output_file: Optional[str] = None) -> Dict[str, Any]:
+    score, user_prompt, judgment = run_judge(
+        match.question, match.answer, match.judge, match.ref_answer, multi_turn=match.multi_turn
+    )
+    result = make_match_result(match, score, user_prompt, judgment)
 
     if output_file:
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
@@ -173,6 +191,159 @@ def play_a_match(match: MatchSingle, output_file: Optional[str] = None) -> Dict[
 
     return result
 
+class KeyRateLimiter:
+    """Space out the requests sent with one API key to at most `requests_per_minute`."""
+
+    def __init__(self, requests_per_minute: Optional[float] = None) -> None:
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.interval == 0.0:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class AsyncJudgeClient:
+    """Asynchronous OpenAI-compatible chat client for judging.
+
+    Requests are bounded by `max_concurrency`, rotated over the API keys, rate limited per key
+    and retried with exponential backoff and full jitter. `base_url` may point to any
+    OpenAI-compatible server, including a local mock. Successful responses are stored in the
+    optional `cache`.
+    """
+
+    def __init__(
+        self,
+        api_keys: Optional[List[str]] = None,
+        base_url: Optional[str] = None,
+        max_concurrency: int = 32,
+        requests_per_minute: Optional[float] = None,
+        max_retries: int = API_MAX_RETRY,
+        timeout: float = 600.0,
+        cache: Optional[JudgeCache] = None,
+    ) -> None:
+        if not api_keys:
+            api_keys = [key for key in os.getenv("OPENAI_API_KEY", "").split(",") if key]
+        if not api_keys:
+            raise ValueError("No OpenAI API key provided, please set OPENAI_API_KEY")
+        base_url = base_url or os.getenv("OPENAI_API_BASE")
+
+        self.clients = [
+            openai.AsyncOpenAI(api_key=key, base_url=base_url, max_retries=0, timeout=timeout)
+            for key in api_keys
+        ]
+        self.limiters = [KeyRateLimiter(requests_per_minute) for _ in api_keys]
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.next_key = 0
+        self.semaphore = None
+        self.cache = cache
+
+    async def chat_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        max_tokens: int,
+    ) -> str:
+        if self.cache is not None:
+            key = JudgeCache.make_key(model, messages, temperature=temperature, max_tokens=max_tokens)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        content = await self._chat_completion(model, messages, temperature, max_tokens)
+        if self.cache is not None and content != API_ERROR_OUTPUT:
+            self.cache.put(key, model, content)
+        return content
+
+    async def _chat_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        max_tokens: int,
+    ) -> str:
+        # The semaphore is bound to the running event loop, so it is created lazily.
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self.semaphore:
+            for attempt in range(self.max_retries):
+                key = self.next_key
+                self.next_key = (self.next_key + 1) % len(self.clients)
+                await self.limiters[key].acquire()
+                try:
+                    response = await self.clients[key].chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        n=1,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                    )
+                    return response.choices[0].message.content
+                except (openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError) as e:
+                    print(f"Exception: {e}")
+                    return API_ERROR_OUTPUT
+                except openai.OpenAIError as e:
+                    print(f"Exception: {e}")
+                    delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)
+                    await asyncio.sleep(random.uniform(0, delay))
+
+        return API_ERROR_OUTPUT
+
+    async def close(self) -> None:
+        for client in self.clients:
+            await client.close()
+        if self.cache is not None:
+            print(f"Judge cache: {self.cache.stats()}")
+            self.cache.evict()
+            self.cache.close()
+
+async def play_matches_async(
+    matches: List[MatchSingle],
+    client: AsyncJudgeClient,
+    output_file: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Judge all matches concurrently, appending the results to `output_file` in input order.
+
+    A result is written as soon as it and every match before it are judged, so the file is
+    ordered like `matches` and an interrupted run keeps a complete prefix.
+    """
+    fout = None
+    if output_file:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        fout = open(output_file, "a")
+    results: List[Optional[Dict[str, Any]]] = [None] * len(matches)
+    num_written = 0
+
+    async def play(index: int, match: MatchSingle) -> Dict[str, Any]:
+        nonlocal num_written
+        user_prompt, messages = build_judge_messages(
+            match.question, match.answer, match.judge, match.ref_answer, multi_turn=match.multi_turn
+        )
+        judgment = await client.chat_completion(match.judge.model_name, messages, temperature=0, max_tokens=2048)
+        result = make_match_result(match, parse_rating(match.judge, judgment), user_prompt, judgment)
+        results[index] = result
+        if fout is not None:
+            while num_written < len(results) and results[num_written] is not None:
+                fout.write(json.dumps(results[num_written]) + "\n")
+                num_written += 1
+            fout.flush()
+        return result
+
+    try:
+        return await asyncio.gather(*(play(index, match) for index, match in enumerate(matches)))
+    finally:
+        if fout is not None:
+            fout.close()
+        await client.close()
+
 def load_jsonl(file_path: str) -> List[Dict[str, Any]]:
     with open(file_path, "r") as f:
         return [json.loads(line) for line in f]
@@ -69,6 +69,27 @@ def parse_arguments() -> argparse.Namespace:
         help='Whether to stream the output.',
         default=False,
     )
+    parser.add_argument(
+        '--template',
+        type=str,
+        default='Dialogue',
+        help='Model template',
+    )
+    parser.add_argument(
+        '--assistant_model_name_or_path',
+        type=str,
+        default=None,
+        help='A draft model sharing the tokenizer, enables speculative decoding.',
+    )
+    parser.add_argument(
+        '--prompt_lookup_num_tokens',
+        type=int,
+        default=None,
+        help=(
+            'Number of tokens drafted from n-grams of the prompt, '
+            'speculative decoding without a draft model.'
+        ),
+    )
     parser.add_argument(
         '--fp16',
         type=str2bool,
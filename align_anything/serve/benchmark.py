@@ -0,0 +1,287 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Load generator comparing the serving engines against the naive `Chatbot` path."""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import math
+import queue
+import random
+import threading
+import time
+from typing import Any
+
+import torch
+
+from align_anything.models.pretrained_model import load_pretrained_models
+from align_anything.serve.chatbot import Chatbot
+from align_anything.serve.engine import ContinuousBatchingEngine, GenerationRequest
+from align_anything.serve.server import BatchScheduler, format_chat_prompt
+from align_anything.utils.template_registry import get_template_class
+
+
+DEFAULT_PROMPTS = [
+    'Write a short poem about the sea.',
+    'Explain the difference between a list and a tuple in Python.',
+    'What are the main causes of climate change?',
+    'Give me three tips for a job interview.',
+    'Summarize the plot of Romeo and Juliet.',
+    'How does a binary search work?',
+    'Describe your ideal weekend.',
+    'Translate "good morning" into French, Spanish and German.',
+]
+
+
+class ChatbotBackend:
+    """Serve requests one at a time with `Chatbot`, like the interactive CLI does."""
+
+    def __init__(self, chatbot: Chatbot) -> None:
+        self.chatbot = chatbot
+        self.queue: queue.Queue[tuple[GenerationRequest, str]] = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: GenerationRequest, text: str) -> None:
+        self.queue.put((request, text))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, text = item
+            self.chatbot.reset()
+            *_, response = self.chatbot.generator(text)
+            request.outputs.put((
+                'done',
+                {
+                    'text': response,
+                    'completion_tokens': self.chatbot.last_stats.num_tokens,
+                },
+            ))
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return math.nan
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100.0 * len(values)) - 1))]
+
+
+def run_load(
+    backend: Any,
+    prompts: list[str],
+    template: Any,
+    eos_token: str,
+    request_rate: float,
+    num_requests: int,
+    max_new_tokens: int,
+    seed: int,
+) -> dict[str, Any]:
+    """Offer `num_requests` requests with Poisson arrivals and measure their latency."""
+    rng = random.Random(seed)
+    latencies: list[float] = []
+    num_tokens = [0]
+    num_errors = [0]
+    lock = threading.Lock()
+
+    def wait(request: GenerationRequest) -> None:
+        kind, result = request.outputs.get()
+        while kind == 'delta':
+            kind, result = request.outputs.get()
+        with lock:
+            latencies.append(time.perf_counter() - request.arrival_time)
+            if kind == 'done':
+                num_tokens[0] += result['completion_tokens']
+            else:
+                num_errors[0] += 1
+
+    waiters = []
+    start = time.perf_counter()
+    arrival = start
+    for i in range(num_requests):
+        if not math.isinf(request_rate):
+            arrival += rng.expovariate(request_rate)
+            time.sleep(max(0.0, arrival - time.perf_counter()))
+        text = prompts[i % len(prompts)]
+        prompt = format_chat_prompt(template, [{'role': 'user', 'content': text}], eos_token)
+        request = GenerationRequest(prompt=prompt, max_new_tokens=max_new_tokens, temperature=0.0)
+        if isinstance(backend, ChatbotBackend):
+            backend.submit(request, text)
+        else:
+            backend.submit(request)
+        waiter = threading.Thread(target=wait, args=(request,), daemon=True)
+        waiter.start()
+        waiters.append(waiter)
+    for waiter in waiters:
+        waiter.join()
+    duration = time.perf_counter() - start
+
+    return {
+        'request_rate': request_rate,
+        'num_requests': num_requests,
+        'num_errors': num_errors[0],
+        'duration': duration,
+        'requests_per_second': num_requests / duration,
+        'tokens_per_second': num_tokens[0] / duration,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+    }
+
+
+def release(loaded: dict[str, Any]) -> None:
+    """Drop the shared model and return the memory of the released backends to the device."""
+    loaded.clear()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def build_backend(args: argparse.Namespace, engine: str, loaded: dict[str, Any]) -> tuple[Any, str]:
+    """Build a serving path, the batching engines share one copy of the model.
+
+    The chatbot loads its own copy, so the shared one must be released before.
+    """
+    if engine == 'chatbot':
+        chatbot = Chatbot(
+            args.model_name_or_path,
+            temperature=0.0,
+            max_length=args.max_new_tokens,
+            template=args.template,
+        )
+        return ChatbotBackend(chatbot), chatbot.tokenizer.eos_token
+
+    if 'model' not in loaded:
+        loaded['model'], loaded['tokenizer'], _ = load_pretrained_models(
+            args.model_name_or_path,
+            padding_side='left',
+            auto_device_mapping=torch.cuda.is_available(),
+            trust_remote_code=True,
+        )
+        loaded['model'].eval()
+    model, tokenizer = loaded['model'], loaded['tokenizer']
+    if engine == 'batch':
+        backend = BatchScheduler(model, tokenizer, max_batch_size=args.max_batch_size)
+    else:
+        backend = ContinuousBatchingEngine(
+            model,
+            tokenizer,
+            max_batch_size=args.max_batch_size,
+            max_tokens=args.max_kv_tokens,
+        )
+    return backend, tokenizer.eos_token
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Benchmark the serving engines under load.')
+    parser.add_argument(
+        '--model_name_or_path',
+        type=str,
+        required=True,
+        help='Path to the model checkpoint or its name.',
+    )
+    parser.add_argument('--template', type=str, default='Dialogue', help='Model template')
+    parser.add_argument(
+        '--engines',
+        type=str,
+        nargs='+',
+        choices=['chatbot', 'batch', 'continuous'],
+        default=['chatbot', 'batch', 'continuous'],
+        help='The serving paths to compare.',
+    )
+    parser.add_argument(
+        '--request_rates',
+        type=float,
+        nargs='+',
+        default=[1.0, 4.0, float('inf')],
+        help='Offered loads in requests per second, `inf` sends every request at once.',
+    )
+    parser.add_argument('--num_requests', type=int, default=64, help='Requests per offered load.')
+    parser.add_argument('--max_new_tokens', type=int, default=128, help='Tokens per request.')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='Maximum batch size.')
+    parser.add_argument(
+        '--max_kv_tokens',
+        type=int,
+        default=None,
+        help='Key-value cache budget of the continuous engine.',
+    )
+    parser.add_argument(
+        '--prompts',
+        type=str,
+        default=None,
+        help='A text file with one prompt per line, built-in prompts are used by default.',
+    )
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the arrival process.')
+    parser.add_argument('--output', type=str, default=None, help='Write the results as JSON.')
+    return parser.parse_args()
+
+
+def main(args: argparse.Namespace | None = None) -> None:
+    if args is None:
+        args = parse_arguments()
+
+    prompts = DEFAULT_PROMPTS
+    if args.prompts is not None:
+        with open(args.prompts, encoding='utf-8') as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    template = get_template_class(args.template)
+
+    results = []
+    loaded = {}
+    for engine in args.engines:
+        if engine == 'chatbot':
+            # Only one copy of the model may be resident, it also skews the cache budget.
+            release(loaded)
+        backend, eos_token = build_backend(args, engine, loaded)
+        for request_rate in args.request_rates:
+            result = run_load(
+                backend,
+                prompts,
+                template,
+                eos_token,
+                request_rate=request_rate,
+                num_requests=args.num_requests,
+                max_new_tokens=args.max_new_tokens,
+                seed=args.seed,
+            )
+            result['engine'] = engine
+            results.append(result)
+            print(
+                f'{engine:>10} | rate {request_rate:>6.2f} req/s | '
+                f'{result["requests_per_second"]:>7.2f} req/s | '
+                f'{result["tokens_per_second"]:>9.1f} tok/s | '
+                f'p50 {result["latency_p50"]:>7.3f} s | p99 {result["latency_p99"]:>7.3f} s | '
+                f'{result["num_errors"]} errors',
+            )
+        backend.close()
+        del backend
+        if engine == 'chatbot':
+            release(loaded)
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,9 @@ from __future__ import annotations
 import abc
 import dataclasses
 import os
+import queue
 import re
+import time
 from enum import Enum
 from threading import Thread
 from typing import Generator, Iterable, Iterator, NoReturn, overload
@@ -28,7 +30,7 @@ import torch
 from transformers import GenerationConfig, TextIteratorStreamer
 
 from align_anything.models.pretrained_model import load_pretrained_models
-from align_anything.utils.multi_process import to_device
+from align_anything.utils.speculative_decoding import SpeculativeDecoder
 from align_anything.utils.template_registry import get_template_class
 
 __all__ = [
@@ -179,6 +181,24 @@ class ModelArgs:
     repetition_penalty: float = 1.0
     dtype: torch.dtype | str | None = 'auto'
     template: str = "Dialogue"
+    device: str | None = None
+    assistant_model_name_or_path: str | os.PathLike | None = None
+    prompt_lookup_num_tokens: int | None = None
+
+
+@dataclasses.dataclass
+class GenerationStats:
+    """Latency and length of the last generated response."""
+
+    latency: float
+    num_tokens: int
+    # Only set with speculative decoding.
+    acceptance_rate: float | None = None
+    tokens_per_forward: float | None = None
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.num_tokens / max(self.latency, 1e-6)
 
 
 class Chatbot(AbstractChatbot):
@@ -193,6 +213,9 @@ class Chatbot(AbstractChatbot):
         repetition_penalty: float = 1.0,
         dtype: torch.dtype | str | None = 'auto',
         template: str = "Dialogue",
+        device: str | None = None,
+        assistant_model_name_or_path: str | os.PathLike | None = None,
+        prompt_lookup_num_tokens: int | None = None,
     ) -> None:
         """Initialize the chatbot."""
         
@@ -202,7 +225,16 @@ class Chatbot(AbstractChatbot):
         self.model, self.tokenizer, self.processor = load_pretrained_models(
             model_name_or_path,
             model_max_length=max_length,
-            auto_device_mapping=torch.cuda.is_available(),
+            auto_device_mapping=device is None and torch.cuda.is_available(),
+            dtype=dtype,
+            trust_remote_code=True,
+        )
+        if device is not None:
+            self.model.to(device)
+        self.speculator = SpeculativeDecoder(
+            self.model,
+            assistant_model_name_or_path=assistant_model_name_or_path,
+            prompt_lookup_num_tokens=prompt_lookup_num_tokens,
             dtype=dtype,
             trust_remote_code=True,
         )
@@ -225,12 +257,34 @@ class Chatbot(AbstractChatbot):
         self.last_response = ''
         self.inputs = []
         self.responses = []
+        self.last_stats: GenerationStats | None = None
+        self.reset_cache()
 
     @property
     def round(self) -> int:
         """Get the step counter of the current dialogue."""
         return len(self.inputs)
 
+    def reset_cache(self) -> None:
+        """Drop the token ids and the key-value cache of the committed dialogue."""
+        self.dialogue_ids = self.tokenizer(self.PROMPT_BEGIN, return_tensors='pt')['input_ids']
+        self.last_dialogue_ids = self.dialogue_ids
+        self.past_key_values = None
+
+    def rollback_cache(self) -> None:
+        """Roll the committed dialogue back to the one before the last response."""
+        self.dialogue_ids = self.last_dialogue_ids
+        # The cache covers all committed tokens except the last one, which is fed with the
+        # next turn.
+        self.crop_cache(self.dialogue_ids.size(-1) - 1)
+
+    def crop_cache(self, num_tokens: int) -> None:
+        """Keep the key-value cache of the first `num_tokens` tokens only."""
+        if hasattr(self.past_key_values, 'crop'):
+            self.past_key_values.crop(num_tokens)
+        else:
+            self.past_key_values = None
+
     def reset(self) -> None:
         """Reset the dialogue context."""
         self.dialogue = self.PROMPT_BEGIN
@@ -239,9 +293,11 @@ class Chatbot(AbstractChatbot):
         self.last_response = ''
         self.inputs.clear()
         self.responses.clear()
+        self.reset_cache()
 
     def __call__(self, text: str, stream: bool = False) -> Iterable[str]:
         """Generate the response to the given text."""
+        self.last_stats = None
         if text in {SpecialCommand.QUIT, SpecialCommand.EXIT}:
             raise EndOfDialogue
         if text == SpecialCommand.RESET:
@@ -260,8 +316,10 @@ class Chatbot(AbstractChatbot):
     def generator(self, text: str, stream: bool = False) -> Generator[str, None, None]:
         """Generate the response to the given text."""
         
+        start = time.perf_counter()
         self.last_input = text
         self.last_dialogue = self.dialogue
+        self.last_dialogue_ids = self.dialogue_ids
         raw_sample = {
             "instruction":"",
             "input": text,
@@ -270,15 +328,35 @@ class Chatbot(AbstractChatbot):
         prompt = self.template.format_sample(raw_sample)["prompt"]
         self.inputs.append(text)
 
-        input = self.dialogue+prompt
-        
-        #dialogue = self.dialogue + PROMPT_USER.format(input=text) + PROMPT_ASSISTANT
-        tokenized = to_device(
-            self.tokenizer(input, return_tensors='pt'),
-            device=('cuda' if torch.cuda.is_available() else None),
-        )
-        decoded_text = self.tokenizer.decode(tokenized['input_ids'][0], skip_special_tokens=True)
-        
+        # Only the new turn is tokenized, the committed dialogue is reused as token ids and its
+        # key-value cache, so that only the new tokens are prefilled.
+        prompt_ids = self.tokenizer(prompt, add_special_tokens=False, return_tensors='pt')['input_ids']
+        input_ids = torch.cat([self.dialogue_ids, prompt_ids], dim=-1)
+        # Tokens merged across a turn boundary, or a response the model spelled with
+        # non-canonical tokens, make the pieces differ from the whole dialogue tokenized at
+        # once. Then use the latter and keep the cache only for the tokens both agree on.
+        full_ids = self.tokenizer(self.dialogue + prompt, return_tensors='pt')['input_ids']
+        if not torch.equal(input_ids, full_ids):
+            num_common = min(input_ids.size(-1), full_ids.size(-1))
+            mismatch = (input_ids[0, :num_common] != full_ids[0, :num_common]).nonzero()
+            if mismatch.numel() > 0:
+                num_common = int(mismatch[0, 0])
+            self.crop_cache(min(num_common, full_ids.size(-1) - 1))
+            input_ids = full_ids
+        input_ids = input_ids.to(self.model.device)
+        generate_kwargs = {
+            'input_ids': input_ids,
+            'attention_mask': torch.ones_like(input_ids),
+            'generation_config': self.generation_config,
+            'return_dict_in_generate': True,
+        }
+        if self.past_key_values is not None:
+            generate_kwargs['past_key_values'] = self.past_key_values
+
+        outputs = {}
+
+        def generate(**kwargs) -> None:
+            outputs['result'] = self.speculator.generate(self.model, **kwargs)
 
         if stream:
             streamer = TextIteratorStreamer(
@@ -287,13 +365,8 @@ class Chatbot(AbstractChatbot):
                 skip_special_tokens=True,
             )
             daemon = Thread(
-                target=self.model.generate,
-                kwargs={
-                    'input_ids': tokenized['input_ids'],
-                    'attention_mask': tokenized['attention_mask'],
-                    'generation_config': self.generation_config,
-                    'streamer': streamer,
-                },
+                target=generate,
+                kwargs={**generate_kwargs, 'streamer': streamer},
                 daemon=True,
             )
             daemon.start()
@@ -305,22 +378,26 @@ class Chatbot(AbstractChatbot):
 
             daemon.join()
         else:
-            
-            output = self.model.generate(
-                input_ids=tokenized['input_ids'].to(self.model.device),
-                attention_mask=tokenized['attention_mask'].to(self.model.device),
-                generation_config=self.generation_config,
+            generate(**generate_kwargs)
+
+        sequences = outputs['result'].sequences
+        self.past_key_values = outputs['result'].past_key_values
+        response_ids = sequences[0, input_ids.size(-1):]
+        self.last_stats = GenerationStats(time.perf_counter() - start, response_ids.numel())
+        if self.speculator.enabled:
+            self.last_stats.acceptance_rate = self.speculator.last_stats.acceptance_rate
+            self.last_stats.tokens_per_forward = self.speculator.last_stats.tokens_per_forward
+        clean_response = self.tokenizer.decode(response_ids, skip_special_tokens=True)
+        response = self.tokenizer.decode(response_ids, skip_special_tokens=False)
+        if response.endswith(self.tokenizer.eos_token):
+            response = response[: -len(self.tokenizer.eos_token)]
+
+        self.dialogue_ids = sequences.cpu()
+        if response_ids.numel() == 0 or response_ids[-1].item() != self.tokenizer.eos_token_id:
+            self.dialogue_ids = torch.cat(
+                [self.dialogue_ids, torch.tensor([[self.tokenizer.eos_token_id]])], dim=-1
             )
-            
-
-            dialogue_text = self.tokenizer.decode(output[0], skip_special_tokens=False)
-            clean_text = self.tokenizer.decode(output[0], skip_special_tokens=True)
-            clean_response = clean_text.replace(decoded_text, "", 1)
-            
-            response = dialogue_text.replace(self.dialogue, "", 1)
-            
 
-            
         self.last_response = response
         self.responses.append(response)
         raw_sample = {
@@ -340,6 +417,7 @@ class Chatbot(AbstractChatbot):
             return ['WRONG COMMAND: Empty dialogue history. No input to regenerate.']
 
         self.dialogue = self.last_dialogue
+        self.rollback_cache()
         self.inputs.pop()
         self.responses.pop()
         return self.generator(self.last_input, stream=stream)
@@ -349,6 +427,19 @@ class ChatbotList(AbstractChatbot):
     """List of chatbot."""
 
     def __init__(self, chatbots: Iterable[Chatbot | ModelArgs]) -> None:
+        chatbots = list(chatbots)
+        # Give every model its own device when there are enough of them, so that they can
+        # generate concurrently without sharing one device.
+        if (
+            torch.cuda.device_count() >= len(chatbots) > 1
+            and all(
+                isinstance(chatbot, ModelArgs) and chatbot.device is None for chatbot in chatbots
+            )
+        ):
+            chatbots = [
+                dataclasses.replace(chatbot, device=f'cuda:{i}')
+                for i, chatbot in enumerate(chatbots)
+            ]
         self.chatbots = [
             chatbot if isinstance(chatbot, Chatbot) else Chatbot(**dataclasses.asdict(chatbot))
             for chatbot in chatbots
@@ -399,3 +490,39 @@ class ChatbotList(AbstractChatbot):
         """Regenerate the last response."""
         for chatbot in self.chatbots:
             yield chatbot.regenerator(stream=stream)
+
+    @staticmethod
+    def multiplex(
+        responses: Iterable[Iterable[str]],
+    ) -> Generator[tuple[int, str, bool], None, None]:
+        """Consume the responses of all chatbots concurrently.
+
+        Yield `(index, response, finished)` whenever any chatbot produces new text, so the turn
+        takes as long as the slowest chatbot instead of the sum of all of them.
+        """
+        events = queue.Queue()
+
+        def consume(index: int, response_iterable: Iterable[str]) -> None:
+            response = ''
+            try:
+                for response in response_iterable:
+                    events.put((index, response, False))
+            except Exception as ex:  # pylint: disable=broad-except
+                events.put((index, ex, True))
+                return
+            events.put((index, response, True))
+
+        threads = [
+            Thread(target=consume, args=(index, response_iterable), daemon=True)
+            for index, response_iterable in enumerate(responses)
+        ]
+        for thread in threads:
+            thread.start()
+
+        num_running = len(threads)
+        while num_running > 0:
+            index, response, finished = events.get()
+            if isinstance(response, Exception):
+                raise response
+            num_running -= finished
+            yield index, response, finished
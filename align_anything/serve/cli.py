@@ -18,10 +18,11 @@ from __future__ import annotations
 
 import argparse
 import itertools
+import time
 from typing import Generator, Iterable
 
 import torch
-from rich.console import Console
+from rich.console import Console, Group
 from rich.live import Live
 from rich.syntax import Syntax
 from rich.text import Text
@@ -29,8 +30,10 @@ from transformers.utils import is_torch_bf16_gpu_available, is_torch_tf32_availa
 
 from align_anything.serve.chatbot import (
     CODE_BLOCK_PATTERN,
+    Chatbot,
     ChatbotList,
     EndOfDialogue,
+    GenerationStats,
     ModelArgs,
     SpecialCommand,
 )
@@ -113,12 +116,16 @@ class CLI:
                     self.console.print()
                     continue
 
-                for response_generator, name, style in zip(
-                    self.chatbots(text=text, stream=self.stream),
-                    self.chatbot_names,
-                    self.styles,
-                ):
-                    self.render(response_generator, name, style)
+                if len(self.chatbots) > 1:
+                    self.render_multiplexed(self.chatbots(text=text, stream=self.stream))
+                else:
+                    for response_generator, name, style, chatbot in zip(
+                        self.chatbots(text=text, stream=self.stream),
+                        self.chatbot_names,
+                        self.styles,
+                        self.chatbots,
+                    ):
+                        self.render(response_generator, name, style, chatbot)
 
                 self.console.print()
 
@@ -127,7 +134,13 @@ class CLI:
                 self.console.print()
             self.console.print('Bye!', style='bold yellow')
 
-    def render(self, response_generator: Generator[str, None, None], name: str, style: str) -> None:
+    def render(
+        self,
+        response_generator: Generator[str, None, None],
+        name: str,
+        style: str,
+        chatbot: Chatbot | None = None,
+    ) -> None:
         response = ''
         if self.stream:
             with Live(console=self.console, refresh_per_second=25, transient=True) as live:
@@ -137,6 +150,54 @@ class CLI:
         else:
             response = next(response_generator)
 
+        self.print_response(response, name, style, chatbot.last_stats if chatbot else None)
+
+    def render_multiplexed(self, responses: Iterable[Iterable[str]]) -> None:
+        """Generate with all the chatbots concurrently and render their streams side by side."""
+        start = time.perf_counter()
+        latest = ['' for _ in self.chatbots]
+        finished = [False for _ in self.chatbots]
+        if self.stream:
+            with Live(console=self.console, refresh_per_second=25, transient=True) as live:
+                for index, response, done in self.chatbots.multiplex(responses):
+                    latest[index], finished[index] = response, done
+                    live.update(
+                        Group(
+                            *(
+                                Text(
+                                    f'{name} ({"done" if is_done else "generating..."})\n{text}\n',
+                                    style=f'dim {style}',
+                                )
+                                for name, style, text, is_done in zip(
+                                    self.chatbot_names,
+                                    self.styles,
+                                    latest,
+                                    finished,
+                                )
+                            ),
+                        ),
+                    )
+        else:
+            for index, response, _ in self.chatbots.multiplex(responses):
+                latest[index] = response
+        elapsed = time.perf_counter() - start
+
+        for response, name, style, chatbot in zip(
+            latest,
+            self.chatbot_names,
+            self.styles,
+            self.chatbots,
+        ):
+            self.print_response(response, name, style, chatbot.last_stats)
+        self.console.print(f'(turn: {elapsed:.2f}s)', style='dim')
+
+    def print_response(
+        self,
+        response: str,
+        name: str,
+        style: str,
+        stats: GenerationStats | None = None,
+    ) -> None:
         self.console.print(f'[{self.chatbots.round}] Assistant (', style=f'bold {style}', end='')
         self.console.print(name, end='')
         self.console.print(
@@ -163,6 +224,18 @@ class CLI:
                 )
             self.console.print(match.group('suffix'), style=f'bold italic {style}', end='')
         self.console.print(response, style=style, soft_wrap=True)
+        if stats is not None:
+            speculative = ''
+            if stats.acceptance_rate is not None:
+                speculative = (
+                    f', acceptance {stats.acceptance_rate:.1%}, '
+                    f'{stats.tokens_per_forward:.2f} tokens/forward'
+                )
+            self.console.print(
+                f'({stats.latency:.2f}s, {stats.num_tokens} tokens, '
+                f'{stats.tokens_per_second:.1f} tokens/s{speculative})',
+                style=f'dim {style}',
+            )
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -207,6 +280,21 @@ def parse_arguments() -> argparse.Namespace:
         help='Whether to stream the output.',
         default=False,
     )
+    parser.add_argument(
+        '--assistant_model_name_or_path',
+        type=str,
+        default=None,
+        help='A draft model sharing the tokenizer, enables speculative decoding.',
+    )
+    parser.add_argument(
+        '--prompt_lookup_num_tokens',
+        type=int,
+        default=None,
+        help=(
+            'Number of tokens drafted from n-grams of the prompt, '
+            'speculative decoding without a draft model.'
+        ),
+    )
     parser.add_argument(
         '--fp16',
         type=str2bool,
@@ -257,6 +345,8 @@ def main(args: argparse.Namespace | None = None) -> None:
         'repetition_penalty': args.repetition_penalty,
         'dtype': (torch.bfloat16 if args.bf16 else (torch.float16 if args.fp16 else 'auto')),
         'template': args.template,
+        'assistant_model_name_or_path': args.assistant_model_name_or_path,
+        'prompt_lookup_num_tokens': args.prompt_lookup_num_tokens,
     }
     cli = CLI(
         *(
@@ -0,0 +1,477 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Continuous batching engine for serving generation requests."""
+
+from __future__ import annotations
+
+import collections
+import dataclasses
+import queue
+import threading
+import time
+from typing import Any
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache, PreTrainedModel, PreTrainedTokenizerBase
+
+from align_anything.serve.kv_cache import KVCacheAllocator
+
+
+__all__ = [
+    'GenerationRequest',
+    'ServerMetrics',
+    'KVCacheAllocator',
+    'ContinuousBatchingEngine',
+]
+
+
+@dataclasses.dataclass
+class GenerationRequest:
+    """A single completion request waiting to be batched."""
+
+    prompt: str
+    max_new_tokens: int = 16
+    temperature: float = 1.0
+    top_p: float = 1.0
+    stop: list[str] = dataclasses.field(default_factory=list)
+    stream: bool = False
+    arrival_time: float = dataclasses.field(default_factory=time.perf_counter)
+    # Receives `('delta', text)` while streaming and a final `('done', result)` or `('error', message)`.
+    outputs: queue.Queue = dataclasses.field(default_factory=queue.Queue)
+
+    @property
+    def sampling_key(self) -> tuple[float, float]:
+        """Requests with the same key can share one `generate` call."""
+        if self.temperature <= 0.0:
+            return (0.0, 1.0)
+        return (self.temperature, self.top_p)
+
+
+class ServerMetrics:
+    """Thread-safe serving counters."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.active_requests = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_batched_requests = 0
+        self.num_prompt_tokens = 0
+        self.num_generated_tokens = 0
+        self.generation_time = 0.0
+
+    def request_started(self) -> None:
+        with self.lock:
+            self.active_requests += 1
+            self.num_requests += 1
+
+    def request_finished(self) -> None:
+        with self.lock:
+            self.active_requests -= 1
+
+    def batch_finished(self, batch_size: int, prompt_tokens: int, generated_tokens: int, elapsed: float) -> None:
+        with self.lock:
+            self.num_batches += 1
+            self.num_batched_requests += batch_size
+            self.num_prompt_tokens += prompt_tokens
+            self.num_generated_tokens += generated_tokens
+            self.generation_time += elapsed
+
+    def summary(self, queue_depth: int) -> dict[str, Any]:
+        with self.lock:
+            uptime = time.perf_counter() - self.start_time
+            return {
+                'uptime': uptime,
+                'active_requests': self.active_requests,
+                'queue_depth': queue_depth,
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'mean_batch_size': self.num_batched_requests / max(self.num_batches, 1),
+                'prompt_tokens': self.num_prompt_tokens,
+                'generated_tokens': self.num_generated_tokens,
+                'tokens_per_second': self.num_generated_tokens / max(self.generation_time, 1e-6),
+                'tokens_per_second_uptime': self.num_generated_tokens / max(uptime, 1e-6),
+            }
+
+
+def truncate_at_stop(text: str, stop: list[str]) -> tuple[str, bool]:
+    """Cut the text at the first stop string."""
+    positions = [text.find(s) for s in stop if s and s in text]
+    if not positions:
+        return text, False
+    return text[: min(positions)], True
+
+
+def decode_delta(
+    tokenizer: PreTrainedTokenizerBase,
+    token_ids: list[int],
+    prefix_offset: int,
+    read_offset: int,
+) -> tuple[str, int, int]:
+    """Decode the text added by the tokens after `read_offset`, looking back to `prefix_offset`.
+
+    Only the last few tokens are decoded, so streaming a response costs linear time. Decoding
+    from `prefix_offset` keeps the context that merges the new tokens with the previous ones, and
+    an incomplete character is held back until its remaining tokens arrive. Returns the new text
+    and the offsets for the next call.
+    """
+    prefix_text = tokenizer.decode(token_ids[prefix_offset:read_offset], skip_special_tokens=True)
+    new_text = tokenizer.decode(token_ids[prefix_offset:], skip_special_tokens=True)
+    if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+        return new_text[len(prefix_text) :], read_offset, len(token_ids)
+    return '', prefix_offset, read_offset
+
+
+def emit_text_delta(request: GenerationRequest, text: str, sent: str) -> str:
+    """Push the new part of the decoded text to a streaming request and return the text sent so far.
+
+    Incomplete characters and the characters that may start a stop string are held back.
+    """
+    if text.endswith('\ufffd'):
+        return sent
+    text, stopped = truncate_at_stop(text, request.stop)
+    if not stopped:
+        holdback = max((len(s) for s in request.stop), default=1) - 1
+        text = text[: len(text) - holdback]
+    if len(text) > len(sent):
+        request.outputs.put(('delta', text[len(sent) :]))
+        return text
+    return sent
+
+
+
+@dataclasses.dataclass(eq=False)
+class Sequence:
+    """A request that holds a slot in the running batch."""
+
+    request: GenerationRequest
+    slot: int
+    prompt_ids: list[int]
+    token_ids: list[int] = dataclasses.field(default_factory=list)
+    # The decoded text and the offsets of `decode_delta`, only kept for streaming or stop strings.
+    text: str = ''
+    prefix_offset: int = 0
+    read_offset: int = 0
+    sent: str = ''
+
+
+def sample_next_tokens(logits: torch.Tensor, requests: list[GenerationRequest]) -> torch.LongTensor:
+    """Sample one token per row with the sampling parameters of its own request."""
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    temperatures = torch.tensor([request.temperature for request in requests], device=logits.device)
+    if not bool((temperatures > 0.0).any()):
+        return greedy
+    top_p = torch.tensor([request.top_p for request in requests], device=logits.device)
+    probs = torch.softmax(logits / temperatures.clamp(min=1e-5).unsqueeze(-1), dim=-1)
+    sorted_probs, sorted_indices = probs.sort(dim=-1, descending=True)
+    # Keep the smallest prefix of tokens whose probability mass reaches `top_p`.
+    sorted_probs = sorted_probs.masked_fill(
+        sorted_probs.cumsum(dim=-1) - sorted_probs > top_p.unsqueeze(-1),
+        0.0,
+    )
+    sampled = sorted_indices.gather(-1, torch.multinomial(sorted_probs, num_samples=1)).squeeze(-1)
+    return torch.where(temperatures > 0.0, sampled, greedy)
+
+
+class ContinuousBatchingEngine:
+    """Iteration-level batching: sequences join and leave the running batch at token boundaries.
+
+    Admitted requests are prefilled together and their caches are merged into the running,
+    left-padded cache. Each iteration then decodes one token for every running sequence, and the
+    finished ones are dropped from the cache right away instead of waiting for the longest one.
+    The engine exposes the same `submit` interface as `BatchScheduler`.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        max_batch_size: int = 8,
+        max_tokens: int | None = None,
+        memory_fraction: float = 0.9,
+        metrics: ServerMetrics | None = None,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        free_memory = None
+        if max_tokens is None and model.device.type == 'cuda':
+            free_memory, _ = torch.cuda.mem_get_info(model.device)
+        self.allocator = KVCacheAllocator.from_free_memory(
+            model.config,
+            num_slots=max_batch_size,
+            element_size=torch.finfo(model.dtype).bits // 8,
+            free_memory=free_memory,
+            memory_fraction=memory_fraction,
+            max_tokens=max_tokens,
+        )
+        self.queue: queue.Queue[GenerationRequest] = queue.Queue()
+        self.waiting: collections.deque[tuple[GenerationRequest, list[int]]] = collections.deque()
+
+        self.running: list[Sequence] = []
+        # Models that take a `Cache` return the legacy tuples when they are given none, so the
+        # decode steps would keep passing the deprecated format back.
+        self.cache_class = DynamicCache if getattr(model, '_supports_cache_class', False) else None
+        self.past_key_values = None
+        self.attention_mask: torch.LongTensor | None = None
+        self.positions: torch.LongTensor | None = None
+        self.last_tokens: torch.LongTensor | None = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() + len(self.waiting)
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        self.queue.put(request)
+        return request
+
+    def close(self) -> None:
+        """Stop the engine thread once the submitted requests are finished."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def loop(self) -> None:
+        while not (self.closed and not self.running and not self.waiting):
+            self.receive(block=not self.running and not self.waiting)
+            admitted = []
+            try:
+                admitted = self.admit()
+                if admitted:
+                    self.prefill(admitted)
+                if self.running:
+                    self.decode()
+            except Exception as ex:  # pylint: disable=broad-except
+                error = f'{type(ex).__name__}: {ex}'
+                failed = self.running + [s for s in admitted if s not in self.running]
+                for sequence in failed:
+                    sequence.request.outputs.put(('error', error))
+                    if sequence.slot in self.allocator.reserved:
+                        self.allocator.free(sequence.slot)
+                if not failed and self.waiting:
+                    # The admission of the first waiting request failed, drop it so that it
+                    # cannot fail again on every iteration.
+                    request, _ = self.waiting.popleft()
+                    request.outputs.put(('error', error))
+                self.running = []
+                self.past_key_values = None
+
+    def receive(self, block: bool) -> None:
+        if block:
+            self.enqueue(self.queue.get())
+        while True:
+            try:
+                self.enqueue(self.queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def enqueue(self, request: GenerationRequest | None) -> None:
+        if request is None:
+            self.closed = True
+            return
+        prompt_ids = self.tokenizer(request.prompt)['input_ids']
+        self.waiting.append((request, prompt_ids))
+
+    def admit(self) -> list[Sequence]:
+        """Admit waiting requests in arrival order while slots and cache are available."""
+        admitted = []
+        while self.waiting:
+            request, prompt_ids = self.waiting[0]
+            num_tokens = len(prompt_ids) + request.max_new_tokens
+            if not self.allocator.can_allocate(num_tokens):
+                if self.running or admitted or self.allocator.num_free_slots == 0:
+                    break
+                self.waiting.popleft()
+                request.outputs.put((
+                    'error',
+                    f'The request needs {num_tokens} tokens of key-value cache, '
+                    f'but only {self.allocator.max_tokens} are available.',
+                ))
+                continue
+            self.waiting.popleft()
+            admitted.append(Sequence(request, self.allocator.allocate(num_tokens), prompt_ids))
+        return admitted
+
+    def to_legacy_cache(self, past_key_values: Any) -> tuple:
+        if hasattr(past_key_values, 'to_legacy_cache'):
+            self.cache_class = type(past_key_values)
+            return past_key_values.to_legacy_cache()
+        return past_key_values
+
+    def from_legacy_cache(self, past_key_values: tuple) -> Any:
+        if self.cache_class is not None:
+            return self.cache_class.from_legacy_cache(past_key_values)
+        return past_key_values
+
+    @staticmethod
+    def pad_cache(past_key_values: tuple, length: int) -> tuple:
+        return tuple(
+            tuple(F.pad(tensor, (0, 0, length - tensor.size(-2), 0)) for tensor in layer)
+            for layer in past_key_values
+        )
+
+    @torch.no_grad()
+    def prefill(self, sequences: list[Sequence]) -> None:
+        start = time.perf_counter()
+        pad_token_id = self.tokenizer.pad_token_id
+        length = max(len(sequence.prompt_ids) for sequence in sequences)
+        input_ids = torch.tensor(
+            [[pad_token_id] * (length - len(s.prompt_ids)) + s.prompt_ids for s in sequences],
+            device=self.model.device,
+        )
+        attention_mask = torch.tensor(
+            [[0] * (length - len(s.prompt_ids)) + [1] * len(s.prompt_ids) for s in sequences],
+            device=self.model.device,
+        )
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        past_key_values = self.to_legacy_cache(outputs.past_key_values)
+        next_tokens = sample_next_tokens(outputs.logits[:, -1], [s.request for s in sequences])
+
+        if self.running:
+            length = max(length, self.attention_mask.size(-1))
+            self.past_key_values = tuple(
+                tuple(torch.cat(pair, dim=0) for pair in zip(layer, new_layer))
+                for layer, new_layer in zip(
+                    self.pad_cache(self.past_key_values, length),
+                    self.pad_cache(past_key_values, length),
+                )
+            )
+            self.attention_mask = torch.cat(
+                [
+                    F.pad(self.attention_mask, (length - self.attention_mask.size(-1), 0)),
+                    F.pad(attention_mask, (length - attention_mask.size(-1), 0)),
+                ],
+                dim=0,
+            )
+            self.positions = torch.cat([self.positions, attention_mask.sum(dim=-1)])
+            self.last_tokens = torch.cat([self.last_tokens, next_tokens])
+        else:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.positions = attention_mask.sum(dim=-1)
+            self.last_tokens = next_tokens
+        self.running.extend(sequences)
+
+        self.metrics.batch_finished(
+            len(sequences),
+            sum(len(s.prompt_ids) for s in sequences),
+            len(sequences),
+            time.perf_counter() - start,
+        )
+        self.step(next_tokens.tolist(), first=len(self.running) - len(sequences))
+
+    @torch.no_grad()
+    def decode(self) -> None:
+        start = time.perf_counter()
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        outputs = self.model(
+            input_ids=self.last_tokens.unsqueeze(-1),
+            attention_mask=self.attention_mask,
+            position_ids=self.positions.unsqueeze(-1),
+            past_key_values=self.from_legacy_cache(self.past_key_values),
+            use_cache=True,
+        )
+        self.past_key_values = self.to_legacy_cache(outputs.past_key_values)
+        self.positions = self.positions + 1
+        self.last_tokens = sample_next_tokens(outputs.logits[:, -1], [s.request for s in self.running])
+
+        self.metrics.batch_finished(len(self.running), 0, len(self.running), time.perf_counter() - start)
+        self.step(self.last_tokens.tolist(), first=0)
+
+    def step(self, next_tokens: list[int], first: int) -> None:
+        """Append the new tokens of `self.running[first:]` and release the finished sequences."""
+        finished = []
+        for index, token_id in enumerate(next_tokens, start=first):
+            sequence = self.running[index]
+            request = sequence.request
+            if token_id == self.tokenizer.eos_token_id:
+                finished.append((index, 'stop'))
+                continue
+            sequence.token_ids.append(token_id)
+            stopped = False
+            if request.stream or request.stop:
+                delta, sequence.prefix_offset, sequence.read_offset = decode_delta(
+                    self.tokenizer,
+                    sequence.token_ids,
+                    sequence.prefix_offset,
+                    sequence.read_offset,
+                )
+                sequence.text += delta
+                if request.stream:
+                    sequence.sent = emit_text_delta(request, sequence.text, sequence.sent)
+                if delta and request.stop:
+                    # A new stop string ends in the delta, so only the tail needs a search.
+                    window = len(delta) + max(len(s) for s in request.stop) - 1
+                    tail = sequence.text[max(len(sequence.text) - window, 0) :]
+                    stopped = truncate_at_stop(tail, request.stop)[1]
+            if stopped:
+                finished.append((index, 'stop'))
+            elif len(sequence.token_ids) >= request.max_new_tokens:
+                finished.append((index, 'length'))
+
+        if not finished:
+            return
+        for index, finish_reason in finished:
+            self.finish(self.running[index], finish_reason)
+        finished_indices = {index for index, _ in finished}
+        keep = [index for index in range(len(self.running)) if index not in finished_indices]
+        self.running = [self.running[index] for index in keep]
+        if not self.running:
+            self.past_key_values = None
+            return
+
+        keep = torch.tensor(keep, device=self.attention_mask.device)
+        self.attention_mask = self.attention_mask.index_select(0, keep)
+        # Drop the leading columns that only padded the sequences that left.
+        offset = int((self.attention_mask.sum(dim=0) == 0).cumprod(dim=0).sum().item())
+        self.attention_mask = self.attention_mask[:, offset:]
+        self.past_key_values = tuple(
+            tuple(tensor.index_select(0, keep)[..., offset:, :] for tensor in layer)
+            for layer in self.past_key_values
+        )
+        self.positions = self.positions.index_select(0, keep)
+        self.last_tokens = self.last_tokens.index_select(0, keep)
+
+    def finish(self, sequence: Sequence, finish_reason: str) -> None:
+        request = sequence.request
+        text, _ = truncate_at_stop(
+            self.tokenizer.decode(sequence.token_ids, skip_special_tokens=True),
+            request.stop,
+        )
+        if request.stream and len(text) > len(sequence.sent):
+            request.outputs.put(('delta', text[len(sequence.sent) :]))
+        request.outputs.put((
+            'done',
+            {
+                'text': text,
+                'finish_reason': finish_reason,
+                'prompt_tokens': len(sequence.prompt_ids),
+                'completion_tokens': len(sequence.token_ids),
+            },
+        ))
+        self.allocator.free(sequence.slot)
@@ -0,0 +1,94 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Key-value cache accounting of the continuous batching engine."""
+
+from __future__ import annotations
+
+from typing import Any
+
+
+__all__ = ['KVCacheAllocator']
+
+
+class KVCacheAllocator:
+    """Slot-based accounting of the key-value cache of the running sequences.
+
+    Every running sequence holds one of `num_slots` slots and reserves the cache of its prompt
+    and of its whole token budget when it is admitted, so it can never run out of cache later.
+    The running sequences share one left-padded cache tensor, whose footprint is the number of
+    sequences times the longest reservation; admission keeps this footprint under `max_tokens`.
+    """
+
+    def __init__(self, num_slots: int, max_tokens: int) -> None:
+        self.num_slots = num_slots
+        self.max_tokens = max_tokens
+        self.free_slots = list(reversed(range(num_slots)))
+        self.reserved: dict[int, int] = {}
+
+    @staticmethod
+    def bytes_per_token(config: Any, element_size: int) -> int:
+        num_heads = config.num_attention_heads
+        num_key_value_heads = getattr(config, 'num_key_value_heads', None) or num_heads
+        head_dim = getattr(config, 'head_dim', None) or config.hidden_size // num_heads
+        return 2 * config.num_hidden_layers * num_key_value_heads * head_dim * element_size
+
+    @classmethod
+    def from_free_memory(
+        cls,
+        config: Any,
+        num_slots: int,
+        element_size: int,
+        free_memory: int | None = None,
+        memory_fraction: float = 0.9,
+        max_tokens: int | None = None,
+    ) -> KVCacheAllocator:
+        """Size the cache budget from the free device memory, unless `max_tokens` is given.
+
+        Without `free_memory` (e.g. on CPU) every slot may hold the longest supported sequence.
+        """
+        if max_tokens is None:
+            if free_memory is not None:
+                max_tokens = int(free_memory * memory_fraction) // cls.bytes_per_token(
+                    config,
+                    element_size,
+                )
+            else:
+                max_tokens = num_slots * getattr(config, 'max_position_embeddings', 2048)
+        return cls(num_slots, max_tokens)
+
+    @property
+    def num_free_slots(self) -> int:
+        return len(self.free_slots)
+
+    @property
+    def used_tokens(self) -> int:
+        return len(self.reserved) * max(self.reserved.values(), default=0)
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        if not self.free_slots:
+            return False
+        footprint = (len(self.reserved) + 1) * max([num_tokens, *self.reserved.values()])
+        return footprint <= self.max_tokens
+
+    def allocate(self, num_tokens: int) -> int:
+        if not self.can_allocate(num_tokens):
+            raise RuntimeError('Not enough key-value cache to admit the sequence.')
+        slot = self.free_slots.pop()
+        self.reserved[slot] = num_tokens
+        return slot
+
+    def free(self, slot: int) -> None:
+        del self.reserved[slot]
+        self.free_slots.append(slot)
@@ -0,0 +1,388 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Best-of-N rejection sampling of preference pairs with a policy and a reward model.
+
+Every prompt gets `num_samples` sampled responses that are scored by the reward model. The
+highest and the lowest scored ones are written as `response_0` and `response_1` with
+`better_response_id = 0`, next to the fields of the prompt sample, so the output can be loaded by
+`PreferenceDataset` with the same template, and `response_0` alone serves as SFT data. A prompt
+whose best and worst responses tie in reward or in text gives no preference and is not paired.
+
+Launch it with `torchrun --nproc_per_node <N>`, every rank writes its own
+`pairs-<rank>-of-<world_size>.jsonl` and logs the unpaired prompts to
+`skipped-<rank>-of-<world_size>.jsonl`. After every batch the number of finished prompts and
+of lines of both files is recorded in `progress-<rank>-of-<world_size>.json`, a restart resumes
+from it and drops any line written after it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from typing import Any
+
+import torch
+from tqdm import tqdm
+from transformers import GenerationConfig, PreTrainedModel, PreTrainedTokenizerBase
+from transformers.utils import is_torch_bf16_gpu_available
+
+from align_anything.datasets.prompt_only import PromptOnlyDataset
+from align_anything.models.pretrained_model import load_pretrained_models
+from align_anything.models.pretrained_model_with_value import load_pretrained_model_with_value_head
+from align_anything.serve.score import RewardScorer, count_finished_records
+from align_anything.utils.multi_process import get_current_device
+from align_anything.utils.tools import seed_everything, str2bool
+
+
+__all__ = ['RejectionSampler']
+
+
+class RejectionSampler:
+    """Sample `num_samples` responses per prompt and rank them with a reward model.
+
+    The prompts are prefilled once and expanded to `num_samples` rows by `num_return_sequences`.
+    Responses are scored as decoded text, so the reward model may use a different tokenizer.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        scorer: RewardScorer,
+        generation_config: GenerationConfig,
+        num_samples: int,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.scorer = scorer
+        self.generation_config = generation_config
+        self.num_samples = num_samples
+        self.device = next(model.parameters()).device
+
+    @torch.no_grad()
+    def generate(self, prompts: list[str]) -> list[list[str]]:
+        """Return `num_samples` responses for each prompt."""
+        inputs = self.tokenizer(
+            prompts,
+            padding=True,
+            truncation=True,
+            return_tensors='pt',
+        ).to(self.device)
+        sequences = self.model.generate(
+            **inputs,
+            generation_config=self.generation_config,
+            num_return_sequences=self.num_samples,
+        )
+        responses = self.tokenizer.batch_decode(
+            sequences[:, inputs['input_ids'].size(-1) :],
+            skip_special_tokens=True,
+        )
+        return [
+            responses[i : i + self.num_samples] for i in range(0, len(responses), self.num_samples)
+        ]
+
+    def __call__(self, prompts: list[str]) -> list[tuple[list[str], list[float]]]:
+        """Return the responses of each prompt and their rewards."""
+        candidates = self.generate(prompts)
+        eos_token = self.scorer.tokenizer.eos_token
+        rewards = self.scorer.score(
+            [
+                prompt + response + eos_token
+                for prompt, responses in zip(prompts, candidates)
+                for response in responses
+            ],
+        )
+        return [
+            (responses, rewards[i * self.num_samples : (i + 1) * self.num_samples])
+            for i, responses in enumerate(candidates)
+        ]
+
+
+def make_pair(
+    raw_sample: dict[str, Any],
+    responses: list[str],
+    rewards: list[float],
+    save_candidates: bool = False,
+) -> dict[str, Any] | None:
+    """Build a preference sample from the best and the worst scored responses.
+
+    Return `None` if they tie in reward or in text, since the pair would teach no preference.
+    """
+    best = max(range(len(rewards)), key=rewards.__getitem__)
+    worst = min(range(len(rewards)), key=rewards.__getitem__)
+    if rewards[best] == rewards[worst] or responses[best] == responses[worst]:
+        return None
+    sample = {
+        **raw_sample,
+        'response_0': responses[best],
+        'response_1': responses[worst],
+        'better_response_id': 0,
+        'response_0_reward': rewards[best],
+        'response_1_reward': rewards[worst],
+    }
+    if save_candidates:
+        sample['candidates'] = responses
+        sample['candidate_rewards'] = rewards
+    return sample
+
+
+def truncate_records(path: str | os.PathLike, num_records: int) -> None:
+    """Keep only the first `num_records` lines of a jsonl output file."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        for _ in range(num_records):
+            if not f.readline().endswith(b'\n'):
+                raise ValueError(f'{path} has fewer than the {num_records} recorded lines.')
+        f.truncate()
+
+
+def load_progress(progress_file: str, output_file: str, skipped_file: str) -> dict[str, int]:
+    """Restore the output files to the last recorded progress."""
+    if os.path.exists(progress_file):
+        with open(progress_file, encoding='utf-8') as f:
+            progress = json.load(f)
+    else:
+        # Output of a run that predates the progress record.
+        num_pairs = count_finished_records(output_file)
+        num_skipped = count_finished_records(skipped_file)
+        progress = {
+            'num_prompts': num_pairs + num_skipped,
+            'num_pairs': num_pairs,
+            'num_skipped': num_skipped,
+        }
+    truncate_records(output_file, progress['num_pairs'])
+    truncate_records(skipped_file, progress['num_skipped'])
+    return progress
+
+
+def save_progress(progress_file: str, progress: dict[str, int]) -> None:
+    """Replace the progress record atomically, so that it is either the old or the new one."""
+    with open(f'{progress_file}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{progress_file}.tmp', progress_file)
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Best-of-N rejection sampling.')
+    parser.add_argument(
+        '--model_name_or_path',
+        type=str,
+        required=True,
+        help='Path to the policy model checkpoint or its name.',
+    )
+    parser.add_argument(
+        '--reward_model_name_or_path',
+        type=str,
+        required=True,
+        help='Path to the reward model checkpoint or its name.',
+    )
+    parser.add_argument('--prompt_datasets', type=str, required=True, help='The prompt dataset.')
+    parser.add_argument('--template', type=str, required=True, help='The prompt-only template.')
+    parser.add_argument('--split', type=str, default=None, help='The split of the dataset.')
+    parser.add_argument('--subset', type=str, default=None, help='The subset of the dataset.')
+    parser.add_argument('--data_files', type=str, default=None, help='The data files to be used.')
+    parser.add_argument('--size', type=int, default=None, help='The number of prompts to use.')
+    parser.add_argument(
+        '--num_proc',
+        type=int,
+        default=None,
+        help='Number of processes hashing the prompts for deduplication.',
+    )
+    parser.add_argument('--output_dir', type=str, required=True, help='Where to write the pairs.')
+    parser.add_argument('--num_samples', type=int, default=8, help='Responses per prompt.')
+    parser.add_argument(
+        '--prompt_batch_size',
+        type=int,
+        default=8,
+        help='Prompts per `generate` call, each expanded to `num_samples` rows.',
+    )
+    parser.add_argument('--max_new_tokens', type=int, default=512, help='Tokens per response.')
+    parser.add_argument('--max_length', type=int, default=2048, help='Maximum sequence length.')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Sampling temperature.')
+    parser.add_argument('--top_p', type=float, default=1.0, help='Nucleus sampling threshold.')
+    parser.add_argument(
+        '--max_tokens_per_batch',
+        type=int,
+        default=32768,
+        help='Maximum number of padded tokens of a reward model batch.',
+    )
+    parser.add_argument(
+        '--save_candidates',
+        type=str2bool,
+        default=False,
+        help='Also write every response and its reward.',
+    )
+    parser.add_argument(
+        '--resume',
+        type=str2bool,
+        default=True,
+        help='Continue after the prompts already in the output files.',
+    )
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the sampling.')
+    parser.add_argument(
+        '--bf16',
+        type=str2bool,
+        default=True,
+        help='Whether to use bfloat16 precision.',
+    )
+    parser.add_argument(
+        '--trust_remote_code',
+        type=str2bool,
+        default=True,
+        help='Whether to trust remote code.',
+    )
+
+    args = parser.parse_args()
+    if args.num_samples < 2:
+        parser.error('At least two samples per prompt are needed to build a pair.')
+    if args.bf16 and torch.cuda.is_available() and not is_torch_bf16_gpu_available():
+        parser.error('bf16 precision is not supported on this GPU, please disable `--bf16`.')
+    return args
+
+
+def main(args: argparse.Namespace | None = None) -> None:
+    if args is None:
+        args = parse_arguments()
+
+    rank = int(os.environ.get('RANK', '0'))
+    world_size = int(os.environ.get('WORLD_SIZE', '1'))
+    seed_everything(args.seed + rank)
+    os.makedirs(args.output_dir, exist_ok=True)
+    suffix = f'{rank:05d}-of-{world_size:05d}'
+    output_file = os.path.join(args.output_dir, f'pairs-{suffix}.jsonl')
+    skipped_file = os.path.join(args.output_dir, f'skipped-{suffix}.jsonl')
+    progress_file = os.path.join(args.output_dir, f'progress-{suffix}.json')
+    if not args.resume:
+        for path in (output_file, skipped_file, progress_file):
+            if os.path.exists(path):
+                os.remove(path)
+    progress = load_progress(progress_file, output_file, skipped_file)
+    num_finished = progress['num_prompts']
+
+    dtype = torch.bfloat16 if args.bf16 else 'auto'
+    device = get_current_device()
+    model, tokenizer, _ = load_pretrained_models(
+        args.model_name_or_path,
+        model_max_length=args.max_length,
+        padding_side='left',
+        dtype=dtype,
+        trust_remote_code=args.trust_remote_code,
+    )
+    model.to(device).eval()
+    reward_model, reward_tokenizer, _ = load_pretrained_model_with_value_head(
+        args.reward_model_name_or_path,
+        model_max_length=args.max_length,
+        padding_side='right',
+        dtype=dtype,
+        trust_remote_code=args.trust_remote_code,
+    )
+    reward_model.to(device).eval()
+
+    sampler = RejectionSampler(
+        model,
+        tokenizer,
+        scorer=RewardScorer(
+            reward_model,
+            reward_tokenizer,
+            max_batch_size=args.prompt_batch_size * args.num_samples,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+        ),
+        generation_config=GenerationConfig(
+            max_new_tokens=args.max_new_tokens,
+            temperature=args.temperature,
+            top_p=args.top_p,
+            do_sample=True,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        ),
+        num_samples=args.num_samples,
+    )
+
+    # The dataset removes duplicated prompts, so the shards are taken after the deduplication
+    dataset = PromptOnlyDataset(
+        path=args.prompt_datasets,
+        template=args.template,
+        tokenizer=tokenizer,
+        size=args.size,
+        split=args.split,
+        subset=args.subset,
+        data_files=args.data_files,
+        num_proc=args.num_proc,
+    )
+    raw_samples = dataset.raw_data.shard(num_shards=world_size, index=rank, contiguous=False)
+    raw_samples = raw_samples.select(range(num_finished, len(raw_samples)))
+
+    progress_bar = tqdm(
+        total=len(raw_samples),
+        desc='Rejection sampling',
+        unit='prompt',
+        disable=rank != 0,
+    )
+    start = time.perf_counter()
+    num_skipped = 0
+    with open(output_file, 'a', encoding='utf-8') as f, open(
+        skipped_file, 'a', encoding='utf-8'
+    ) as fskip:
+        for i in range(0, len(raw_samples), args.prompt_batch_size):
+            batch = [
+                raw_samples[j] for j in range(i, min(i + args.prompt_batch_size, len(raw_samples)))
+            ]
+            prompts = [dataset.template.format_prompt_only_sample(sample)['text'] for sample in batch]
+            prompts = [
+                tokenizer.eos_token.join(prompt) if isinstance(prompt, list) else prompt
+                for prompt in prompts
+            ]
+            lines, skipped_lines = [], []
+            for sample, (responses, rewards) in zip(batch, sampler(prompts)):
+                pair = make_pair(sample, responses, rewards, args.save_candidates)
+                if pair is not None:
+                    lines.append(json.dumps(pair, ensure_ascii=False, default=str) + '\n')
+                    continue
+                # Unpaired prompts are recorded so that a restart does not sample them again.
+                skipped = {**sample, 'candidate_rewards': rewards}
+                if args.save_candidates:
+                    skipped['candidates'] = responses
+                skipped_lines.append(json.dumps(skipped, ensure_ascii=False, default=str) + '\n')
+            f.write(''.join(lines))
+            fskip.write(''.join(skipped_lines))
+            f.flush()
+            fskip.flush()
+            os.fsync(f.fileno())
+            os.fsync(fskip.fileno())
+            # Both files are complete up to here, lines written after a crash are dropped.
+            progress['num_prompts'] += len(batch)
+            progress['num_pairs'] += len(lines)
+            progress['num_skipped'] += len(skipped_lines)
+            save_progress(progress_file, progress)
+            num_skipped += len(skipped_lines)
+            progress_bar.update(len(batch))
+    progress_bar.close()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f'[rank {rank}] sampled {len(raw_samples)} prompts ({num_finished} resumed, '
+        f'{num_skipped} without a preference) in {elapsed:.1f} s -> {output_file}',
+    )
+
+
+if __name__ == '__main__':
+    main()
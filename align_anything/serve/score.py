@@ -0,0 +1,312 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Score a jsonl or parquet dataset offline with a trained reward model.
+
+Launch it with `torchrun --nproc_per_node <N>` to shard the samples over the ranks, every rank
+writes its own `scores-<rank>-of-<world_size>.jsonl` and resumes from it when restarted.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Iterator
+
+import torch
+from tqdm import tqdm
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from transformers.utils import is_torch_bf16_gpu_available
+
+from align_anything.models.pretrained_model_with_value import load_pretrained_model_with_value_head
+from align_anything.utils.multi_process import get_current_device
+from align_anything.utils.template_registry import get_template_class
+from align_anything.utils.tools import right_padding, str2bool
+
+
+__all__ = ['RewardScorer', 'read_records']
+
+
+def read_records(path: str | os.PathLike) -> Iterator[dict[str, Any]]:
+    """Stream the records of a jsonl or parquet file without loading it at once."""
+    if str(path).endswith('.parquet'):
+        import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=1024):
+            yield from record_batch.to_pylist()
+        return
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def count_finished_records(path: str | os.PathLike) -> int:
+    """Count the complete lines of a partial output file, dropping a trailing partial line."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    return data.count(b'\n', 0, end)
+
+
+def format_texts(
+    record: dict[str, Any],
+    template: Any | None,
+    text_key: str,
+    eos_token: str,
+) -> dict[str, str]:
+    """Map the score names of a record to the texts to score, ending with EOS like in training."""
+
+    def finish(text: str | list[str]) -> str:
+        if isinstance(text, list):
+            return eos_token.join(text)
+        return text if text.endswith(eos_token) else text + eos_token
+
+    if template is None:
+        return {'score': finish(record[text_key])}
+    formatted = template.format_sample(record)
+    if isinstance(formatted, str):
+        return {'score': finish(formatted)}
+    if 'better_text' in formatted:
+        return {
+            'better_score': finish(formatted['better_text']),
+            'worse_score': finish(formatted['worse_text']),
+        }
+    return {'score': finish(formatted['text'])}
+
+
+class RewardScorer:
+    """Compute the end scores of texts in length-bucketed batches.
+
+    Texts are sorted by token length and packed into batches of at most `max_tokens_per_batch`
+    padded tokens, so short texts are batched wide and little compute is spent on padding.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerBase,
+        max_batch_size: int = 64,
+        max_tokens_per_batch: int = 32768,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.device = next(model.parameters()).device
+
+    def buckets(self, lengths: list[int]) -> Iterator[list[int]]:
+        order = sorted(range(len(lengths)), key=lengths.__getitem__)
+        bucket: list[int] = []
+        for index in order:
+            # Sorted ascending, so the new text is the longest of the bucket
+            if bucket and (
+                len(bucket) >= self.max_batch_size
+                or (len(bucket) + 1) * lengths[index] > self.max_tokens_per_batch
+            ):
+                yield bucket
+                bucket = []
+            bucket.append(index)
+        if bucket:
+            yield bucket
+
+    @torch.inference_mode()
+    def score(self, texts: list[str]) -> list[float | list[float]]:
+        """Return the end score of every text, a list when the score head is multi-dimensional."""
+        input_ids = self.tokenizer(
+            texts,
+            add_special_tokens=True,
+            truncation=True,
+            max_length=self.tokenizer.model_max_length,
+        )['input_ids']
+        scores: list[Any] = [None] * len(texts)
+        for bucket in self.buckets([len(ids) for ids in input_ids]):
+            batch_input_ids = right_padding(
+                [torch.tensor(input_ids[index], dtype=torch.long) for index in bucket],
+                padding_value=self.tokenizer.pad_token_id,
+            ).to(self.device, non_blocking=True)
+            attention_mask = right_padding(
+                [torch.ones(len(input_ids[index]), dtype=torch.bool) for index in bucket],
+                padding_value=0,
+            ).to(self.device, non_blocking=True)
+            end_scores = self.model(
+                input_ids=batch_input_ids,
+                attention_mask=attention_mask,
+            ).end_scores.float()  # size = (B, D)
+            if end_scores.size(-1) == 1:
+                end_scores = end_scores.squeeze(dim=-1)
+            for index, end_score in zip(bucket, end_scores.tolist()):
+                scores[index] = end_score
+        return scores
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Score a dataset with a reward model.')
+    parser.add_argument(
+        '--model_name_or_path',
+        type=str,
+        required=True,
+        help='Path to the reward model checkpoint or its name.',
+    )
+    parser.add_argument(
+        '--input',
+        type=str,
+        required=True,
+        help='A jsonl or parquet file of the samples to score.',
+    )
+    parser.add_argument('--output_dir', type=str, required=True, help='Where to write the scores.')
+    parser.add_argument(
+        '--template',
+        type=str,
+        default=None,
+        help='Template formatting the samples, preference templates score both responses.',
+    )
+    parser.add_argument(
+        '--text_key',
+        type=str,
+        default='text',
+        help='Field holding the formatted text to score when no template is given.',
+    )
+    parser.add_argument('--max_length', type=int, default=2048, help='Truncation length.')
+    parser.add_argument('--max_batch_size', type=int, default=64, help='Maximum batch size.')
+    parser.add_argument(
+        '--max_tokens_per_batch',
+        type=int,
+        default=32768,
+        help='Maximum number of padded tokens of a batch.',
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=4096,
+        help='Samples sorted into length buckets together, and written out together.',
+    )
+    parser.add_argument(
+        '--keep_fields',
+        type=str2bool,
+        default=True,
+        help='Copy the fields of the input samples to the output, otherwise only their index.',
+    )
+    parser.add_argument(
+        '--resume',
+        type=str2bool,
+        default=True,
+        help='Continue after the samples already in the output files.',
+    )
+    parser.add_argument(
+        '--bf16',
+        type=str2bool,
+        default=True,
+        help='Whether to use bfloat16 precision.',
+    )
+    parser.add_argument(
+        '--trust_remote_code',
+        type=str2bool,
+        default=True,
+        help='Whether to trust remote code.',
+    )
+
+    args = parser.parse_args()
+    if args.bf16 and torch.cuda.is_available() and not is_torch_bf16_gpu_available():
+        parser.error('bf16 precision is not supported on this GPU, please disable `--bf16`.')
+    return args
+
+
+def main(args: argparse.Namespace | None = None) -> None:
+    if args is None:
+        args = parse_arguments()
+
+    rank = int(os.environ.get('RANK', '0'))
+    world_size = int(os.environ.get('WORLD_SIZE', '1'))
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file = os.path.join(
+        args.output_dir,
+        f'scores-{rank:05d}-of-{world_size:05d}.jsonl',
+    )
+    if not args.resume and os.path.exists(output_file):
+        os.remove(output_file)
+    num_finished = count_finished_records(output_file)
+
+    model, tokenizer, _ = load_pretrained_model_with_value_head(
+        args.model_name_or_path,
+        model_max_length=args.max_length,
+        padding_side='right',
+        dtype=torch.bfloat16 if args.bf16 else 'auto',
+        trust_remote_code=args.trust_remote_code,
+    )
+    model.to(get_current_device()).eval()
+    scorer = RewardScorer(
+        model,
+        tokenizer,
+        max_batch_size=args.max_batch_size,
+        max_tokens_per_batch=args.max_tokens_per_batch,
+    )
+    template = get_template_class(args.template) if args.template is not None else None
+
+    progress_bar = tqdm(desc='Scoring', unit='sample', disable=rank != 0)
+    num_scored = 0
+    start = time.perf_counter()
+
+    def flush(chunk: list[tuple[int, dict[str, Any]]], f: Any) -> None:
+        texts = [
+            format_texts(record, template, args.text_key, tokenizer.eos_token)
+            for _, record in chunk
+        ]
+        flat_texts = [text for sample_texts in texts for text in sample_texts.values()]
+        flat_scores = iter(scorer.score(flat_texts))
+        lines = []
+        for (index, record), sample_texts in zip(chunk, texts):
+            output = dict(record) if args.keep_fields else {'index': index}
+            output.update({name: next(flat_scores) for name in sample_texts})
+            lines.append(json.dumps(output, ensure_ascii=False, default=str) + '\n')
+        f.write(''.join(lines))
+        f.flush()
+        progress_bar.update(len(chunk))
+
+    with open(output_file, 'a', encoding='utf-8') as f:
+        chunk: list[tuple[int, dict[str, Any]]] = []
+        num_local = 0
+        for index, record in enumerate(read_records(args.input)):
+            if index % world_size != rank:
+                continue
+            num_local += 1
+            if num_local <= num_finished:
+                continue
+            chunk.append((index, record))
+            if len(chunk) >= args.chunk_size:
+                flush(chunk, f)
+                num_scored += len(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk, f)
+            num_scored += len(chunk)
+    progress_bar.close()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f'[rank {rank}] scored {num_scored} samples ({num_finished} resumed) in {elapsed:.1f} s, '
+        f'{3600.0 * num_scored / max(elapsed, 1e-6):.0f} samples/hour -> {output_file}',
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,594 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""OpenAI-compatible inference server with dynamic request batching."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, PreTrainedTokenizerBase
+from transformers.generation.streamers import BaseStreamer
+from transformers.utils import is_torch_bf16_gpu_available
+
+from align_anything.models.pretrained_model import load_pretrained_models
+from align_anything.serve.engine import (
+    ContinuousBatchingEngine,
+    GenerationRequest,
+    ServerMetrics,
+    decode_delta,
+    emit_text_delta,
+    truncate_at_stop,
+)
+from align_anything.utils.template_registry import get_template_class
+from align_anything.utils.tools import str2bool
+
+
+__all__ = [
+    'GenerationRequest',
+    'BatchScheduler',
+    'ServerMetrics',
+    'format_chat_prompt',
+    'make_server',
+]
+
+
+class RequestStoppingLogitsProcessor(LogitsProcessor):
+    """Force EOS on the rows that reached their own token budget or a stop string.
+
+    `generate` then finishes these rows individually while the others keep decoding.
+    """
+
+    def __init__(
+        self,
+        requests: list[GenerationRequest],
+        prompt_length: int,
+        tokenizer: PreTrainedTokenizerBase,
+        eos_token_id: int,
+        stop_window: int = 16,
+    ) -> None:
+        self.requests = requests
+        self.prompt_length = prompt_length
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.stop_window = stop_window
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        num_generated = input_ids.size(-1) - self.prompt_length
+        for i, request in enumerate(self.requests):
+            should_stop = num_generated >= request.max_new_tokens
+            if not should_stop and request.stop and num_generated > 0:
+                tail = self.tokenizer.decode(
+                    input_ids[i, -min(num_generated, self.stop_window) :],
+                    skip_special_tokens=True,
+                )
+                should_stop = truncate_at_stop(tail, request.stop)[1]
+            if should_stop:
+                scores[i] = float('-inf')
+                scores[i, self.eos_token_id] = 0.0
+        return scores
+
+
+class BatchStreamer(BaseStreamer):
+    """Split the tokens of a batched `generate` call into per-request text deltas."""
+
+    def __init__(self, requests: list[GenerationRequest], tokenizer: PreTrainedTokenizerBase, eos_token_id: int) -> None:
+        self.requests = requests
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.skip_prompt = True
+        self.token_ids = [[] for _ in requests]
+        self.texts = ['' for _ in requests]
+        self.offsets = [(0, 0) for _ in requests]
+        self.sent = ['' for _ in requests]
+        self.finished = [False for _ in requests]
+
+    def put(self, value: torch.Tensor) -> None:
+        if self.skip_prompt:
+            self.skip_prompt = False
+            return
+        for i, token_id in enumerate(value.view(-1).tolist()):
+            if self.finished[i]:
+                continue
+            if token_id == self.eos_token_id:
+                self.finished[i] = True
+                continue
+            self.token_ids[i].append(token_id)
+            if not self.requests[i].stream:
+                continue
+            delta, prefix_offset, read_offset = decode_delta(
+                self.tokenizer,
+                self.token_ids[i],
+                *self.offsets[i],
+            )
+            self.offsets[i] = (prefix_offset, read_offset)
+            self.texts[i] += delta
+            self.sent[i] = emit_text_delta(self.requests[i], self.texts[i], self.sent[i])
+
+    def end(self) -> None:
+        pass
+
+
+class BatchScheduler:
+    """Merge concurrent requests into batched, left-padded `generate` calls."""
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        tokenizer: PreTrainedTokenizerBase,
+        max_batch_size: int = 8,
+        max_wait_time: float = 0.01,
+        metrics: ServerMetrics | None = None,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.tokenizer.padding_side = 'left'
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.queue: queue.Queue[GenerationRequest] = queue.Queue()
+        # Requests that could not join the current batch because of their sampling parameters.
+        self.deferred: list[GenerationRequest] = []
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() + len(self.deferred)
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        self.queue.put(request)
+        return request
+
+    def close(self) -> None:
+        """Stop the scheduler thread once the submitted requests are finished."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def next_batch(self) -> list[GenerationRequest]:
+        if self.deferred:
+            first = self.deferred.pop(0)
+        else:
+            first = self.queue.get()
+        if first is None:
+            return []
+        batch, deferred = [first], []
+        for request in self.deferred:
+            if len(batch) < self.max_batch_size and request.sampling_key == first.sampling_key:
+                batch.append(request)
+            else:
+                deferred.append(request)
+        self.deferred = deferred
+
+        deadline = time.perf_counter() + self.max_wait_time
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Close after the requests that are still deferred.
+                self.queue.put(None)
+                break
+            if request.sampling_key == first.sampling_key:
+                batch.append(request)
+            else:
+                self.deferred.append(request)
+        return batch
+
+    def loop(self) -> None:
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            try:
+                self.run_batch(batch)
+            except Exception as ex:  # pylint: disable=broad-except
+                for request in batch:
+                    request.outputs.put(('error', f'{type(ex).__name__}: {ex}'))
+
+    @torch.no_grad()
+    def run_batch(self, requests: list[GenerationRequest]) -> None:
+        start = time.perf_counter()
+        eos_token_id = self.tokenizer.eos_token_id
+        tokenized = self.tokenizer(
+            [request.prompt for request in requests],
+            padding=True,
+            return_token_type_ids=False,
+            return_tensors='pt',
+        ).to(self.model.device)
+        prompt_length = tokenized['input_ids'].size(-1)
+        temperature, top_p = requests[0].sampling_key
+
+        streamer = BatchStreamer(requests, self.tokenizer, eos_token_id)
+        self.model.generate(
+            **tokenized,
+            do_sample=temperature > 0.0,
+            temperature=temperature if temperature > 0.0 else None,
+            top_p=top_p if temperature > 0.0 else None,
+            max_new_tokens=max(request.max_new_tokens for request in requests),
+            logits_processor=LogitsProcessorList(
+                [RequestStoppingLogitsProcessor(requests, prompt_length, self.tokenizer, eos_token_id)],
+            ),
+            streamer=streamer,
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_id=eos_token_id,
+        )
+
+        num_generated = 0
+        for i, request in enumerate(requests):
+            token_ids = streamer.token_ids[i]
+            text, stopped = truncate_at_stop(
+                self.tokenizer.decode(token_ids, skip_special_tokens=True),
+                request.stop,
+            )
+            finished_by_length = not stopped and len(token_ids) >= request.max_new_tokens
+            num_generated += len(token_ids)
+            if request.stream and len(text) > len(streamer.sent[i]):
+                request.outputs.put(('delta', text[len(streamer.sent[i]) :]))
+            request.outputs.put((
+                'done',
+                {
+                    'text': text,
+                    'finish_reason': 'length' if finished_by_length else 'stop',
+                    'prompt_tokens': int(tokenized['attention_mask'][i].sum().item()),
+                    'completion_tokens': len(token_ids),
+                },
+            ))
+
+        self.metrics.batch_finished(
+            len(requests),
+            int(tokenized['attention_mask'].sum().item()),
+            num_generated,
+            time.perf_counter() - start,
+        )
+
+
+def format_chat_prompt(template: Any, messages: list[dict[str, str]], eos_token: str) -> str:
+    """Build the prompt of a conversation the same way as the interactive `Chatbot`."""
+    dialogue = template.system_prompt
+    pending_input = None
+    for message in messages:
+        role, content = message['role'], message.get('content') or ''
+        if role == 'system':
+            dialogue = content
+        elif role == 'user':
+            pending_input = content if pending_input is None else f'{pending_input}\n{content}'
+        elif role == 'assistant':
+            raw_sample = {'instruction': '', 'input': pending_input or '', 'output': content}
+            dialogue += template.format_sample(raw_sample)['text'] + eos_token
+            pending_input = None
+    raw_sample = {'instruction': '', 'input': pending_input or '', 'output': ''}
+    return dialogue + template.format_sample(raw_sample)['prompt']
+
+
+class ServerState:
+    """Everything the request handlers share."""
+
+    def __init__(
+        self,
+        model_name: str,
+        scheduler: BatchScheduler | ContinuousBatchingEngine,
+        template: Any,
+        default_max_tokens: int = 512,
+    ) -> None:
+        self.model_name = model_name
+        self.scheduler = scheduler
+        self.template = template
+        self.default_max_tokens = default_max_tokens
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handle the OpenAI-compatible endpoints."""
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def state(self) -> ServerState:
+        return self.server.state  # type: ignore[attr-defined]
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+    def send_json(self, status: int, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, payload: dict[str, Any] | str) -> None:
+        data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+        self.wfile.write(f'data: {data}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.path == '/metrics':
+            self.send_json(200, self.state.scheduler.metrics.summary(self.state.scheduler.queue_depth))
+        elif self.path == '/v1/models':
+            self.send_json(
+                200,
+                {'object': 'list', 'data': [{'id': self.state.model_name, 'object': 'model'}]},
+            )
+        else:
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        if self.path not in {'/v1/completions', '/v1/chat/completions'}:
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            chat = self.path == '/v1/chat/completions'
+            if chat:
+                prompt = format_chat_prompt(
+                    self.state.template,
+                    body['messages'],
+                    self.state.scheduler.tokenizer.eos_token,
+                )
+            else:
+                prompt = body['prompt']
+                if isinstance(prompt, list):
+                    if len(prompt) != 1:
+                        raise ValueError('Only a single prompt per request is supported.')
+                    prompt = prompt[0]
+            stop = body.get('stop') or []
+            request = GenerationRequest(
+                prompt=prompt,
+                max_new_tokens=int(body.get('max_tokens') or self.state.default_max_tokens),
+                temperature=float(body.get('temperature', 1.0)),
+                top_p=float(body.get('top_p', 1.0)),
+                stop=[stop] if isinstance(stop, str) else list(stop),
+                stream=bool(body.get('stream', False)),
+            )
+        except (KeyError, ValueError, TypeError) as ex:
+            self.send_json(400, {'error': {'message': f'Invalid request: {ex}'}})
+            return
+
+        metrics = self.state.scheduler.metrics
+        metrics.request_started()
+        try:
+            self.state.scheduler.submit(request)
+            if request.stream:
+                self.stream_response(request, chat)
+            else:
+                self.complete_response(request, chat)
+        finally:
+            metrics.request_finished()
+
+    def make_payload(self, response_id: str, chat: bool, choice: dict[str, Any], chunk: bool) -> dict[str, Any]:
+        if chat:
+            obj = 'chat.completion.chunk' if chunk else 'chat.completion'
+        else:
+            obj = 'text_completion'
+        return {
+            'id': response_id,
+            'object': obj,
+            'created': int(time.time()),
+            'model': self.state.model_name,
+            'choices': [{'index': 0, **choice}],
+        }
+
+    def complete_response(self, request: GenerationRequest, chat: bool) -> None:
+        kind, result = request.outputs.get()
+        while kind == 'delta':
+            kind, result = request.outputs.get()
+        if kind == 'error':
+            self.send_json(500, {'error': {'message': result}})
+            return
+        choice = (
+            {'message': {'role': 'assistant', 'content': result['text']}}
+            if chat
+            else {'text': result['text']}
+        )
+        payload = self.make_payload(
+            f'{"chatcmpl" if chat else "cmpl"}-{uuid.uuid4().hex}',
+            chat,
+            {**choice, 'finish_reason': result['finish_reason']},
+            chunk=False,
+        )
+        payload['usage'] = {
+            'prompt_tokens': result['prompt_tokens'],
+            'completion_tokens': result['completion_tokens'],
+            'total_tokens': result['prompt_tokens'] + result['completion_tokens'],
+        }
+        self.send_json(200, payload)
+
+    def stream_response(self, request: GenerationRequest, chat: bool) -> None:
+        response_id = f'{"chatcmpl" if chat else "cmpl"}-{uuid.uuid4().hex}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        if chat:
+            self.send_event(
+                self.make_payload(response_id, chat, {'delta': {'role': 'assistant'}, 'finish_reason': None}, chunk=True),
+            )
+        while True:
+            kind, result = request.outputs.get()
+            if kind == 'error':
+                self.send_event({'error': {'message': result}})
+                break
+            if kind == 'delta':
+                choice = {'delta': {'content': result}} if chat else {'text': result}
+                self.send_event(self.make_payload(response_id, chat, {**choice, 'finish_reason': None}, chunk=True))
+                continue
+            choice = {'delta': {}} if chat else {'text': ''}
+            self.send_event(
+                self.make_payload(response_id, chat, {**choice, 'finish_reason': result['finish_reason']}, chunk=True),
+            )
+            break
+        self.send_event('[DONE]')
+
+
+def make_server(
+    model_name_or_path: str | os.PathLike,
+    host: str = '127.0.0.1',
+    port: int = 8000,
+    template: str = 'Dialogue',
+    max_batch_size: int = 8,
+    max_wait_time: float = 0.01,
+    max_length: int = 512,
+    dtype: torch.dtype | str | None = 'auto',
+    engine: str = 'batch',
+    max_kv_tokens: int | None = None,
+) -> ThreadingHTTPServer:
+    """Load the model and build a server; call `serve_forever` to start it."""
+    model, tokenizer, _ = load_pretrained_models(
+        model_name_or_path,
+        model_max_length=max_length,
+        padding_side='left',
+        auto_device_mapping=torch.cuda.is_available(),
+        dtype=dtype,
+        trust_remote_code=True,
+    )
+    model.eval()
+    if engine == 'continuous':
+        scheduler = ContinuousBatchingEngine(
+            model,
+            tokenizer,
+            max_batch_size=max_batch_size,
+            max_tokens=max_kv_tokens,
+        )
+    elif engine == 'batch':
+        scheduler = BatchScheduler(
+            model,
+            tokenizer,
+            max_batch_size=max_batch_size,
+            max_wait_time=max_wait_time,
+        )
+    else:
+        raise ValueError(f'Unknown engine: {engine}')
+
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.state = ServerState(  # type: ignore[attr-defined]
+        model_name=os.path.basename(os.path.normpath(model_name_or_path)),
+        scheduler=scheduler,
+        template=get_template_class(template),
+        default_max_tokens=max_length,
+    )
+    return server
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Serve a model with an OpenAI-compatible API.')
+    parser.add_argument(
+        '--model_name_or_path',
+        type=str,
+        required=True,
+        help='Path to the model checkpoint or its name.',
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='The host to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='The port to listen on.')
+    parser.add_argument('--template', type=str, default='Dialogue', help='Model template')
+    parser.add_argument(
+        '--max_length',
+        type=int,
+        default=512,
+        help='Default maximum number of generated tokens of a request.',
+    )
+    parser.add_argument(
+        '--max_batch_size',
+        type=int,
+        default=8,
+        help='Maximum number of requests merged into one generation call.',
+    )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        choices=['batch', 'continuous'],
+        default='batch',
+        help='Merge requests into whole `generate` calls, or batch them at token boundaries.',
+    )
+    parser.add_argument(
+        '--max_kv_tokens',
+        type=int,
+        default=None,
+        help='Key-value cache budget of the continuous engine, sized from free memory by default.',
+    )
+    parser.add_argument(
+        '--max_wait_time',
+        type=float,
+        default=0.01,
+        help='Seconds to wait for more requests before running a batch.',
+    )
+    parser.add_argument(
+        '--fp16',
+        type=str2bool,
+        default=False,
+        help='Whether to use float16 precision.',
+    )
+    parser.add_argument(
+        '--bf16',
+        type=str2bool,
+        default=False,
+        help='Whether to use bfloat16 precision.',
+    )
+
+    args = parser.parse_args()
+    if args.fp16 and args.bf16:
+        parser.error('Cannot use both bf16 and fp16 precision.')
+    if args.bf16 and not is_torch_bf16_gpu_available():
+        parser.error(
+            'bf16 precision is not supported on this GPU. '
+            'Please disable `--bf16` flag or use another precision flag (e.g., `--fp16`).',
+        )
+    return args
+
+
+def main(args: argparse.Namespace | None = None) -> None:
+    if args is None:
+        args = parse_arguments()
+
+    server = make_server(
+        args.model_name_or_path,
+        host=args.host,
+        port=args.port,
+        template=args.template,
+        max_batch_size=args.max_batch_size,
+        max_wait_time=args.max_wait_time,
+        max_length=args.max_length,
+        dtype=(torch.bfloat16 if args.bf16 else (torch.float16 if args.fp16 else 'auto')),
+        engine=args.engine,
+        max_kv_tokens=args.max_kv_tokens,
+    )
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,7 @@
 
 
 import argparse
+import itertools
 import os
 import sys
 from datetime import datetime
@@ -33,12 +34,14 @@ from transformers import CONFIG_NAME, AutoModelForCausalLM, PreTrainedModel, get
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
 from align_anything.datasets.preference import PreferenceBatch, PreferenceDataset
+from align_anything.datasets.streaming import StreamingPreferenceDataset
 from align_anything.models.pretrained_model import load_pretrained_models
 from align_anything.utils.logger import Logger
 from align_anything.utils.multi_process import (
     get_all_reduce_mean,
     get_current_device,
     is_main_process,
+    main_process_first,
 )
 from align_anything.utils.tools import (
     custom_cfgs_to_dict,
@@ -67,7 +70,8 @@ class DPOTrainer:
         dist.barrier()
         self.init_models()
         dist.barrier()
-        self.init_datasets()
+        with main_process_first():
+            self.init_datasets()
         dist.barrier()
         self.init_engines()
         dist.barrier()
@@ -113,7 +117,19 @@ class DPOTrainer:
 
     def init_datasets(self) -> None:
         """Initialize training and evaluation datasets."""
-        train_dataset = PreferenceDataset(
+        dataset_class = (
+            StreamingPreferenceDataset if self.cfgs.data_cfgs.train_streaming else PreferenceDataset
+        )
+        # The streaming dataset deals the samples to the workers in whole batches
+        streaming_kwargs = (
+            {
+                'seed': self.cfgs.train_cfgs.seed,
+                'batch_size': self.cfgs.train_cfgs.per_device_train_batch_size,
+            }
+            if self.cfgs.data_cfgs.train_streaming
+            else {}
+        )
+        train_dataset = dataset_class(
             path=self.cfgs.data_cfgs.train_datasets,
             template=self.cfgs.data_cfgs.train_template,
             tokenizer=self.tokenizer,
@@ -122,11 +138,16 @@ class DPOTrainer:
             split=self.cfgs.data_cfgs.train_split,
             subset=self.cfgs.data_cfgs.train_subset,
             data_files=self.cfgs.data_cfgs.train_data_files,
+            **streaming_kwargs,
         )
         self.train_dataloader = DataLoader(
             train_dataset,
             collate_fn=train_dataset.get_collator(),
-            sampler=DistributedSampler(train_dataset, shuffle=True),
+            sampler=(
+                None
+                if self.cfgs.data_cfgs.train_streaming
+                else DistributedSampler(train_dataset, shuffle=True)
+            ),
             batch_size=self.cfgs.train_cfgs.per_device_train_batch_size,
         )
         if self.cfgs.data_cfgs.eval_datasets:
@@ -189,6 +210,18 @@ class DPOTrainer:
         if self.cfgs.train_cfgs.gradient_checkpointing:
             self.model.gradient_checkpointing_enable()
 
+        if self.cfgs.train_cfgs.resume_from_checkpoint:
+            load_path, client_state = self.model.load_checkpoint(
+                self.cfgs.train_cfgs.resume_from_checkpoint,
+            )
+            if load_path is None:
+                raise ValueError(
+                    f'No checkpoint found in {self.cfgs.train_cfgs.resume_from_checkpoint}.',
+                )
+            self.global_step = client_state['global_step']
+            if self.cfgs.data_cfgs.train_streaming:
+                self.train_dataloader.dataset.load_state_dict(client_state['train_dataset'])
+
     @staticmethod
     def compute_log_probs(
         model: AutoModelForCausalLM,
@@ -333,12 +366,26 @@ class DPOTrainer:
             self.logger.print('\n***** Evaluating at the beginning *****')
             self.logger.log(self.eval(), step=0)
 
-        for epoch in range(self.cfgs.train_cfgs.epochs):
+        # A resumed training starts in the middle of an epoch
+        start_epoch, start_step = divmod(self.global_step, len(self.train_dataloader))
+        progress_bar.update(self.global_step)
+        for epoch in range(start_epoch, self.cfgs.train_cfgs.epochs):
             self.model.train()
 
-            for batch in self.train_dataloader:
+            train_dataloader = self.train_dataloader
+            if self.cfgs.data_cfgs.train_streaming:
+                # The streaming dataset skips the samples it has recorded as consumed
+                train_dataloader.dataset.set_epoch(epoch)
+            elif epoch == start_epoch:
+                train_dataloader = itertools.islice(train_dataloader, start_step, None)
+
+            for batch in train_dataloader:
                 info = self.train_step(batch)
                 torch.cuda.empty_cache()
+                if self.cfgs.data_cfgs.train_streaming:
+                    train_dataloader.dataset.consume(
+                        self.cfgs.train_cfgs.per_device_train_batch_size,
+                    )
 
                 self.global_step += 1
                 progress_bar.set_description(
@@ -395,6 +442,17 @@ class DPOTrainer:
         save_file_name = f'pytorch_model_{tag}.bin' if tag else 'pytorch_model.bin'
         model.save_16bit_model(self.cfgs.logger_cfgs.output_dir, save_filename=save_file_name)
 
+        if tag is not None and self.cfgs.logger_cfgs.save_checkpoint:
+            self.logger.print('Saving DeepSpeed checkpoint...')
+            client_state = {'global_step': self.global_step}
+            if self.cfgs.data_cfgs.train_streaming:
+                client_state['train_dataset'] = self.train_dataloader.dataset.state_dict()
+            model.save_checkpoint(
+                os.path.join(self.cfgs.logger_cfgs.output_dir, 'checkpoints'),
+                tag=f'global_step{tag}',
+                client_state=client_state,
+            )
+
         self.logger.print('Model saved!')
 
 
@@ -36,24 +36,195 @@ from align_anything.datasets.preference import PreferenceBatch, PreferenceDatase
 from align_anything.models.pretrained_model import load_pretrained_models
 from align_anything.utils.logger import Logger
 from align_anything.utils.multi_process import (
+    get_all_reduce_max,
     get_all_reduce_mean,
     get_current_device,
     is_main_process,
+    main_process_first,
 )
 from align_anything.utils.tools import (
     custom_cfgs_to_dict,
     dict_to_namedtuple,
     gather_log_probabilities,
     get_optimizer_grouped_parameters,
+    masked_mean,
     namedtuple_to_dict,
     prepare_ds_eval_cfgs,
     prepare_ds_train_cfgs,
     read_cfgs,
+    response_span_log_probs,
     seed_everything,
     update_dict,
 )
 
 
+def kto_losses(
+    log_ratio: torch.Tensor,  # size = (N,)
+    desirable: torch.BoolTensor,  # size = (N,)
+    kl: torch.Tensor | float,
+    scale_coeff: float,
+    scale_better: float,
+    scale_worse: float,
+) -> torch.Tensor:  # size = (N,)
+    """Per-sample KTO loss, `desirable` selects the term of the better samples of the pairs."""
+    better_losses = -scale_better * F.sigmoid(scale_coeff * (log_ratio - kl))
+    worse_losses = -scale_worse * F.sigmoid(scale_coeff * (kl - log_ratio))
+    return torch.where(desirable, better_losses, worse_losses)
+
+
+def kto_loss(  # pylint: disable=too-many-arguments,too-many-locals
+    sequence_log_probs: torch.Tensor,  # size = (2 * B, L - 1)
+    ref_sequence_log_probs: torch.Tensor,  # size = (2 * B, L - 1)
+    input_ids: torch.LongTensor,  # size = (2 * B, L)
+    attention_mask: torch.BoolTensor,  # size = (2 * B, L)
+    kl: torch.Tensor | float,
+    scale_coeff: float,
+    scale_better: float,
+    scale_worse: float,
+) -> dict[str, torch.Tensor]:
+    """KTO loss and rewards of a batch of pairs, the better responses come first.
+
+    Pairs whose responses are identical have no response span and are left out of the loss and
+    the reward accuracy.
+    """
+    log_probs, _, valid = response_span_log_probs(  # size = (2 * B,)
+        sequence_log_probs,
+        input_ids,
+        attention_mask,
+    )
+    ref_log_probs, _, _ = response_span_log_probs(  # size = (2 * B,)
+        ref_sequence_log_probs,
+        input_ids,
+        attention_mask,
+    )
+    log_ratio = log_probs - ref_log_probs  # size = (2 * B,)
+    batch_size = valid.size(0)
+    desirable = torch.arange(2 * batch_size, device=log_ratio.device) < batch_size
+    losses = kto_losses(
+        log_ratio,
+        desirable,
+        kl,
+        scale_coeff=scale_coeff,
+        scale_better=scale_better,
+        scale_worse=scale_worse,
+    )  # size = (2 * B,)
+    better_losses, worse_losses = losses.chunk(chunks=2, dim=0)
+    loss = ((better_losses + worse_losses) * valid).sum() / valid.sum().clamp(min=1)  # size = ()
+
+    better_log_ratio, worse_log_ratio = log_ratio.detach().chunk(chunks=2, dim=0)
+    better_sample_reward = scale_coeff * better_log_ratio  # size = (B,)
+    worse_sample_reward = scale_coeff * worse_log_ratio  # size = (B,)
+    reward = better_sample_reward + worse_sample_reward  # size = (B,)
+    reward_accuracy = masked_mean(
+        (better_sample_reward > worse_sample_reward).float(),
+        valid,
+    )  # size = ()
+    reward_margin = better_sample_reward - worse_sample_reward  # size = (B,)
+
+    return {
+        'loss': loss,
+        'reward': reward,
+        'better_sample_reward': better_sample_reward,
+        'worse_sample_reward': worse_sample_reward,
+        'reward_accuracy': reward_accuracy,
+        'reward_margin': reward_margin,
+        'valid': valid,
+    }
+
+
+class KLEstimator:
+    """Running estimate of the KL divergence between the policy and the reference model.
+
+    KTO estimates the KL term on mismatched (prompt, response) pairs. The pairs are built once,
+    every update only looks at `num_batches` batches, and the estimates are smoothed with an
+    exponential moving average. The reference model is frozen, so the log probabilities of
+    every pair under it are computed once and cached.
+    """
+
+    def __init__(
+        self,
+        dataset: RandomPreferenceDataset,
+        batch_size: int,
+        num_batches: int = 4,
+        ema_decay: float = 0.9,
+        seed: int = 0,
+    ) -> None:
+        self.dataset = dataset
+        self.collator = dataset.get_collator()
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.ema_decay = ema_decay
+        # The sampler pads the shard of every rank to the same size, so all ranks run the same
+        # number of forward passes, which ZeRO-3 requires.
+        self.sampler = DistributedSampler(dataset, shuffle=True, seed=seed)
+        self.epoch = 0
+        self.indices = iter(())
+        self.ref_log_probs: dict[int, float] = {}
+        self.value: torch.Tensor | None = None
+
+    def next_indices(self) -> list[int]:
+        """Cycle through the shard of this rank, reshuffled on every pass."""
+        indices = []
+        while len(indices) < self.batch_size:
+            try:
+                indices.append(next(self.indices))
+            except StopIteration:
+                self.sampler.set_epoch(self.epoch)
+                self.epoch += 1
+                self.indices = iter(list(self.sampler))
+        return indices
+
+    @staticmethod
+    def sequence_log_probs(model: AutoModelForCausalLM, batch: PreferenceBatch) -> torch.Tensor:
+        """Sum of the log probabilities of the non-padding tokens of each sequence."""
+        logits = model(**batch).logits
+        log_probs = gather_log_probabilities(logits[:, :-1], batch['input_ids'][:, 1:])
+        return (log_probs.float() * batch['attention_mask'][:, 1:]).sum(dim=-1)  # size = (B,)
+
+    @torch.no_grad()
+    def update(
+        self,
+        model: AutoModelForCausalLM,
+        reference_model: AutoModelForCausalLM,
+    ) -> torch.Tensor:
+        """Estimate the per-token KL on a few batches and fold it into the running estimate."""
+        device = get_current_device()
+        log_ratio_sum = torch.zeros((), device=device)
+        num_tokens = torch.zeros((), device=device)
+        for _ in range(self.num_batches):
+            indices = self.next_indices()
+            batch = self.collator([self.dataset[index] for index in indices])
+
+            # Under ZeRO-3 a forward pass gathers the parameters from all ranks, so either every
+            # rank runs the reference model or none does.
+            need_reference = torch.tensor(
+                float(any(index not in self.ref_log_probs for index in indices)),
+                device=device,
+            )
+            if get_all_reduce_max(need_reference).item() > 0:
+                ref_log_probs = self.sequence_log_probs(reference_model, batch)
+                self.ref_log_probs.update(zip(indices, ref_log_probs.tolist()))
+            ref_log_probs = torch.tensor(
+                [self.ref_log_probs[index] for index in indices],
+                device=device,
+            )
+
+            log_probs = self.sequence_log_probs(model, batch)
+            log_ratio_sum += (log_probs - ref_log_probs).sum()
+            num_tokens += batch['attention_mask'][:, 1:].sum()
+
+        if dist.is_initialized():
+            dist.all_reduce(log_ratio_sum, op=dist.ReduceOp.SUM)
+            dist.all_reduce(num_tokens, op=dist.ReduceOp.SUM)
+        estimate = log_ratio_sum / num_tokens.clamp(min=1)
+
+        if self.value is None:
+            self.value = estimate
+        else:
+            self.value = self.ema_decay * self.value + (1.0 - self.ema_decay) * estimate
+        return self.value.clamp(min=0.0)
+
+
 class KTOTrainer:
 
     def __init__(self, cfgs, ds_cfgs) -> None:
@@ -67,7 +238,8 @@ class KTOTrainer:
         dist.barrier()
         self.init_models()
         dist.barrier()
-        self.init_datasets()
+        with main_process_first():
+            self.init_datasets()
         dist.barrier()
         self.init_engines()
         dist.barrier()
@@ -148,6 +320,26 @@ class KTOTrainer:
             )
         self.split_token = train_dataset.template.split_token
 
+        random_dataset = RandomPreferenceDataset(
+            path=self.cfgs.data_cfgs.train_datasets,
+            template=self.cfgs.data_cfgs.template,
+            tokenizer=self.tokenizer,
+            processor=self.processor,
+            size=self.cfgs.data_cfgs.size,
+            split=self.cfgs.data_cfgs.train_split,
+            subset=self.cfgs.data_cfgs.subset,
+            data_files=self.cfgs.data_cfgs.data_files,
+        )
+        kl_num_batches = self.cfgs.train_cfgs.kl_num_batches
+        kl_ema_decay = self.cfgs.train_cfgs.kl_ema_decay
+        self.kl_estimator = KLEstimator(
+            random_dataset,
+            batch_size=self.cfgs.train_cfgs.per_device_kl_batch_size,
+            num_batches=kl_num_batches if kl_num_batches is not None else 4,
+            ema_decay=kl_ema_decay if kl_ema_decay is not None else 0.9,
+            seed=self.cfgs.train_cfgs.seed,
+        )
+
     def init_engines(self) -> None:
         """Initialize DeepSpeed engines."""
         num_update_steps_per_epoch = (
@@ -198,113 +390,37 @@ class KTOTrainer:
         logits = model(**batch).logits
         input_ids = batch['input_ids']
         return gather_log_probabilities(logits[:, :-1], input_ids[:, 1:])
-    def compute_kl(self):
-        random_dataset = RandomPreferenceDataset(
-            path=self.cfgs.data_cfgs.train_datasets,
-            template=self.cfgs.data_cfgs.template,
-            tokenizer=self.tokenizer,
-            processor=self.processor,
-            size=self.cfgs.data_cfgs.size,
-            split=self.cfgs.data_cfgs.train_split,
-            subset=self.cfgs.data_cfgs.subset,
-            data_files=self.cfgs.data_cfgs.data_files,
-        )
-        seed = torch.randint(0, 100000, (1,)).item()
-        torch.manual_seed(seed)
-        self.random_dataloader = DataLoader(
-            random_dataset,
-            collate_fn=random_dataset.get_collator(),
-            sampler=DistributedSampler(random_dataset, shuffle=True),
-            batch_size=self.cfgs.train_cfgs.per_device_kl_batch_size,
-        )
-        for batch in self.random_dataloader:
-            log_probs = self.compute_log_probs(  # size = (2 * B, L - 1)
-                self.model.module,
-                batch = batch,
-            )
-            ref_log_probs = self.compute_log_probs(  # size = (2 * B, L - 1)
-                self.reference_model.module,
-                batch = batch,
-            )
-            kl = (log_probs - ref_log_probs).mean()
 
-            self.kl = max(kl,0)
-             
-    def loss(  # pylint: disable=too-many-locals
+    def compute_kl(self) -> None:
+        """Update the KL estimate used as the reference point of the KTO loss."""
+        self.kl = self.kl_estimator.update(self.model.module, self.reference_model.module)
+
+    def loss(
         self,
         batch: PreferenceBatch,
     ) -> dict[str, torch.Tensor]:
         """Loss function for the KTO algorithm."""
-        sequence_log_probs = self.compute_log_probs(
+        sequence_log_probs = self.compute_log_probs(  # size = (2 * B, L - 1)
             self.model.module,
             batch,
         )
-        (
-            better_sequence_log_probs,  # size = (B, L - 1)
-            worse_sequence_log_probs,  # size = (B, L - 1)
-        ) = sequence_log_probs.chunk(chunks=2, dim=0)
 
         with torch.no_grad():
             ref_sequence_log_probs = self.compute_log_probs(  # size = (2 * B, L - 1)
                 self.reference_model.module,
                 batch,
             )
-            ref_better_sequence_log_probs, ref_worse_sequence_log_probs = (
-                ref_sequence_log_probs.chunk(chunks=2, dim=0)
-            )
-
-        losses = []
-        better_sample_rewards = []
-        worse_sample_rewards = []
-
-        better_input_ids, worse_input_ids = batch['input_ids'].chunk(chunks=2, dim=0)
-        better_attention_mask, worse_attention_mask = batch['attention_mask'].chunk(chunks=2, dim=0)
-
-        batch_size = better_input_ids.size(0)
-        for i in range(batch_size):
-            if torch.all(torch.eq(better_input_ids[i], worse_input_ids[i])).item():
-                continue
-            better_end_index = better_attention_mask[i].nonzero()[-1].squeeze().item()
-            worse_end_index = worse_attention_mask[i].nonzero()[-1].squeeze().item()
-            diverge_index = (
-                (better_input_ids[i] != worse_input_ids[i]).nonzero()[0].squeeze().item()
-            )
-            assert 0 <= diverge_index <= better_end_index, 'diverge index is out of range!'
-            assert 0 <= diverge_index <= worse_end_index, 'diverge index is out of range!'
-
-            better_seq_slice = slice(diverge_index, better_end_index + 1)
-            worse_seq_slice = slice(diverge_index, worse_end_index + 1)
-
-            # size = ()
-            better_log_prob = better_sequence_log_probs[i, better_seq_slice].sum(dim=-1)
-            worse_log_prob = worse_sequence_log_probs[i, worse_seq_slice].sum(dim=-1)
-            ref_better_log_prob = ref_better_sequence_log_probs[i, better_seq_slice].sum(dim=-1)
-            ref_worse_log_prob = ref_worse_sequence_log_probs[i, worse_seq_slice].sum(dim=-1)
-            better_log_ratio = better_log_prob - ref_better_log_prob
-            worse_log_ratio = worse_log_prob - ref_worse_log_prob
-            losses.append(
-                 - self.cfgs.train_cfgs.scale_better * F.sigmoid(self.cfgs.train_cfgs.scale_coeff * (better_log_ratio - self.kl))
-                 - self.cfgs.train_cfgs.scale_worse * F.sigmoid(self.cfgs.train_cfgs.scale_coeff * (self.kl - worse_log_ratio)),
-            )
-            better_sample_rewards.append(
-                self.cfgs.train_cfgs.scale_coeff * better_log_ratio.detach(),
-            )
-            worse_sample_rewards.append(self.cfgs.train_cfgs.scale_coeff * worse_log_ratio.detach())
-        loss = torch.stack(losses).mean()  # size = ()
-        better_sample_reward = torch.stack(better_sample_rewards)  # size = (B,)
-        worse_sample_reward = torch.stack(worse_sample_rewards)  # size = (B,)
-        reward = better_sample_reward + worse_sample_reward  # size = (B,)
-        reward_accuracy = (better_sample_reward > worse_sample_reward).float().mean()  # size = ()
-        reward_margin = better_sample_reward - worse_sample_reward  # size = (B,)
 
-        return {
-            'loss': loss,
-            'reward': reward,
-            'better_sample_reward': better_sample_reward,
-            'worse_sample_reward': worse_sample_reward,
-            'reward_accuracy': reward_accuracy,
-            'reward_margin': reward_margin,
-        }
+        return kto_loss(
+            sequence_log_probs,
+            ref_sequence_log_probs,
+            batch['input_ids'],
+            batch['attention_mask'],
+            self.kl,
+            scale_coeff=self.cfgs.train_cfgs.scale_coeff,
+            scale_better=self.cfgs.train_cfgs.scale_better,
+            scale_worse=self.cfgs.train_cfgs.scale_worse,
+        )
 
     def train_step(
         self,
@@ -317,11 +433,12 @@ class KTOTrainer:
         self.model.step()
 
         with torch.no_grad():
-            reward = loss_dict['reward'].mean()
-            better_sample_reward = loss_dict['better_sample_reward'].mean()
-            worse_sample_reward = loss_dict['worse_sample_reward'].mean()
+            valid = loss_dict['valid']
+            reward = masked_mean(loss_dict['reward'], valid)
+            better_sample_reward = masked_mean(loss_dict['better_sample_reward'], valid)
+            worse_sample_reward = masked_mean(loss_dict['worse_sample_reward'], valid)
             reward_accuracy = loss_dict['reward_accuracy']
-            reward_margin = loss_dict['reward_margin'].mean()
+            reward_margin = masked_mean(loss_dict['reward_margin'], valid)
 
             loss = get_all_reduce_mean(loss)
             reward = get_all_reduce_mean(reward)
@@ -337,6 +454,7 @@ class KTOTrainer:
             'train/worse_sample_reward': worse_sample_reward.item(),
             'train/reward_accuracy': reward_accuracy.item(),
             'train/reward_margin': reward_margin.item(),
+            'train/kl': self.kl.item(),
             'train/lr': self.model.optimizer.param_groups[0]['lr'],
         }
 
@@ -363,11 +481,11 @@ class KTOTrainer:
 
         for epoch in range(self.cfgs.train_cfgs.epochs):
             self.model.train()
-            if self.global_step%self.cfgs.train_cfgs.kl_steps==0:
-                with torch.no_grad():
-                    self.compute_kl()
 
             for batch in self.train_dataloader:
+                if self.global_step % self.cfgs.train_cfgs.kl_steps == 0:
+                    self.compute_kl()
+
                 info = self.train_step(batch)
                 torch.cuda.empty_cache()
 
@@ -16,6 +16,7 @@
 
 
 import argparse
+import itertools
 import os
 import sys
 from datetime import datetime
@@ -33,22 +34,26 @@ from transformers import CONFIG_NAME, AutoModelForCausalLM, PreTrainedModel, get
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
 from align_anything.datasets.preference import PreferenceBatch, PreferenceDataset
+from align_anything.datasets.streaming import StreamingPreferenceDataset
 from align_anything.models.pretrained_model import load_pretrained_models
 from align_anything.utils.logger import Logger
 from align_anything.utils.multi_process import (
     get_all_reduce_mean,
     get_current_device,
     is_main_process,
+    main_process_first,
 )
 from align_anything.utils.tools import (
     custom_cfgs_to_dict,
     dict_to_namedtuple,
     gather_log_probabilities,
     get_optimizer_grouped_parameters,
+    log1mexp,
+    masked_mean,
     namedtuple_to_dict,
-    prepare_ds_eval_cfgs,
     prepare_ds_train_cfgs,
     read_cfgs,
+    response_span_log_probs,
     seed_everything,
     update_dict,
 )
@@ -60,14 +65,14 @@ class ORPOTrainer:
         """Initialize trainer."""
         self.cfgs = cfgs
         self.ds_train_cfgs = prepare_ds_train_cfgs(custom_cfgs=cfgs.train_cfgs, raw_ds_cfgs=ds_cfgs)
-        self.ds_eval_cfgs = prepare_ds_eval_cfgs(custom_cfgs=cfgs.train_cfgs, raw_ds_cfgs=ds_cfgs)
         self.global_step = 0
 
         self.init_check()
         dist.barrier()
         self.init_models()
         dist.barrier()
-        self.init_datasets()
+        with main_process_first():
+            self.init_datasets()
         dist.barrier()
         self.init_engines()
         dist.barrier()
@@ -94,8 +99,6 @@ class ORPOTrainer:
         """Initialize model and tokenizer."""
         if self.ds_train_cfgs['zero_optimization']['stage'] == 3:
             self.dstchf_train = HfDeepSpeedConfig(self.ds_train_cfgs)
-        if self.ds_eval_cfgs['zero_optimization']['stage'] == 3:
-            self.dsechf_eval = HfDeepSpeedConfig(self.ds_eval_cfgs)
         self.model, self.tokenizer, self.processor = load_pretrained_models(
             self.cfgs.model_cfgs.model_name_or_path,
             model_max_length=self.cfgs.model_cfgs.model_max_length,
@@ -104,16 +107,22 @@ class ORPOTrainer:
             freeze_mm_proj=self.cfgs.train_cfgs.freeze_mm_proj,
             freeze_vision_tower=self.cfgs.train_cfgs.freeze_vision_tower,
         )
-        self.reference_model, _, _ = load_pretrained_models(
-            self.cfgs.model_cfgs.model_name_or_path,
-            model_max_length=self.cfgs.model_cfgs.model_max_length,
-            padding_side='left',
-            trust_remote_code=self.cfgs.train_cfgs.trust_remote_code,
-        )
 
     def init_datasets(self) -> None:
         """Initialize training and evaluation datasets."""
-        train_dataset = PreferenceDataset(
+        dataset_class = (
+            StreamingPreferenceDataset if self.cfgs.data_cfgs.train_streaming else PreferenceDataset
+        )
+        # The streaming dataset deals the samples to the workers in whole batches
+        streaming_kwargs = (
+            {
+                'seed': self.cfgs.train_cfgs.seed,
+                'batch_size': self.cfgs.train_cfgs.per_device_train_batch_size,
+            }
+            if self.cfgs.data_cfgs.train_streaming
+            else {}
+        )
+        train_dataset = dataset_class(
             path=self.cfgs.data_cfgs.train_datasets,
             template=self.cfgs.data_cfgs.template,
             tokenizer=self.tokenizer,
@@ -122,11 +131,16 @@ class ORPOTrainer:
             split=self.cfgs.data_cfgs.train_split,
             subset=self.cfgs.data_cfgs.subset,
             data_files=self.cfgs.data_cfgs.data_files,
+            **streaming_kwargs,
         )
         self.train_dataloader = DataLoader(
             train_dataset,
             collate_fn=train_dataset.get_collator(),
-            sampler=DistributedSampler(train_dataset, shuffle=True),
+            sampler=(
+                None
+                if self.cfgs.data_cfgs.train_streaming
+                else DistributedSampler(train_dataset, shuffle=True)
+            ),
             batch_size=self.cfgs.train_cfgs.per_device_train_batch_size,
         )
         if self.cfgs.data_cfgs.eval_datasets:
@@ -181,14 +195,21 @@ class ORPOTrainer:
             dist_init_required=True,
         )
 
-        self.reference_model, *_ = deepspeed.initialize(
-            model=self.reference_model,
-            config=self.ds_eval_cfgs,
-        )
-
         if self.cfgs.train_cfgs.gradient_checkpointing:
             self.model.gradient_checkpointing_enable()
 
+        if self.cfgs.train_cfgs.resume_from_checkpoint:
+            load_path, client_state = self.model.load_checkpoint(
+                self.cfgs.train_cfgs.resume_from_checkpoint,
+            )
+            if load_path is None:
+                raise ValueError(
+                    f'No checkpoint found in {self.cfgs.train_cfgs.resume_from_checkpoint}.',
+                )
+            self.global_step = client_state['global_step']
+            if self.cfgs.data_cfgs.train_streaming:
+                self.train_dataloader.dataset.load_state_dict(client_state['train_dataset'])
+
     @staticmethod
     def compute_log_probs(
         model: AutoModelForCausalLM,
@@ -204,70 +225,34 @@ class ORPOTrainer:
         batch: PreferenceBatch,
     ) -> dict[str, torch.Tensor]:
         """Loss function for the ORPO algorithm."""
-        sequence_log_probs = self.compute_log_probs(
+        sequence_log_probs = self.compute_log_probs(  # size = (2 * B, L - 1)
             self.model.module,
             batch,
         )
-        (
-            better_sequence_log_probs,  # size = (B, L - 1)
-            worse_sequence_log_probs,  # size = (B, L - 1)
-        ) = sequence_log_probs.chunk(chunks=2, dim=0)
-
-        with torch.no_grad():
-            ref_sequence_log_probs = self.compute_log_probs(  # size = (2 * B, L - 1)
-                self.reference_model.module,
-                batch,
-            )
-            ref_better_sequence_log_probs, ref_worse_sequence_log_probs = (
-                ref_sequence_log_probs.chunk(chunks=2, dim=0)
-            )
-
-        losses = []
-        better_sample_rewards = []
-        worse_sample_rewards = []
-
-        better_input_ids, worse_input_ids = batch['input_ids'].chunk(chunks=2, dim=0)
-        better_attention_mask, worse_attention_mask = batch['attention_mask'].chunk(chunks=2, dim=0)
-
-        batch_size = better_input_ids.size(0)
-        for i in range(batch_size):
-            if torch.all(torch.eq(better_input_ids[i], worse_input_ids[i])).item():
-                continue
-            better_end_index = better_attention_mask[i].nonzero()[-1].squeeze().item()
-            worse_end_index = worse_attention_mask[i].nonzero()[-1].squeeze().item()
-            diverge_index = (
-                (better_input_ids[i] != worse_input_ids[i]).nonzero()[0].squeeze().item()
-            )
-            assert 0 <= diverge_index <= better_end_index, 'diverge index is out of range!'
-            assert 0 <= diverge_index <= worse_end_index, 'diverge index is out of range!'
-
-            better_seq_slice = slice(diverge_index, better_end_index + 1)
-            worse_seq_slice = slice(diverge_index, worse_end_index + 1)
-            better_seq_length = better_end_index+1
-            worse_seq_length = worse_end_index+1
-            
-            # size = ()
-            better_log_prob = better_sequence_log_probs[i, better_seq_slice].sum(dim=-1)
-            worse_log_prob = worse_sequence_log_probs[i, worse_seq_slice].sum(dim=-1)
-            better_log_ratio = better_log_prob / better_seq_length
-            worse_log_ratio = worse_log_prob / worse_seq_length
-            log_odds = (better_log_ratio - worse_log_ratio) - (torch.log1p(-torch.exp(better_log_ratio )) - torch.log1p(-torch.exp(worse_log_ratio)))
-            odds_ratio_loss = -F.logsigmoid(log_odds)
-
-            sft_loss = -better_log_ratio
-            losses.append(
-                sft_loss+self.cfgs.train_cfgs.scale_coeff *odds_ratio_loss,
-            )
-            better_sample_rewards.append(
-                self.cfgs.train_cfgs.scale_coeff * better_log_ratio.detach(),
-            )
-            worse_sample_rewards.append(self.cfgs.train_cfgs.scale_coeff * worse_log_ratio.detach())
-
-        loss = torch.stack(losses).mean()  # size = ()
-        better_sample_reward = torch.stack(better_sample_rewards)  # size = (B,)
-        worse_sample_reward = torch.stack(worse_sample_rewards)  # size = (B,)
+        _, mean_log_probs, valid = response_span_log_probs(  # size = (2 * B,)
+            sequence_log_probs,
+            batch['input_ids'],
+            batch['attention_mask'],
+            length_normalization=self.cfgs.train_cfgs.length_normalization or 'response',
+        )
+        better_log_ratio, worse_log_ratio = mean_log_probs.chunk(chunks=2, dim=0)  # size = (B,)
+
+        # log(p / (1 - p)) of the better response minus that of the worse one.
+        log_odds = (better_log_ratio - worse_log_ratio) - (
+            log1mexp(better_log_ratio) - log1mexp(worse_log_ratio)
+        )  # size = (B,)
+        odds_ratio_loss = -F.logsigmoid(log_odds)  # size = (B,)
+        sft_loss = -better_log_ratio  # size = (B,)
+        losses = sft_loss + self.cfgs.train_cfgs.scale_coeff * odds_ratio_loss  # size = (B,)
+        loss = (losses * valid).sum() / valid.sum().clamp(min=1)  # size = ()
+
+        better_sample_reward = self.cfgs.train_cfgs.scale_coeff * better_log_ratio.detach()  # size = (B,)
+        worse_sample_reward = self.cfgs.train_cfgs.scale_coeff * worse_log_ratio.detach()  # size = (B,)
         reward = better_sample_reward + worse_sample_reward  # size = (B,)
-        reward_accuracy = (better_sample_reward > worse_sample_reward).float().mean()  # size = ()
+        reward_accuracy = masked_mean(
+            (better_sample_reward > worse_sample_reward).float(),
+            valid,
+        )  # size = ()
         reward_margin = better_sample_reward - worse_sample_reward  # size = (B,)
 
         return {
@@ -277,6 +262,7 @@ class ORPOTrainer:
             'worse_sample_reward': worse_sample_reward,
             'reward_accuracy': reward_accuracy,
             'reward_margin': reward_margin,
+            'valid': valid,
         }
 
     def train_step(
@@ -290,11 +276,12 @@ class ORPOTrainer:
         self.model.step()
 
         with torch.no_grad():
-            reward = loss_dict['reward'].mean()
-            better_sample_reward = loss_dict['better_sample_reward'].mean()
-            worse_sample_reward = loss_dict['worse_sample_reward'].mean()
+            valid = loss_dict['valid']
+            reward = masked_mean(loss_dict['reward'], valid)
+            better_sample_reward = masked_mean(loss_dict['better_sample_reward'], valid)
+            worse_sample_reward = masked_mean(loss_dict['worse_sample_reward'], valid)
             reward_accuracy = loss_dict['reward_accuracy']
-            reward_margin = loss_dict['reward_margin'].mean()
+            reward_margin = masked_mean(loss_dict['reward_margin'], valid)
 
             loss = get_all_reduce_mean(loss)
             reward = get_all_reduce_mean(reward)
@@ -334,12 +321,26 @@ class ORPOTrainer:
             self.logger.print('\n***** Evaluating at the beginning *****')
             self.logger.log(self.eval(), step=0)
 
-        for epoch in range(self.cfgs.train_cfgs.epochs):
+        # A resumed training starts in the middle of an epoch
+        start_epoch, start_step = divmod(self.global_step, len(self.train_dataloader))
+        progress_bar.update(self.global_step)
+        for epoch in range(start_epoch, self.cfgs.train_cfgs.epochs):
             self.model.train()
 
-            for batch in self.train_dataloader:
+            train_dataloader = self.train_dataloader
+            if self.cfgs.data_cfgs.train_streaming:
+                # The streaming dataset skips the samples it has recorded as consumed
+                train_dataloader.dataset.set_epoch(epoch)
+            elif epoch == start_epoch:
+                train_dataloader = itertools.islice(train_dataloader, start_step, None)
+
+            for batch in train_dataloader:
                 info = self.train_step(batch)
                 torch.cuda.empty_cache()
+                if self.cfgs.data_cfgs.train_streaming:
+                    train_dataloader.dataset.consume(
+                        self.cfgs.train_cfgs.per_device_train_batch_size,
+                    )
 
                 self.global_step += 1
                 progress_bar.set_description(
@@ -396,6 +397,17 @@ class ORPOTrainer:
         save_file_name = f'pytorch_model_{tag}.bin' if tag else 'pytorch_model.bin'
         model.save_16bit_model(self.cfgs.logger_cfgs.output_dir, save_filename=save_file_name)
 
+        if tag is not None and self.cfgs.logger_cfgs.save_checkpoint:
+            self.logger.print('Saving DeepSpeed checkpoint...')
+            client_state = {'global_step': self.global_step}
+            if self.cfgs.data_cfgs.train_streaming:
+                client_state['train_dataset'] = self.train_dataloader.dataset.state_dict()
+            model.save_checkpoint(
+                os.path.join(self.cfgs.logger_cfgs.output_dir, 'checkpoints'),
+                tag=f'global_step{tag}',
+                client_state=client_state,
+            )
+
         self.logger.print('Model saved!')
 
 
@@ -22,7 +22,7 @@ import itertools
 import os
 import sys
 from datetime import datetime
-from typing import Any
+from typing import Any, Iterator
 
 import deepspeed
 import torch
@@ -39,6 +39,8 @@ from align_anything.datasets import (
     DummyDataset,
     PromptOnlyBatch,
     PromptOnlyDataset,
+    StreamingPromptOnlyDataset,
+    StreamingSupervisedDataset,
     SupervisedDataset,
 )
 from align_anything.models.pretrained_model import load_pretrained_models
@@ -49,6 +51,7 @@ from align_anything.utils.multi_process import (
     get_all_reduce_mean,
     get_current_device,
     is_main_process,
+    main_process_first,
 )
 from align_anything.utils.tools import (
     batch_retokenize,
@@ -82,7 +85,8 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
         dist.barrier()
         self.init_models()
         dist.barrier()
-        self.init_datasets()
+        with main_process_first():
+            self.init_datasets()
         dist.barrier()
         self.init_engines()
         dist.barrier()
@@ -198,7 +202,15 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
     def init_datasets(self) -> None:
         """Initialize training and evaluation datasets."""
         # load training datasets
-        prompt_only_dataset = PromptOnlyDataset(
+        dataset_class = (
+            StreamingPromptOnlyDataset if self.cfgs.data_cfgs.train_streaming else PromptOnlyDataset
+        )
+        # The streaming datasets deal the samples to the workers in whole batches
+        streaming_kwargs = {
+            'seed': self.cfgs.train_cfgs.seed,
+            'batch_size': self.cfgs.train_cfgs.per_device_prompt_batch_size,
+        }
+        prompt_only_dataset = dataset_class(
             path=self.cfgs.data_cfgs.train_datasets,
             template=self.cfgs.data_cfgs.train_template,
             tokenizer=self.tokenizer,
@@ -207,11 +219,17 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
             split=self.cfgs.data_cfgs.train_split,
             subset=self.cfgs.data_cfgs.train_subset,
             data_files=self.cfgs.data_cfgs.train_data_files,
+            num_proc=self.cfgs.data_cfgs.num_proc,
+            **(streaming_kwargs if self.cfgs.data_cfgs.train_streaming else {}),
         )
         self.prompt_only_dataloader = DataLoader(
             prompt_only_dataset,
             collate_fn=prompt_only_dataset.get_collator(),
-            sampler=DistributedSampler(prompt_only_dataset, shuffle=True),
+            sampler=(
+                None
+                if self.cfgs.data_cfgs.train_streaming
+                else DistributedSampler(prompt_only_dataset, shuffle=True)
+            ),
             batch_size=self.cfgs.train_cfgs.per_device_prompt_batch_size,
         )
         # load evaluation datasets
@@ -225,6 +243,7 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
                 split=self.cfgs.data_cfgs.eval_split,
                 subset=self.cfgs.data_cfgs.eval_subset,
                 data_files=self.cfgs.data_cfgs.eval_data_files,
+                num_proc=self.cfgs.data_cfgs.num_proc,
             )
             self.eval_dataloader = DataLoader(
                 eval_dataset,
@@ -237,7 +256,12 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
         # load ptx datasets
         self.use_ptx = self.cfgs.data_cfgs.ptx_datasets is not None
         if self.use_ptx:
-            ptx_dataset = SupervisedDataset(
+            dataset_class = (
+                StreamingSupervisedDataset
+                if self.cfgs.data_cfgs.ptx_streaming
+                else SupervisedDataset
+            )
+            ptx_dataset = dataset_class(
                 path=self.cfgs.data_cfgs.ptx_datasets,
                 template=self.cfgs.data_cfgs.ptx_template,
                 tokenizer=self.tokenizer,
@@ -246,11 +270,16 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
                 split=self.cfgs.data_cfgs.ptx_split,
                 subset=self.cfgs.data_cfgs.ptx_subset,
                 data_files=self.cfgs.data_cfgs.ptx_data_files,
+                **(streaming_kwargs if self.cfgs.data_cfgs.ptx_streaming else {}),
             )
             self.ptx_dataloader = DataLoader(
                 ptx_dataset,
                 collate_fn=ptx_dataset.get_collator(),
-                sampler=DistributedSampler(ptx_dataset, shuffle=True),
+                sampler=(
+                    None
+                    if self.cfgs.data_cfgs.ptx_streaming
+                    else DistributedSampler(ptx_dataset, shuffle=True)
+                ),
                 batch_size=self.cfgs.train_cfgs.per_device_prompt_batch_size,
             )
         else:
@@ -351,6 +380,21 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
             self.actor_model.gradient_checkpointing_enable()
         if self.cfgs.train_cfgs.critic_gradient_checkpointing:
             self.reward_critic_model.gradient_checkpointing_enable()
+        # resume the training engines and the position in the datasets
+        if self.cfgs.train_cfgs.resume_from_checkpoint:
+            engines = {'actor': self.actor_model, 'critic': self.reward_critic_model}
+            for subdir, engine in engines.items():
+                load_dir = os.path.join(self.cfgs.train_cfgs.resume_from_checkpoint, subdir)
+                load_path, client_state = engine.load_checkpoint(load_dir)
+                if load_path is None:
+                    raise ValueError(f'No checkpoint found in {load_dir}.')
+            self.global_step = client_state['global_step']
+            if self.cfgs.data_cfgs.train_streaming:
+                self.prompt_only_dataloader.dataset.load_state_dict(
+                    client_state['prompt_only_dataset'],
+                )
+            if self.use_ptx and self.cfgs.data_cfgs.ptx_streaming:
+                self.ptx_dataloader.dataset.load_state_dict(client_state['ptx_dataset'])
 
     def set_train(self, mode: bool = True) -> None:
         """Set training mode for all models."""
@@ -366,6 +410,22 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
                 self.actor_model.gradient_checkpointing_disable()
         return
 
+    def ptx_batches(self, epoch: int, start: int = 0) -> Iterator[Any]:
+        """Cycle through the PTX batches along the prompt-only batches of an epoch."""
+        num_ptx_batches = len(self.ptx_dataloader)
+        num_ptx_replicas = (
+            len(self.prompt_only_dataloader) + num_ptx_batches - 1
+        ) // num_ptx_batches
+        ptx_streaming = self.use_ptx and self.cfgs.data_cfgs.ptx_streaming
+        start_replica, start_step = divmod(start, num_ptx_batches)
+        for replica in range(start_replica, num_ptx_replicas):
+            ptx_dataloader = self.ptx_dataloader
+            if ptx_streaming:
+                ptx_dataloader.dataset.set_epoch(epoch * num_ptx_replicas + replica)
+            elif replica == start_replica:
+                ptx_dataloader = itertools.islice(ptx_dataloader, start_step, None)
+            yield from ptx_dataloader
+
     def split_ptx_micro_batches(
         self,
         ptx_batch: dict[str, torch.Tensor],
@@ -619,14 +679,36 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
             self.logger.print('\n***** Evaluating at the beginning *****')
             self.eval()
 
-        num_prompt_only_batches = len(self.prompt_only_dataloader)
-        num_ptx_batches = len(self.ptx_dataloader)
-        num_ptx_replicas = (num_prompt_only_batches + num_ptx_batches - 1) // num_ptx_batches
-        for epoch in range(self.cfgs.train_cfgs.epochs):
+        # A resumed training continues after the last prompt-only batch it has started
+        steps_per_batch = (
+            self.cfgs.train_cfgs.update_iters
+            * self.cfgs.train_cfgs.per_device_prompt_batch_size
+            // self.cfgs.train_cfgs.per_device_train_batch_size
+        )
+        start_epoch, start_batch = divmod(
+            (self.global_step + steps_per_batch - 1) // steps_per_batch,
+            len(self.prompt_only_dataloader),
+        )
+        progress_bar.update(self.global_step)
+        for epoch in range(start_epoch, self.cfgs.train_cfgs.epochs):
+            prompt_only_dataloader = self.prompt_only_dataloader
+            if self.cfgs.data_cfgs.train_streaming:
+                # The streaming dataset skips the samples it has recorded as consumed
+                prompt_only_dataloader.dataset.set_epoch(epoch)
+            elif epoch == start_epoch:
+                prompt_only_dataloader = itertools.islice(prompt_only_dataloader, start_batch, None)
             for prompt_only_batch, ptx_batch in zip(
-                self.prompt_only_dataloader,
-                itertools.chain.from_iterable([self.ptx_dataloader] * num_ptx_replicas),
+                prompt_only_dataloader,
+                self.ptx_batches(epoch, start=start_batch if epoch == start_epoch else 0),
             ):
+                if self.cfgs.data_cfgs.train_streaming:
+                    self.prompt_only_dataloader.dataset.consume(
+                        self.cfgs.train_cfgs.per_device_prompt_batch_size,
+                    )
+                if self.use_ptx and self.cfgs.data_cfgs.ptx_streaming:
+                    self.ptx_dataloader.dataset.consume(
+                        self.cfgs.train_cfgs.per_device_prompt_batch_size,
+                    )
                 inference_batches, training_batches = self.rollout(prompt_only_batch)
 
                 if self.use_ptx:
@@ -805,6 +887,23 @@ class PPOTrainer:  # pylint: disable=too-many-instance-attributes
         save_file_name = f'pytorch_model_{tag}.bin' if tag else 'pytorch_model.bin'
         model.save_16bit_model(self.cfgs.logger_cfgs.output_dir, save_filename=save_file_name)
 
+        if tag is not None and self.cfgs.logger_cfgs.save_checkpoint:
+            self.logger.print('Saving DeepSpeed checkpoints...')
+            client_state = {'global_step': self.global_step}
+            if self.cfgs.data_cfgs.train_streaming:
+                client_state['prompt_only_dataset'] = (
+                    self.prompt_only_dataloader.dataset.state_dict()
+                )
+            if self.use_ptx and self.cfgs.data_cfgs.ptx_streaming:
+                client_state['ptx_dataset'] = self.ptx_dataloader.dataset.state_dict()
+            engines = {'actor': self.actor_model, 'critic': self.reward_critic_model}
+            for subdir, engine in engines.items():
+                engine.save_checkpoint(
+                    os.path.join(self.cfgs.logger_cfgs.output_dir, 'checkpoints', subdir),
+                    tag=f'global_step{tag}',
+                    client_state=client_state,
+                )
+
         self.logger.print('Model saved!')
 
 
@@ -16,6 +16,8 @@
 
 
 import argparse
+import itertools
+import json
 import os
 import sys
 from datetime import datetime
@@ -33,12 +35,14 @@ from transformers import CONFIG_NAME, PreTrainedModel, get_scheduler
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
 from align_anything.datasets.preference import PreferenceBatch, PreferenceDataset
+from align_anything.datasets.streaming import StreamingPreferenceDataset
 from align_anything.models.pretrained_model_with_value import load_pretrained_model_with_value_head
 from align_anything.utils.logger import Logger
 from align_anything.utils.multi_process import (
     get_all_reduce_mean,
     get_current_device,
     is_main_process,
+    main_process_first,
 )
 from align_anything.utils.tools import (
     custom_cfgs_to_dict,
@@ -53,6 +57,57 @@ from align_anything.utils.tools import (
 )
 
 
+class RewardStatistics:
+    """Streaming reducer of the evaluation rewards.
+
+    Keeps the number of correct and total pairs and the sum and the sum of squares of the rewards
+    on device, so the memory does not grow with the evaluation set and the shards of the ranks may
+    have any size. The rewards of every pair are optionally written to a per-rank JSON lines file.
+    """
+
+    def __init__(self, device: torch.device, spill_file: str | None = None) -> None:
+        # [num_correct, num_pairs, num_rewards, reward_sum, reward_square_sum]
+        self.values = torch.zeros(5, dtype=torch.float64, device=device)
+        self.spill_file = None
+        if spill_file is not None:
+            os.makedirs(os.path.dirname(spill_file), exist_ok=True)
+            self.spill_file = open(spill_file, 'w', encoding='utf-8')  # noqa: SIM115
+
+    def update(self, higher_end_rewards: torch.Tensor, lower_end_rewards: torch.Tensor) -> None:
+        """Accumulate a batch of paired rewards, both of size (B,)."""
+        rewards = torch.cat([higher_end_rewards, lower_end_rewards]).double()
+        self.values += torch.stack(
+            [
+                (higher_end_rewards > lower_end_rewards).sum().double(),
+                rewards.new_tensor(higher_end_rewards.size(0)),
+                rewards.new_tensor(rewards.size(0)),
+                rewards.sum(),
+                rewards.square().sum(),
+            ],
+        )
+        if self.spill_file is not None:
+            for higher, lower in zip(higher_end_rewards.tolist(), lower_end_rewards.tolist()):
+                self.spill_file.write(json.dumps({'higher': higher, 'lower': lower}) + '\n')
+
+    def compute(self) -> dict[str, float] | None:
+        """All-reduce the statistics, returns None when no rank has seen a pair."""
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        if dist.is_initialized():
+            dist.all_reduce(self.values, op=dist.ReduceOp.SUM)
+        num_correct, num_pairs, num_rewards, reward_sum, reward_square_sum = self.values.tolist()
+        if num_pairs == 0:
+            return None
+        mean = reward_sum / num_rewards
+        variance = (reward_square_sum - num_rewards * mean**2) / max(num_rewards - 1, 1)
+        return {
+            'eval/accuracy': num_correct / num_pairs,
+            'eval/reward_mean': mean,
+            'eval/reward_std': max(variance, 0.0) ** 0.5,
+        }
+
+
 class RMTrainer:
 
     def __init__(self, cfgs, ds_cfgs) -> None:
@@ -65,7 +120,8 @@ class RMTrainer:
         dist.barrier()
         self.init_models()
         dist.barrier()
-        self.init_datasets()
+        with main_process_first():
+            self.init_datasets()
         dist.barrier()
         self.init_engines()
         dist.barrier()
@@ -103,7 +159,19 @@ class RMTrainer:
 
     def init_datasets(self) -> None:
         """Initialize training and evaluation datasets."""
-        train_dataset = PreferenceDataset(
+        dataset_class = (
+            StreamingPreferenceDataset if self.cfgs.data_cfgs.train_streaming else PreferenceDataset
+        )
+        # The streaming dataset deals the samples to the workers in whole batches
+        streaming_kwargs = (
+            {
+                'seed': self.cfgs.train_cfgs.seed,
+                'batch_size': self.cfgs.train_cfgs.per_device_train_batch_size,
+            }
+            if self.cfgs.data_cfgs.train_streaming
+            else {}
+        )
+        train_dataset = dataset_class(
             path=self.cfgs.data_cfgs.train_datasets,
             template=self.cfgs.data_cfgs.train_template,
             tokenizer=self.tokenizer,
@@ -112,13 +180,19 @@ class RMTrainer:
             split=self.cfgs.data_cfgs.train_split,
             subset=self.cfgs.data_cfgs.train_subset,
             data_files=self.cfgs.data_cfgs.train_data_files,
+            **streaming_kwargs,
         )
         self.train_dataloader = DataLoader(
             train_dataset,
             collate_fn=train_dataset.get_collator(),
-            sampler=DistributedSampler(train_dataset, shuffle=True),
+            sampler=(
+                None
+                if self.cfgs.data_cfgs.train_streaming
+                else DistributedSampler(train_dataset, shuffle=True)
+            ),
             batch_size=self.cfgs.train_cfgs.per_device_train_batch_size,
         )
+        self.eval_dataloader = None
         if self.cfgs.data_cfgs.eval_datasets:
             eval_dataset = PreferenceDataset(
                 path=self.cfgs.data_cfgs.eval_datasets,
@@ -174,6 +248,18 @@ class RMTrainer:
         if self.cfgs.train_cfgs.gradient_checkpointing:
             self.model.gradient_checkpointing_enable()
 
+        if self.cfgs.train_cfgs.resume_from_checkpoint:
+            load_path, client_state = self.model.load_checkpoint(
+                self.cfgs.train_cfgs.resume_from_checkpoint,
+            )
+            if load_path is None:
+                raise ValueError(
+                    f'No checkpoint found in {self.cfgs.train_cfgs.resume_from_checkpoint}.',
+                )
+            self.global_step = client_state['global_step']
+            if self.cfgs.data_cfgs.train_streaming:
+                self.train_dataloader.dataset.load_state_dict(client_state['train_dataset'])
+
     def loss(
         self,
         batch: PreferenceBatch,
@@ -247,12 +333,26 @@ class RMTrainer:
         if self.cfgs.data_cfgs.eval_datasets:
             self.logger.log(self.eval(), step=0)
 
-        for epoch in range(self.cfgs.train_cfgs.epochs):
+        # A resumed training starts in the middle of an epoch
+        start_epoch, start_step = divmod(self.global_step, len(self.train_dataloader))
+        progress_bar.update(self.global_step)
+        for epoch in range(start_epoch, self.cfgs.train_cfgs.epochs):
             self.model.train()
 
-            for batch in self.train_dataloader:
+            train_dataloader = self.train_dataloader
+            if self.cfgs.data_cfgs.train_streaming:
+                # The streaming dataset skips the samples it has recorded as consumed
+                train_dataloader.dataset.set_epoch(epoch)
+            elif epoch == start_epoch:
+                train_dataloader = itertools.islice(train_dataloader, start_step, None)
+
+            for batch in train_dataloader:
                 info = self.train_step(batch)
                 torch.cuda.empty_cache()
+                if self.cfgs.data_cfgs.train_streaming:
+                    train_dataloader.dataset.consume(
+                        self.cfgs.train_cfgs.per_device_train_batch_size,
+                    )
 
                 self.global_step += 1
                 progress_bar.set_description(
@@ -295,8 +395,6 @@ class RMTrainer:
         self.model.eval()
         if self.cfgs.train_cfgs.gradient_checkpointing:
             self.model.gradient_checkpointing_disable()
-        num_correct_predictions = 0
-        num_total_predictions = 0
 
         eval_dataloader = tqdm(
             self.eval_dataloader,
@@ -306,7 +404,15 @@ class RMTrainer:
             leave=False,
         )
 
-        rewards = []
+        spill_file = None
+        if self.cfgs.train_cfgs.save_eval_rewards:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+            spill_file = os.path.join(
+                self.cfgs.logger_cfgs.output_dir,
+                'eval_rewards',
+                f'step_{self.global_step}_rank_{rank}.jsonl',
+            )
+        statistics = RewardStatistics(get_current_device(), spill_file=spill_file)
         batch = None
         for batch in eval_dataloader:
             output = self.model(**batch)
@@ -314,41 +420,20 @@ class RMTrainer:
             higher_end_rewards, lower_end_rewards = end_scores.squeeze(dim=-1).chunk(
                 chunks=2, dim=0
             )
-            batch_size = higher_end_rewards.size(0)
-            num_correct_predictions += (higher_end_rewards > lower_end_rewards).sum()
-            num_total_predictions += batch_size
-
-            rewards.extend([higher_end_rewards, lower_end_rewards])
+            statistics.update(higher_end_rewards, lower_end_rewards)
 
-        if batch is None:
-            self.logger.print('WARNING: `eval_dataloader` is empty.')
-            return {}
-
-        accuracy = num_correct_predictions / num_total_predictions
-        accuracy = get_all_reduce_mean(accuracy)
-
-        # Gather rewards from all devices for further analysis
-        rewards = torch.cat(rewards, dim=0)
-        if is_main_process():
-            gathered_rewards = [torch.empty_like(rewards) for _ in range(dist.get_world_size())]
-        else:
-            gathered_rewards = []
-        dist.gather(rewards, gathered_rewards, dst=0)
-        if is_main_process():
-            rewards = torch.cat(gathered_rewards, dim=0)
+        # Every rank takes part in the reduction, even one with an empty shard
+        info = statistics.compute()
 
         self.model.train()
         if self.cfgs.train_cfgs.gradient_checkpointing:
             self.model.gradient_checkpointing_enable()
 
-        # Evaluation info
-        info = {
-            'eval/accuracy': accuracy.item(),
-            'eval/reward_mean': rewards.mean().item(),
-            'eval/reward_std': rewards.std().item(),
-        }
+        if info is None:
+            self.logger.print('WARNING: `eval_dataloader` is empty.')
+            return {}
 
-        if is_main_process():
+        if is_main_process() and batch is not None:
             # Print some examples from the last batch
             max_num_rows = 3
             (
@@ -428,6 +513,17 @@ class RMTrainer:
         save_file_name = f'pytorch_model_{tag}.bin' if tag else 'pytorch_model.bin'
         model.save_16bit_model(self.cfgs.logger_cfgs.output_dir, save_filename=save_file_name)
 
+        if tag is not None and self.cfgs.logger_cfgs.save_checkpoint:
+            self.logger.print('Saving DeepSpeed checkpoint...')
+            client_state = {'global_step': self.global_step}
+            if self.cfgs.data_cfgs.train_streaming:
+                client_state['train_dataset'] = self.train_dataloader.dataset.state_dict()
+            model.save_checkpoint(
+                os.path.join(self.cfgs.logger_cfgs.output_dir, 'checkpoints'),
+                tag=f'global_step{tag}',
+                client_state=client_state,
+            )
+
         self.logger.print('Model saved!')
 
 
@@ -15,6 +15,7 @@
 """Trainer for supervised training."""
 
 import argparse
+import itertools
 import os
 import sys
 from datetime import datetime
@@ -30,10 +31,15 @@ from tqdm import tqdm
 from transformers import CONFIG_NAME, PreTrainedModel, get_scheduler
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
+from align_anything.datasets.streaming import StreamingSupervisedDataset
 from align_anything.datasets.supervised import SupervisedBatch, SupervisedDataset
 from align_anything.models.pretrained_model import load_pretrained_models
 from align_anything.utils.logger import Logger
-from align_anything.utils.multi_process import get_current_device, is_main_process
+from align_anything.utils.multi_process import (
+    get_current_device,
+    is_main_process,
+    main_process_first,
+)
 from align_anything.utils.tools import (
     custom_cfgs_to_dict,
     dict_to_namedtuple,
@@ -58,7 +64,8 @@ class SuperviseTrainer:
         dist.barrier()
         self.init_models()
         dist.barrier()
-        self.init_datasets()
+        with main_process_first():
+            self.init_datasets()
         dist.barrier()
         self.init_engines()
         dist.barrier()
@@ -94,7 +101,19 @@ class SuperviseTrainer:
 
     def init_datasets(self) -> None:
         """Initialize training and evaluation datasets."""
-        train_dataset = SupervisedDataset(
+        dataset_class = (
+            StreamingSupervisedDataset if self.cfgs.data_cfgs.train_streaming else SupervisedDataset
+        )
+        # The streaming dataset deals the samples to the workers in whole batches
+        streaming_kwargs = (
+            {
+                'seed': self.cfgs.train_cfgs.seed,
+                'batch_size': self.cfgs.train_cfgs.per_device_train_batch_size,
+            }
+            if self.cfgs.data_cfgs.train_streaming
+            else {}
+        )
+        train_dataset = dataset_class(
             path=self.cfgs.data_cfgs.train_datasets,
             template=self.cfgs.data_cfgs.train_template,
             tokenizer=self.tokenizer,
@@ -103,11 +122,16 @@ class SuperviseTrainer:
             split=self.cfgs.data_cfgs.train_split,
             subset=self.cfgs.data_cfgs.train_subset,
             data_files=self.cfgs.data_cfgs.train_data_files,
+            **streaming_kwargs,
         )
         self.train_dataloader = DataLoader(
             train_dataset,
             collate_fn=train_dataset.get_collator(),
-            sampler=DistributedSampler(train_dataset, shuffle=True),
+            sampler=(
+                None
+                if self.cfgs.data_cfgs.train_streaming
+                else DistributedSampler(train_dataset, shuffle=True)
+            ),
             batch_size=self.cfgs.train_cfgs.per_device_train_batch_size,
         )
         if self.cfgs.data_cfgs.eval_datasets:
@@ -161,6 +185,18 @@ class SuperviseTrainer:
         if self.cfgs.train_cfgs.gradient_checkpointing:
             self.model.gradient_checkpointing_enable()
 
+        if self.cfgs.train_cfgs.resume_from_checkpoint:
+            load_path, client_state = self.model.load_checkpoint(
+                self.cfgs.train_cfgs.resume_from_checkpoint,
+            )
+            if load_path is None:
+                raise ValueError(
+                    f'No checkpoint found in {self.cfgs.train_cfgs.resume_from_checkpoint}.',
+                )
+            self.global_step = client_state['global_step']
+            if self.cfgs.data_cfgs.train_streaming:
+                self.train_dataloader.dataset.load_state_dict(client_state['train_dataset'])
+
     def loss(self, sft_batch: SupervisedBatch) -> dict[str, torch.Tensor]:
         """Loss function for supervised finetuning."""
         outputs = self.model(**sft_batch)
@@ -195,12 +231,26 @@ class SuperviseTrainer:
             self.logger.print('\n***** Evaluating at the beginning *****')
             self.logger.log(self.eval(), step=0)
 
-        for epoch in range(self.cfgs.train_cfgs.epochs):
+        # A resumed training starts in the middle of an epoch
+        start_epoch, start_step = divmod(self.global_step, len(self.train_dataloader))
+        progress_bar.update(self.global_step)
+        for epoch in range(start_epoch, self.cfgs.train_cfgs.epochs):
             self.model.train()
 
-            for batch in self.train_dataloader:
+            train_dataloader = self.train_dataloader
+            if self.cfgs.data_cfgs.train_streaming:
+                # The streaming dataset skips the samples it has recorded as consumed
+                train_dataloader.dataset.set_epoch(epoch)
+            elif epoch == start_epoch:
+                train_dataloader = itertools.islice(train_dataloader, start_step, None)
+
+            for batch in train_dataloader:
                 info = self.train_step(batch)
                 torch.cuda.empty_cache()
+                if self.cfgs.data_cfgs.train_streaming:
+                    train_dataloader.dataset.consume(
+                        self.cfgs.train_cfgs.per_device_train_batch_size,
+                    )
 
                 self.global_step += 1
                 progress_bar.set_description(
@@ -292,6 +342,17 @@ class SuperviseTrainer:
         save_file_name = f'pytorch_model_{tag}.bin' if tag else 'pytorch_model.bin'
         model.save_16bit_model(self.cfgs.logger_cfgs.output_dir, save_filename=save_file_name)
 
+        if tag is not None and self.cfgs.logger_cfgs.save_checkpoint:
+            self.logger.print('Saving DeepSpeed checkpoint...')
+            client_state = {'global_step': self.global_step}
+            if self.cfgs.data_cfgs.train_streaming:
+                client_state['train_dataset'] = self.train_dataloader.dataset.state_dict()
+            model.save_checkpoint(
+                os.path.join(self.cfgs.logger_cfgs.output_dir, 'checkpoints'),
+                tag=f'global_step{tag}',
+                client_state=client_state,
+            )
+
         self.logger.print('Model saved!')
 
 
@@ -13,6 +13,7 @@
 # limitations under the License.
 # ==============================================================================
 
+import contextlib
 import os
 from typing import Any, Callable, TypeVar, cast
 
@@ -54,6 +55,32 @@ def rank_zero_only(func: Func) -> Func:
     return cast(Func, wrapper)
 
 
+def is_local_main_process() -> bool:
+    """Check if the current process is the main process of its node."""
+    return not dist.is_initialized() or int(os.environ.get('LOCAL_RANK', '0')) == 0
+
+
+@contextlib.contextmanager
+def main_process_first(local: bool = True) -> Generator[None, None, None]:
+    """Run the body on the main process of every node first, the other processes wait.
+
+    The other processes run the body after the main process has finished it, and then find its
+    results in the `datasets` cache, which they memory-map instead of preparing them again. With
+    `local=False` only the global main process goes first, for caches shared between nodes.
+    """
+    if not dist.is_initialized():
+        yield
+        return
+    is_first = is_local_main_process() if local else is_main_process()
+    if not is_first:
+        dist.barrier()
+    try:
+        yield
+    finally:
+        if is_first:
+            dist.barrier()
+
+
 def get_current_device() -> torch.device:
     r"""
     Gets the current available device.
@@ -0,0 +1,220 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Speculative decoding with a draft model or prompt lookup, and its acceptance statistics."""
+
+from __future__ import annotations
+
+import dataclasses
+import functools
+import os
+import time
+import warnings
+from typing import Any
+
+import torch
+import torch.distributed as dist
+from transformers import PreTrainedModel
+
+from align_anything.models.pretrained_model import load_pretrained_models
+from align_anything.utils.multi_process import get_current_device
+
+
+SPECULATIVE_KEYS = (
+    'assistant_model_name_or_path',
+    'num_assistant_tokens',
+    'prompt_lookup_num_tokens',
+)
+
+
+def split_speculative_config(generate_config: Any) -> tuple[dict[str, Any], dict[str, Any]]:
+    """Separate the speculative decoding options from the keyword arguments of `generate`."""
+    if hasattr(generate_config, '_asdict'):
+        generate_config = generate_config._asdict()
+    generate_config = dict(generate_config or {})
+    speculative_config = {
+        key: generate_config.pop(key) for key in SPECULATIVE_KEYS if key in generate_config
+    }
+    return generate_config, speculative_config
+
+
+@dataclasses.dataclass
+class SpeculativeStats:
+    """Counters of the speculative generation calls.
+
+    Every forward pass of the target model after the prefill verifies the proposed tokens and
+    yields the accepted ones plus one more, so `tokens_per_forward` is the factor by which the
+    number of target forward passes shrinks compared with plain decoding. It is not a wall-clock
+    speedup, which also pays for the draft model and the longer verification passes, compare
+    `tokens_per_second` with a run without speculative decoding for that.
+    """
+
+    num_calls: int = 0
+    num_tokens: int = 0
+    num_steps: int = 0
+    num_proposed: int = 0
+    generation_time: float = 0.0
+
+    @property
+    def num_accepted(self) -> int:
+        return max(self.num_tokens - self.num_steps, 0)
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.num_accepted / max(self.num_proposed, 1)
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.num_tokens / max(self.num_steps, 1)
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.num_tokens / max(self.generation_time, 1e-6)
+
+    def __add__(self, other: SpeculativeStats) -> SpeculativeStats:
+        return SpeculativeStats(
+            *(
+                getattr(self, field.name) + getattr(other, field.name)
+                for field in dataclasses.fields(self)
+            ),
+        )
+
+    def all_reduce(self) -> SpeculativeStats:
+        """Sum the counters over all ranks, the generation time is the one of the slowest rank."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return self
+        counts = torch.tensor(
+            [self.num_calls, self.num_tokens, self.num_steps, self.num_proposed],
+            dtype=torch.long,
+            device=get_current_device(),
+        )
+        generation_time = torch.tensor([self.generation_time], device=get_current_device())
+        dist.all_reduce(counts, op=dist.ReduceOp.SUM)
+        dist.all_reduce(generation_time, op=dist.ReduceOp.MAX)
+        num_calls, num_tokens, num_steps, num_proposed = counts.tolist()
+        return SpeculativeStats(num_calls, num_tokens, num_steps, num_proposed, generation_time.item())
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            'num_calls': self.num_calls,
+            'num_tokens': self.num_tokens,
+            'acceptance_rate': self.acceptance_rate,
+            'tokens_per_forward': self.tokens_per_forward,
+            'tokens_per_second': self.tokens_per_second,
+        }
+
+
+class SpeculativeDecoder:
+    """Run `generate` of a target model with a draft model or with prompt lookup.
+
+    With `assistant_model_name_or_path` a small model of the same tokenizer drafts the tokens,
+    otherwise `prompt_lookup_num_tokens` drafts them from the n-grams of the prompt, which needs
+    no extra model. Drafts are verified by the target model, with speculative sampling when
+    sampling is enabled, so the outputs follow the distribution of the target model. Assisted
+    generation only supports one sequence at a time, larger batches are generated plainly.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        assistant_model_name_or_path: str | os.PathLike | None = None,
+        num_assistant_tokens: int | None = None,
+        prompt_lookup_num_tokens: int | None = None,
+        dtype: torch.dtype | str | None = 'auto',
+        trust_remote_code: bool = False,
+    ) -> None:
+        self.assistant_model = None
+        self.prompt_lookup_num_tokens = None
+        if assistant_model_name_or_path is not None:
+            self.assistant_model, _, _ = load_pretrained_models(
+                assistant_model_name_or_path,
+                dtype=dtype,
+                trust_remote_code=trust_remote_code,
+            )
+            self.assistant_model.to(model.device).eval()
+            if num_assistant_tokens is not None:
+                self.assistant_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        elif prompt_lookup_num_tokens is not None:
+            self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+
+        self.stats = SpeculativeStats()
+        self.last_stats: SpeculativeStats | None = None
+        self.counting = False
+        self.num_forwards = 0
+        self.num_proposed = 0
+        self.warned_batch = False
+        if self.enabled:
+            self.wrap_forward(getattr(model, 'module', model))
+
+    @property
+    def enabled(self) -> bool:
+        return self.assistant_model is not None or self.prompt_lookup_num_tokens is not None
+
+    def wrap_forward(self, module: torch.nn.Module) -> None:
+        """Count the forward passes of the target model, `generate` calls them through `__call__`."""
+        forward = module.forward
+
+        @functools.wraps(forward)
+        def counted_forward(*args: Any, **kwargs: Any) -> Any:
+            if self.counting:
+                self.count_forward(kwargs.get('input_ids', args[0] if args else None))
+            return forward(*args, **kwargs)
+
+        module.forward = counted_forward
+
+    def count_forward(self, input_ids: torch.Tensor | None) -> None:
+        if self.num_forwards > 0 and input_ids is not None:
+            # Besides the proposed tokens the target model is fed the last accepted token.
+            self.num_proposed += input_ids.size(-1) - 1
+        self.num_forwards += 1
+
+    def generate_kwargs(self) -> dict[str, Any]:
+        if self.assistant_model is not None:
+            return {'assistant_model': self.assistant_model}
+        if self.prompt_lookup_num_tokens is not None:
+            return {'prompt_lookup_num_tokens': self.prompt_lookup_num_tokens}
+        return {}
+
+    def generate(self, model: PreTrainedModel, **kwargs: Any) -> Any:
+        """Call `model.generate` speculatively when possible and record the statistics."""
+        input_ids = kwargs['input_ids']
+        if not self.enabled:
+            return model.generate(**kwargs)
+        if input_ids.size(0) != 1:
+            if not self.warned_batch:
+                self.warned_batch = True
+                warnings.warn(
+                    'Speculative decoding only supports one sequence at a time, batches of '
+                    f'{input_ids.size(0)} sequences are generated without it.',
+                    stacklevel=2,
+                )
+            return model.generate(**kwargs)
+
+        self.counting, self.num_forwards, self.num_proposed = True, 0, 0
+        start = time.perf_counter()
+        try:
+            outputs = model.generate(**kwargs, **self.generate_kwargs())
+        finally:
+            self.counting = False
+        sequences = outputs if isinstance(outputs, torch.Tensor) else outputs.sequences
+
+        self.last_stats = SpeculativeStats(
+            num_calls=1,
+            num_tokens=sequences.size(-1) - input_ids.size(-1),
+            num_steps=self.num_forwards,
+            num_proposed=self.num_proposed,
+            generation_time=time.perf_counter() - start,
+        )
+        self.stats = self.stats + self.last_stats
+        return outputs
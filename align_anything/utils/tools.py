@@ -16,6 +16,7 @@
 from __future__ import annotations
 
 import json
+import math
 import os
 import random
 from collections import namedtuple
@@ -244,6 +245,54 @@ def gather_log_probabilities(
     return gathered_log_probs.squeeze(dim=-1)  # size = (B, L)
 
 
+def response_span_log_probs(
+    log_probs: torch.Tensor,  # size = (2 * B, L - 1)
+    input_ids: torch.LongTensor,  # size = (2 * B, L)
+    attention_mask: torch.BoolTensor,  # size = (2 * B, L)
+    length_normalization: str = 'response',
+) -> tuple[torch.Tensor, torch.Tensor, torch.BoolTensor]:
+    """Reduce the log probabilities of preference pairs over their response spans.
+
+    The batch holds the better sequences followed by the worse ones. The span of a sequence runs
+    from the first position where the two sequences of its pair diverge to its last token.
+    Returns the summed and the mean log probabilities over the spans, both of size (2 * B,), and
+    the mask of the pairs that diverge at all, of size (B,). The mean divides by the length of
+    the span with `length_normalization='response'`, or by the length of the whole sequence
+    with `'sequence'`.
+    """
+    if length_normalization not in {'response', 'sequence'}:
+        raise ValueError(f'Unknown length normalization: {length_normalization}')
+    better_input_ids, worse_input_ids = input_ids.chunk(chunks=2, dim=0)
+    diverge_mask = torch.ne(better_input_ids, worse_input_ids)  # size = (B, L)
+    valid = diverge_mask.any(dim=-1)  # size = (B,)
+    diverge_index = diverge_mask.int().argmax(dim=-1).repeat(2)  # size = (2 * B,)
+
+    positions = torch.arange(input_ids.size(-1), device=input_ids.device)
+    end_index = (positions * attention_mask).max(dim=-1).values  # size = (2 * B,)
+    span_mask = torch.logical_and(  # size = (2 * B, L - 1)
+        positions[:-1] >= diverge_index.unsqueeze(dim=-1),
+        positions[:-1] <= end_index.unsqueeze(dim=-1),
+    )
+
+    summed = (log_probs.float() * span_mask).sum(dim=-1)  # size = (2 * B,)
+    if length_normalization == 'sequence':
+        lengths = end_index + 1  # size = (2 * B,)
+    else:
+        lengths = span_mask.sum(dim=-1).clamp(min=1)  # size = (2 * B,)
+    mean = summed / lengths  # size = (2 * B,)
+    return summed, mean, valid
+
+
+def log1mexp(x: torch.Tensor) -> torch.Tensor:
+    """Compute `log(1 - exp(x))` for `x < 0` without cancellation."""
+    x = x.clamp(max=-torch.finfo(x.dtype).tiny)
+    return torch.where(
+        x > -math.log(2.0),
+        torch.log(-torch.expm1(x)),
+        torch.log1p(-torch.exp(x)),
+    )
+
+
 def batch_retokenize(
     input_ids: torch.LongTensor,
     src_tokenizer: PreTrainedTokenizerBase,
@@ -292,10 +341,10 @@ def masked_mean(
     x: torch.Tensor,  # size = (B, L)
     mask: torch.BoolTensor | None = None,  # size = (B, L)
 ) -> torch.Tensor:  # size = ()
-    """Compute the mean of a tensor with a mask."""
+    """Compute the mean of a tensor with a mask, zero where the mask is empty."""
     if mask is None:
         return x.mean()
-    return ((x * mask).sum(dim=-1) / mask.sum(dim=-1)).mean()
+    return ((x * mask).sum(dim=-1) / mask.sum(dim=-1).clamp(min=1)).mean()
 
 def str2bool(string: str) -> bool:
     """Convert a string literal to a boolean value."""
@@ -0,0 +1,145 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Concurrent MT-Bench judging against a local stub of the OpenAI chat endpoint."""
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+pytest.importorskip('openai')
+
+from align_anything.evaluation import utils  # noqa: E402
+from align_anything.evaluation.utils import (  # noqa: E402
+    AsyncJudgeClient,
+    Judge,
+    MatchSingle,
+    play_matches_async,
+)
+
+
+NUM_MATCHES = 6
+PROMPT_TEMPLATE = {
+    'name': 'single-v1',
+    'system_prompt': 'You are a judge.',
+    'prompt_template': 'Question: {question}\nAnswer: {answer}',
+    'output_format': '[[rating]]',
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Rate every answer with its number, answering later questions sooner."""
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.num_requests += 1
+            fail = self.server.num_requests <= self.server.num_failures
+        if fail:
+            self.send_error(503)
+            return
+        index = int(re.search(r'Answer: answer (\d+)', body['messages'][-1]['content']).group(1))
+        time.sleep(0.05 * (NUM_MATCHES - index))
+        payload = json.dumps({
+            'id': f'chatcmpl-{index}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body['model'],
+            'choices': [
+                {
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': f'Rating: [[{index}]]'},
+                    'finish_reason': 'stop',
+                },
+            ],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.num_requests = 0
+    server.num_failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_matches():
+    judge = Judge('stub-judge', PROMPT_TEMPLATE)
+    return [
+        MatchSingle(
+            question={'question_id': 100 + index, 'turns': [f'question {index}']},
+            model='model',
+            answer={'choices': [{'turns': [f'answer {index}']}]},
+            judge=judge,
+        )
+        for index in range(NUM_MATCHES)
+    ]
+
+
+def make_client(server):
+    return AsyncJudgeClient(
+        api_keys=['key-a', 'key-b'],
+        base_url=f'http://127.0.0.1:{server.server_address[1]}/v1',
+        max_concurrency=NUM_MATCHES,
+    )
+
+
+def test_results_are_appended_in_input_order(stub_server, tmp_path):
+    output_file = os.path.join(tmp_path, 'judgment', 'stub-judge.jsonl')
+    os.makedirs(os.path.dirname(output_file))
+    with open(output_file, 'w') as f:
+        f.write(json.dumps({'question_id': 0}) + '\n')
+
+    results = asyncio.run(play_matches_async(make_matches(), make_client(stub_server), output_file))
+
+    expected_ids = [100 + index for index in range(NUM_MATCHES)]
+    assert [result['question_id'] for result in results] == expected_ids
+    assert [result['score'] for result in results] == list(range(NUM_MATCHES))
+    with open(output_file) as f:
+        written = [json.loads(line) for line in f]
+    # Earlier judgments are kept and the new ones follow in input order.
+    assert [record['question_id'] for record in written] == [0, *expected_ids]
+    assert written[1:] == [json.loads(json.dumps(result)) for result in results]
+
+
+def test_failed_requests_are_retried(stub_server, monkeypatch):
+    monkeypatch.setattr(utils, 'API_BACKOFF_BASE', 0.01)
+    stub_server.num_failures = 2
+
+    results = asyncio.run(play_matches_async(make_matches()[:1], make_client(stub_server)))
+
+    assert results[0]['score'] == 0
+    assert results[0]['judgment'] == 'Rating: [[0]]'
+    assert stub_server.num_requests == 3
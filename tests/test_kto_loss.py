@@ -0,0 +1,156 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Parity of the vectorized KTO loss with the per-sample loop it replaced."""
+
+import pytest
+
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('deepspeed')
+
+import torch.nn.functional as F  # noqa: E402
+
+from align_anything.trainers.kto import kto_loss  # noqa: E402
+
+
+SCALE_COEFF = 0.1
+SCALE_BETTER = 1.0
+SCALE_WORSE = 1.5
+
+
+def loop_kto_loss(log_probs, ref_log_probs, input_ids, attention_mask, kl):
+    """The per-sample loop of `KTOTrainer.loss` before the vectorization."""
+    better_log_probs, worse_log_probs = log_probs.chunk(chunks=2, dim=0)
+    ref_better_log_probs, ref_worse_log_probs = ref_log_probs.chunk(chunks=2, dim=0)
+    better_input_ids, worse_input_ids = input_ids.chunk(chunks=2, dim=0)
+    better_attention_mask, worse_attention_mask = attention_mask.chunk(chunks=2, dim=0)
+
+    losses, better_rewards, worse_rewards = [], [], []
+    for i in range(better_input_ids.size(0)):
+        if torch.all(torch.eq(better_input_ids[i], worse_input_ids[i])).item():
+            continue
+        better_end_index = better_attention_mask[i].nonzero()[-1].squeeze().item()
+        worse_end_index = worse_attention_mask[i].nonzero()[-1].squeeze().item()
+        diverge_index = (better_input_ids[i] != worse_input_ids[i]).nonzero()[0].squeeze().item()
+        better_slice = slice(diverge_index, better_end_index + 1)
+        worse_slice = slice(diverge_index, worse_end_index + 1)
+
+        better_log_ratio = (
+            better_log_probs[i, better_slice].sum() - ref_better_log_probs[i, better_slice].sum()
+        )
+        worse_log_ratio = (
+            worse_log_probs[i, worse_slice].sum() - ref_worse_log_probs[i, worse_slice].sum()
+        )
+        losses.append(
+            -SCALE_BETTER * F.sigmoid(SCALE_COEFF * (better_log_ratio - kl))
+            - SCALE_WORSE * F.sigmoid(SCALE_COEFF * (kl - worse_log_ratio)),
+        )
+        better_rewards.append(SCALE_COEFF * better_log_ratio)
+        worse_rewards.append(SCALE_COEFF * worse_log_ratio)
+    return torch.stack(losses).mean(), torch.stack(better_rewards), torch.stack(worse_rewards)
+
+
+def run_kto_loss(log_probs, ref_log_probs, input_ids, attention_mask, kl):
+    return kto_loss(
+        log_probs,
+        ref_log_probs,
+        input_ids,
+        attention_mask,
+        kl,
+        scale_coeff=SCALE_COEFF,
+        scale_better=SCALE_BETTER,
+        scale_worse=SCALE_WORSE,
+    )
+
+
+def make_pair_batch(generator, prompt_lengths, better_lengths, worse_lengths, identical):
+    """Right-padded pairs sharing a prompt, the responses of `identical` pairs are equal."""
+    max_length = max(better_lengths + worse_lengths)
+    better, worse = [], []
+    for prompt_length, better_length, worse_length, same in zip(
+        prompt_lengths,
+        better_lengths,
+        worse_lengths,
+        identical,
+    ):
+        prompt = torch.randint(3, 100, (prompt_length,), generator=generator)
+        better_response = torch.randint(3, 100, (better_length - prompt_length,), generator=generator)
+        worse_response = torch.randint(100, 200, (worse_length - prompt_length,), generator=generator)
+        if same:
+            worse_response = better_response
+        better.append(torch.cat([prompt, better_response]))
+        worse.append(torch.cat([prompt, worse_response]))
+
+    sequences = better + worse
+    input_ids = torch.zeros(len(sequences), max_length, dtype=torch.long)
+    attention_mask = torch.zeros(len(sequences), max_length, dtype=torch.bool)
+    for i, sequence in enumerate(sequences):
+        input_ids[i, : sequence.size(0)] = sequence
+        attention_mask[i, : sequence.size(0)] = True
+    return input_ids, attention_mask
+
+
+@pytest.mark.parametrize('kl', [0.0, 0.7])
+def test_kto_loss_matches_loop(kl):
+    generator = torch.Generator().manual_seed(0)
+    identical = [False, True, False, False, True]
+    input_ids, attention_mask = make_pair_batch(
+        generator,
+        prompt_lengths=[3, 5, 2, 6, 4],
+        better_lengths=[9, 8, 12, 7, 10],
+        worse_lengths=[11, 8, 4, 13, 10],
+        identical=identical,
+    )
+    log_probs = -torch.rand(input_ids.size(0), input_ids.size(1) - 1, generator=generator) * 5
+    ref_log_probs = -torch.rand(input_ids.size(0), input_ids.size(1) - 1, generator=generator) * 5
+
+    loop_loss, loop_better, loop_worse = loop_kto_loss(
+        log_probs,
+        ref_log_probs,
+        input_ids,
+        attention_mask,
+        kl,
+    )
+    output = run_kto_loss(log_probs, ref_log_probs, input_ids, attention_mask, kl)
+    valid = output['valid']
+
+    assert valid.tolist() == [not same for same in identical]
+    torch.testing.assert_close(output['loss'], loop_loss)
+    torch.testing.assert_close(output['better_sample_reward'][valid], loop_better)
+    torch.testing.assert_close(output['worse_sample_reward'][valid], loop_worse)
+    torch.testing.assert_close(output['reward'][valid], loop_better + loop_worse)
+    torch.testing.assert_close(output['reward_margin'][valid], loop_better - loop_worse)
+    torch.testing.assert_close(
+        output['reward_accuracy'],
+        (loop_better > loop_worse).float().mean(),
+    )
+
+
+def test_kto_loss_without_diverging_pairs_is_zero():
+    generator = torch.Generator().manual_seed(1)
+    input_ids, attention_mask = make_pair_batch(
+        generator,
+        prompt_lengths=[3, 4],
+        better_lengths=[6, 9],
+        worse_lengths=[6, 9],
+        identical=[True, True],
+    )
+    log_probs = -torch.rand(input_ids.size(0), input_ids.size(1) - 1, generator=generator)
+
+    output = run_kto_loss(log_probs, log_probs, input_ids, attention_mask, 0.0)
+
+    assert torch.isfinite(output['loss']) and output['loss'].item() == 0.0
+    assert not output['valid'].any()
+    assert output['reward_accuracy'].item() == 0.0
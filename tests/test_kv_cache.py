@@ -0,0 +1,90 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Slot and token accounting of the key-value cache allocator."""
+
+import types
+
+import pytest
+
+from align_anything.serve.kv_cache import KVCacheAllocator
+
+
+def test_first_admission_into_an_empty_allocator():
+    allocator = KVCacheAllocator(num_slots=2, max_tokens=100)
+    assert allocator.used_tokens == 0
+    assert allocator.can_allocate(100)
+    assert not allocator.can_allocate(101)
+
+
+def test_allocate_and_free():
+    allocator = KVCacheAllocator(num_slots=2, max_tokens=100)
+    first = allocator.allocate(30)
+    assert allocator.reserved == {first: 30}
+    assert allocator.num_free_slots == 1
+
+    # The shared cache is padded to the longest reservation.
+    assert allocator.can_allocate(50)
+    assert not allocator.can_allocate(51)
+    second = allocator.allocate(50)
+    assert second != first
+    assert allocator.used_tokens == 100
+
+    # No slot is left, however small the request.
+    assert not allocator.can_allocate(1)
+    with pytest.raises(RuntimeError):
+        allocator.allocate(1)
+
+    allocator.free(second)
+    assert allocator.num_free_slots == 1
+    assert allocator.used_tokens == 30
+    assert allocator.allocate(40) == second
+
+    allocator.free(first)
+    allocator.free(second)
+    assert allocator.reserved == {}
+    assert allocator.num_free_slots == 2
+    assert allocator.can_allocate(100)
+
+
+def test_budget_from_free_memory():
+    config = types.SimpleNamespace(
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        hidden_size=64,
+        num_hidden_layers=3,
+        max_position_embeddings=128,
+    )
+    # Keys and values of 3 layers with 2 heads of 16 half-precision elements each.
+    assert KVCacheAllocator.bytes_per_token(config, element_size=2) == 384
+
+    allocator = KVCacheAllocator.from_free_memory(
+        config,
+        num_slots=4,
+        element_size=2,
+        free_memory=384 * 1000,
+        memory_fraction=0.5,
+    )
+    assert allocator.max_tokens == 500
+    assert KVCacheAllocator.from_free_memory(config, num_slots=4, element_size=2).max_tokens == 512
+    assert (
+        KVCacheAllocator.from_free_memory(
+            config,
+            num_slots=4,
+            element_size=2,
+            free_memory=384 * 1000,
+            max_tokens=64,
+        ).max_tokens
+        == 64
+    )
@@ -0,0 +1,103 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Hits, misses and invalidation of the per-rank evaluation result cache."""
+
+import os
+
+import pytest
+
+from align_anything.evaluation.result_cache import ResultCache, model_fingerprint
+
+
+CONFIG = {'action': 'logits', 'candidate_labels': ['A', 'B', 'C', 'D'], 'max_new_tokens': 32}
+
+
+def make_key(fingerprint='model', prompt='Question: 1 + 1 =', config=CONFIG, index=0):
+    return ResultCache.make_key(fingerprint, 'task', 'test', index, prompt, config)
+
+
+@pytest.fixture
+def prefix(tmp_path):
+    return os.path.join(tmp_path, 'model_results')
+
+
+def test_hit_and_miss(prefix):
+    cache = ResultCache(prefix)
+    key = make_key()
+    assert cache.get_many([key]) == {}
+
+    cache.put_many('task', [(key, {'pred': 'B', 'is_correct': True})])
+    assert cache.get_many([key, make_key(index=1)]) == {key: {'pred': 'B', 'is_correct': True}}
+    assert len(cache) == 1
+    cache.close()
+
+    # A committed result survives the process that wrote it.
+    reopened = ResultCache(prefix)
+    assert reopened.get_many([key]) == {key: {'pred': 'B', 'is_correct': True}}
+    reopened.close()
+
+
+def test_lookup_reads_the_files_of_all_ranks(prefix):
+    writers = [ResultCache(prefix, rank=rank) for rank in range(2)]
+    keys = [make_key(index=index) for index in range(4)]
+    for index, key in enumerate(keys):
+        writers[index % 2].put_many('task', [(key, {'index': index})])
+    for writer in writers:
+        assert len(writer) == 2
+        writer.close()
+    assert sorted(os.path.basename(path) for path in ResultCache(prefix).shard_paths()) == [
+        'model_results.rank0.sqlite',
+        'model_results.rank1.sqlite',
+    ]
+
+    # A run with another world size still finds every result.
+    reader = ResultCache(prefix, rank=3)
+    assert reader.get_many(keys) == {key: {'index': index} for index, key in enumerate(keys)}
+    reader.close()
+
+
+def test_changed_inputs_invalidate_the_key(prefix):
+    cache = ResultCache(prefix)
+    key = make_key()
+    cache.put_many('task', [(key, {'pred': 'B'})])
+
+    stale_keys = [
+        make_key(fingerprint='other-model'),
+        make_key(prompt='Question: 1 + 2 ='),
+        make_key(config={**CONFIG, 'max_new_tokens': 64}),
+        make_key(index=1),
+    ]
+    assert len(set(stale_keys)) == len(stale_keys)
+    assert cache.get_many(stale_keys) == {}
+
+    # Rewriting a key replaces the stale record.
+    cache.put_many('task', [(key, {'pred': 'C'})])
+    assert cache.get_many([key]) == {key: {'pred': 'C'}}
+    assert len(cache) == 1
+    cache.close()
+
+
+def test_fingerprint_changes_with_the_weights(tmp_path):
+    weights = tmp_path / 'model.safetensors'
+    weights.write_bytes(b'\x00' * 8)
+    (tmp_path / 'README.md').write_text('notes')
+    fingerprint = model_fingerprint(str(tmp_path))
+
+    (tmp_path / 'README.md').write_text('other notes')
+    assert model_fingerprint(str(tmp_path)) == fingerprint
+
+    weights.write_bytes(b'\x00' * 16)
+    assert model_fingerprint(str(tmp_path)) != fingerprint
+    assert model_fingerprint('org/model') != model_fingerprint('org/other-model')
@@ -0,0 +1,152 @@
+# Copyright 2024 PKU-Alignment Team. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""End-to-end requests against the OpenAI-compatible server on a tiny CPU checkpoint."""
+
+import json
+import threading
+import time
+import urllib.request
+
+import pytest
+
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('deepspeed')
+transformers = pytest.importorskip('transformers')
+tokenizers = pytest.importorskip('tokenizers')
+
+from align_anything.serve.server import make_server  # noqa: E402
+
+
+VOCAB = {'hello': 0, 'world': 1, '<pad>': 2, '</s>': 3, '<s>': 4, '<unk>': 5}
+
+
+@pytest.fixture(scope='module')
+def checkpoint(tmp_path_factory):
+    path = tmp_path_factory.mktemp('tiny-llama')
+    backend = tokenizers.Tokenizer(tokenizers.models.WordLevel(VOCAB, unk_token='<unk>'))
+    backend.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        pad_token='<pad>',
+        eos_token='</s>',
+        bos_token='<s>',
+        unk_token='<unk>',
+    )
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=len(VOCAB),
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        max_position_embeddings=64,
+        pad_token_id=VOCAB['<pad>'],
+        eos_token_id=VOCAB['</s>'],
+        bos_token_id=VOCAB['<s>'],
+    )
+    model = transformers.LlamaForCausalLM(config)
+    # All-zero logits make greedy decoding pick token 0 at every step, so the
+    # completion is a known run of 'hello' whatever the random weights are.
+    with torch.no_grad():
+        model.lm_head.weight.zero_()
+    model.save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(params=['batch', 'continuous'])
+def server_url(request, checkpoint):
+    server = make_server(checkpoint, port=0, max_length=64, dtype=torch.float32, engine=request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+    server.state.scheduler.close()
+
+
+def post(url, body):
+    data = json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        if body.get('stream'):
+            return [
+                line[len('data: ') :]
+                for line in response.read().decode('utf-8').splitlines()
+                if line.startswith('data: ')
+            ]
+        return json.loads(response.read())
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def test_completions(server_url):
+    body = {'prompt': 'hello world', 'max_tokens': 4, 'temperature': 0.0}
+    payload = post(f'{server_url}/v1/completions', body)
+    choice = payload['choices'][0]
+    assert choice['text'] == 'hello hello hello hello'
+    assert choice['finish_reason'] == 'length'
+    assert payload['usage']['prompt_tokens'] == 2
+    assert payload['usage']['completion_tokens'] == 4
+    assert payload['usage']['total_tokens'] == 6
+
+    events = post(f'{server_url}/v1/completions', {**body, 'stream': True})
+    assert events[-1] == '[DONE]'
+    chunks = [json.loads(event)['choices'][0] for event in events[:-1]]
+    assert ''.join(chunk['text'] for chunk in chunks) == choice['text']
+    assert [chunk['finish_reason'] for chunk in chunks][-1] == 'length'
+    assert all(chunk['finish_reason'] is None for chunk in chunks[:-1])
+
+
+def test_stop_and_max_tokens(server_url):
+    body = {'prompt': 'world', 'max_tokens': 8, 'temperature': 0.0, 'stop': [' hello']}
+    choice = post(f'{server_url}/v1/completions', body)['choices'][0]
+    assert choice['text'] == 'hello'
+    assert choice['finish_reason'] == 'stop'
+
+    events = post(f'{server_url}/v1/completions', {**body, 'stream': True})
+    chunks = [json.loads(event)['choices'][0] for event in events[:-1]]
+    assert ''.join(chunk['text'] for chunk in chunks) == 'hello'
+    assert chunks[-1]['finish_reason'] == 'stop'
+
+    choice = post(f'{server_url}/v1/completions', {'prompt': 'world', 'max_tokens': 1, 'temperature': 0.0})[
+        'choices'
+    ][0]
+    assert choice['text'] == 'hello'
+    assert choice['finish_reason'] == 'length'
+
+
+def test_metrics(server_url):
+    assert get(f'{server_url}/metrics')['num_requests'] == 0
+    post(f'{server_url}/v1/completions', {'prompt': 'hello', 'max_tokens': 3, 'temperature': 0.0})
+
+    # The counters are updated by the scheduler thread after it hands out the
+    # result, so give it a moment to catch up with the response.
+    deadline = time.monotonic() + 10.0
+    metrics = get(f'{server_url}/metrics')
+    while metrics['generated_tokens'] < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+        metrics = get(f'{server_url}/metrics')
+    assert metrics['num_requests'] == 1
+    assert metrics['queue_depth'] == 0
+    assert metrics['num_batches'] >= 1
+    assert metrics['prompt_tokens'] == 1
+    assert metrics['generated_tokens'] == 3